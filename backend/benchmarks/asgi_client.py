@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+from typing import NamedTuple
+
+
+class StreamedResponse(NamedTuple):
+    status_code: int
+    headers: dict[str, str]
+    # (seconds since the request was sent, body chunk) for every chunk the app sent
+    chunks: list[tuple[float, bytes]]
+    total_seconds: float
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(chunk for _, chunk in self.chunks)
+
+    def json(self):
+        return json.loads(self.body)
+
+
+async def request(
+    app,
+    method: str,
+    path: str,
+    json_body=None,
+    headers: dict[str, str] | None = None,
+    query_string: str = "",
+) -> StreamedResponse:
+    """
+    Sends a request straight to the ASGI app and records when every chunk of the response body arrives.
+
+    HTTP clients with an in-process transport buffer the whole response before returning it, which hides exactly the
+        timings a streaming endpoint is benchmarked for.
+    """
+    body = json.dumps(json_body).encode() if json_body is not None else b""
+    raw_headers = [(b"host", b"benchmark")]
+    if json_body is not None:
+        raw_headers.append((b"content-type", b"application/json"))
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query_string.encode(),
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+
+    request_sent = False
+    response_complete = asyncio.Event()
+    status_code = 0
+    response_headers: dict[str, str] = {}
+    chunks: list[tuple[float, bytes]] = []
+    start = time.perf_counter()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        # Streaming responses listen for a client disconnect while sending, which only happens once the app is done
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+            response_headers.update(
+                (name.decode(), value.decode())
+                for name, value in message.get("headers", [])
+            )
+        elif message["type"] == "http.response.body" and message.get("body"):
+            chunks.append((time.perf_counter() - start, message["body"]))
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        response_complete.set()
+
+    return StreamedResponse(
+        status_code, response_headers, chunks, time.perf_counter() - start
+    )
@@ -0,0 +1,128 @@
+"""
+Benchmark of the message compression on real messages, from a chat export (`GET /api/chat/export`).
+
+The messages that are long enough to be compressed are split in two: a dictionary is trained on one half, the other
+    half is compressed without and with it. Reports the compression ratio, the time to compress and decompress a
+    message, and the time to train the dictionary.
+
+Run from the backend directory:
+
+    python -m benchmarks.compression chats.ndjson
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from benchmarks.run import _summarize
+from src.util.dictionary_compression import (
+    NO_DICTIONARY,
+    compress,
+    decompress,
+    train_dictionary,
+)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("export", help="NDJSON export of chats")
+    parser.add_argument(
+        "--min-characters",
+        type=int,
+        default=1000,
+        help="Messages shorter than this are not compressed, see CC_MESSAGE_COMPRESSION_MIN_CHARACTERS",
+    )
+    parser.add_argument(
+        "--train-fraction",
+        type=float,
+        default=0.5,
+        help="Share of the messages the dictionary is trained on",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def _read_messages(path: str, min_characters: int) -> list[str]:
+    messages = []
+    with open(path) as export_file:
+        for line in export_file:
+            if not line.strip():
+                continue
+            exported = json.loads(line)
+            if (
+                exported["type"] == "message"
+                and len(exported["content"]) >= min_characters
+            ):
+                messages.append(exported["content"])
+    return messages
+
+
+def _measure(messages: list[str], version: int, dictionary: bytes) -> dict:
+    original_bytes = 0
+    compressed_bytes = 0
+    compress_seconds = []
+    decompress_seconds = []
+    for message in messages:
+        start = time.perf_counter()
+        compressed = compress(message, version, dictionary)
+        compress_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        decompressed = decompress(compressed, dictionary)
+        decompress_seconds.append(time.perf_counter() - start)
+        assert decompressed == message
+
+        original_bytes += len(message.encode())
+        compressed_bytes += len(compressed)
+
+    return {
+        "original_bytes": original_bytes,
+        "compressed_bytes": compressed_bytes,
+        "ratio": original_bytes / compressed_bytes,
+        "compress_megabytes_per_second": original_bytes
+        / sum(compress_seconds)
+        / 1024**2,
+        "decompress_megabytes_per_second": original_bytes
+        / sum(decompress_seconds)
+        / 1024**2,
+        "compress_seconds": _summarize(compress_seconds),
+        "decompress_seconds": _summarize(decompress_seconds),
+    }
+
+
+def main():
+    arguments = _parse_arguments()
+    messages = _read_messages(arguments.export, arguments.min_characters)
+    if len(messages) < 2:
+        raise SystemExit(
+            f"The export has {len(messages)} messages of at least {arguments.min_characters} characters, "
+            "at least 2 are needed"
+        )
+
+    random.Random(arguments.seed).shuffle(messages)
+    split = max(
+        1, min(int(len(messages) * arguments.train_fraction), len(messages) - 1)
+    )
+    training, evaluation = messages[:split], messages[split:]
+
+    start = time.perf_counter()
+    dictionary = train_dictionary(training)
+    train_seconds = time.perf_counter() - start
+
+    results = {
+        "messages": len(messages),
+        "training_messages": len(training),
+        "evaluation_messages": len(evaluation),
+        "median_message_characters": statistics.median(map(len, evaluation)),
+        "dictionary_bytes": len(dictionary),
+        "train_seconds": train_seconds,
+        "without_dictionary": _measure(evaluation, NO_DICTIONARY, b""),
+        "with_dictionary": _measure(evaluation, 1, dictionary),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+End-to-end benchmark of the chat API, served in-process with a tiny local model.
+
+The app is started through its own lifespan (migrations, model loading, workers), so it talks to the database
+    configured in the `.env` file and exercises the same code paths as a real deployment. Only the model is replaced by
+    a tiny randomly initialised one, so the numbers measure the serving code rather than the model.
+
+Run from the backend directory:
+
+    python -m benchmarks.run --concurrency 8 --chats 32
+    python -m benchmarks.run --compare benchmarks/results/<previous run>.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+
+from benchmarks.asgi_client import StreamedResponse, request
+from benchmarks.tiny_model import build_tiny_model
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Metrics where a higher value is better, every other metric is a latency / size where lower is better
+HIGHER_IS_BETTER = {"tokens_per_second", "requests_per_second"}
+
+
+def _parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Requests in flight at once"
+    )
+    parser.add_argument(
+        "--chats", type=int, default=32, help="Chats to create and message"
+    )
+    parser.add_argument(
+        "--follow-ups", type=int, default=1, help="Follow up messages per chat"
+    )
+    parser.add_argument("--logins", type=int, default=16, help="Logins to perform")
+    parser.add_argument(
+        "--max-new-tokens", type=int, default=64, help="Tokens generated per reply"
+    )
+    parser.add_argument("--warmup", type=int, default=2, help="Unrecorded requests")
+    parser.add_argument(
+        "--model-dir",
+        default=os.path.join(BENCHMARK_DIRECTORY, ".tiny_model"),
+        help="Where the tiny model is built (and reused from)",
+    )
+    parser.add_argument("--env-file", default=".env")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON file to write the results to, defaults to benchmarks/results/<timestamp>.json",
+    )
+    parser.add_argument(
+        "--compare", default=None, help="Results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=0.1,
+        help="Relative change of a p95 / throughput metric that counts as a regression",
+    )
+    return parser.parse_args()
+
+
+def _summarize(values: list[float]) -> dict[str, float] | None:
+    if not values:
+        return None
+
+    ordered = sorted(values)
+
+    def percentile(fraction: float) -> float:
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "min": ordered[0],
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": ordered[-1],
+    }
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class EndpointResults:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.time_to_first_token: list[float] = []
+        self.inter_token_latencies: list[float] = []
+        self.tokens_per_second: list[float] = []
+        self.generated_tokens = 0
+        self.errors = 0
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+
+    def to_json(self) -> dict:
+        wall_seconds = (
+            self.finished_at - self.started_at
+            if self.started_at is not None and self.finished_at is not None
+            else 0.0
+        )
+        results = {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "wall_seconds": wall_seconds,
+            "requests_per_second": len(self.latencies) / wall_seconds
+            if wall_seconds
+            else 0.0,
+            "latency_seconds": _summarize(self.latencies),
+        }
+        if self.time_to_first_token:
+            results |= {
+                "time_to_first_token_seconds": _summarize(self.time_to_first_token),
+                "inter_token_latency_seconds": _summarize(self.inter_token_latencies),
+                "per_request_tokens_per_second": _summarize(self.tokens_per_second),
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_second": self.generated_tokens / wall_seconds
+                if wall_seconds
+                else 0.0,
+            }
+        return results
+
+
+class Benchmark:
+    def __init__(self, app, tokenizer, arguments: argparse.Namespace):
+        self.app = app
+        self.tokenizer = tokenizer
+        self.arguments = arguments
+        self.results: dict[str, EndpointResults] = defaultdict(EndpointResults)
+        self.headers: dict[str, str] = {}
+        self.username = f"benchmark-{uuid.uuid4().hex[:12]}"
+        self.password = uuid.uuid4().hex
+
+    async def sign_up(self):
+        response = await request(
+            self.app,
+            "POST",
+            "/api/user/",
+            json_body={
+                "username": self.username,
+                "email": f"{self.username}@benchmark.local",
+                "password": self.password,
+                "name": "Benchmark",
+            },
+        )
+        if response.status_code != 201:
+            raise RuntimeError(f"Could not create the benchmark user: {response.body}")
+
+        login = await self._login()
+        self.headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+
+    async def _login(self) -> StreamedResponse:
+        return await request(
+            self.app,
+            "POST",
+            "/api/user/login/",
+            json_body={"username": self.username, "password": self.password},
+        )
+
+    async def run_all(self):
+        arguments = self.arguments
+
+        for index in range(arguments.warmup):
+            await self._create_chat(f"warm up {index}", record=False)
+
+        await self._run_concurrently(
+            "POST /api/user/login/",
+            [self._login for _ in range(arguments.logins)],
+        )
+
+        chat_ids = await self._run_concurrently(
+            "POST /api/chat/message",
+            [
+                lambda index=index: self._create_chat(
+                    f"How do I reverse a list in python? ({index})"
+                )
+                for index in range(arguments.chats)
+            ],
+        )
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id is not None]
+
+        for follow_up in range(arguments.follow_ups):
+            await self._run_concurrently(
+                "POST /api/chat/{chat_id}/message",
+                [
+                    lambda chat_id=chat_id: self._send_message(
+                        chat_id, f"Now sort it instead ({follow_up})"
+                    )
+                    for chat_id in chat_ids
+                ],
+            )
+
+        await self._run_concurrently(
+            "GET /api/chat/",
+            [self._get("/api/chat/") for _ in range(arguments.chats)],
+        )
+        await self._run_concurrently(
+            "GET /api/chat/{chat_id}/",
+            [self._get(f"/api/chat/{chat_id}/") for chat_id in chat_ids],
+        )
+
+    async def _run_concurrently(
+        self, endpoint: str, requests: list[Callable[[], Awaitable]]
+    ) -> list:
+        semaphore = asyncio.Semaphore(self.arguments.concurrency)
+        results = self.results[endpoint]
+
+        async def run(send_request):
+            async with semaphore:
+                response = await send_request()
+                if isinstance(response, StreamedResponse):
+                    self._record(endpoint, response)
+                return response
+
+        print(f"Running {len(requests)} x {endpoint}", file=sys.stderr)
+        results.started_at = time.perf_counter()
+        responses = await asyncio.gather(*[run(send) for send in requests])
+        results.finished_at = time.perf_counter()
+
+        return responses
+
+    def _record(self, endpoint: str, response: StreamedResponse):
+        results = self.results[endpoint]
+        if response.status_code >= 400:
+            results.errors += 1
+            return
+
+        results.latencies.append(response.total_seconds)
+
+    def _record_stream(
+        self, endpoint: str, response: StreamedResponse, header_lines: int
+    ):
+        """
+        Records the timings of a streamed reply, skipping the given number of JSON lines sent before the reply
+        """
+        results = self.results[endpoint]
+        if response.status_code >= 400:
+            results.errors += 1
+            return
+
+        token_times = []
+        reply = b""
+        remaining_header_lines = header_lines
+        for arrived_at, chunk in response.chunks:
+            while remaining_header_lines and chunk:
+                _, newline, chunk = chunk.partition(b"\n")
+                if newline:
+                    remaining_header_lines -= 1
+            if chunk:
+                token_times.append(arrived_at)
+                reply += chunk
+
+        results.latencies.append(response.total_seconds)
+        if not token_times:
+            return
+
+        tokens = len(
+            self.tokenizer(
+                reply.decode(errors="replace"), add_special_tokens=False
+            ).input_ids
+        )
+        results.generated_tokens += tokens
+        results.time_to_first_token.append(token_times[0])
+        results.inter_token_latencies.extend(
+            later - earlier for earlier, later in zip(token_times, token_times[1:])
+        )
+        if token_times[-1] > token_times[0]:
+            results.tokens_per_second.append(
+                tokens / (token_times[-1] - token_times[0])
+            )
+
+    async def _create_chat(self, message: str, record: bool = True) -> uuid.UUID | None:
+        response = await request(
+            self.app,
+            "POST",
+            "/api/chat/message",
+            json_body={"message": message, "language": "python"},
+            headers=self.headers,
+        )
+        if record:
+            self._record_stream("POST /api/chat/message", response, header_lines=1)
+        if response.status_code >= 400:
+            return None
+
+        return json.loads(response.body.partition(b"\n")[0])["id"]
+
+    async def _send_message(self, chat_id: uuid.UUID, message: str):
+        response = await request(
+            self.app,
+            "POST",
+            f"/api/chat/{chat_id}/message",
+            json_body={"message": message},
+            headers=self.headers,
+        )
+        self._record_stream(
+            "POST /api/chat/{chat_id}/message", response, header_lines=0
+        )
+
+    def _get(self, path: str) -> Callable[[], Awaitable[StreamedResponse]]:
+        return lambda: request(self.app, "GET", path, headers=self.headers)
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=BENCHMARK_DIRECTORY,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run(arguments: argparse.Namespace) -> dict:
+    load_dotenv(arguments.env_file)
+    # The app reads its settings on import, so they have to be in place before anything from `src` is imported
+    os.environ["CC_MODEL_PATH"] = build_tiny_model(arguments.model_dir)
+    os.environ["CC_SERVE_STATIC_FILES"] = "false"
+    os.environ["CC_GENERATION_MAX_NEW_TOKENS"] = str(arguments.max_new_tokens)
+    # Text is sent as soon as it is generated rather than coalesced into chunks, so the time between chunks is the
+    #   inter-token latency
+    os.environ["CC_STREAM_COALESCE_SECONDS"] = "0"
+
+    import_started_at = time.perf_counter()
+    from src.ai_models import get_model_registry
+    from src.main import app
+    from src.util.startup import STARTUP
+
+    import_seconds = time.perf_counter() - import_started_at
+
+    import torch
+
+    startup_started_at = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        # The app answers right away and loads in the background, it is started once it is ready
+        await STARTUP.wait_until_ready()
+        startup_seconds = time.perf_counter() - startup_started_at
+        startup_peak_rss_mb = _peak_rss_mb()
+
+        with get_model_registry().use() as ai_model:
+            tokenizer = ai_model.tokenizer
+        benchmark = Benchmark(app, tokenizer, arguments)
+        await benchmark.sign_up()
+        await benchmark.run_all()
+
+    return {
+        "created": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "arguments": {
+            name: value
+            for name, value in vars(arguments).items()
+            if name not in ("output", "compare", "env_file")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "import_seconds": import_seconds,
+        "startup_seconds": startup_seconds,
+        "startup_steps": STARTUP.timings,
+        "startup_peak_rss_mb": startup_peak_rss_mb,
+        "peak_rss_mb": _peak_rss_mb(),
+        "endpoints": {
+            endpoint: results.to_json()
+            for endpoint, results in benchmark.results.items()
+        },
+    }
+
+
+def _comparable_metrics(results: dict) -> dict[str, float]:
+    metrics = {"peak_rss_mb": results["peak_rss_mb"]}
+    for endpoint, endpoint_results in results["endpoints"].items():
+        for name in (
+            "latency_seconds",
+            "time_to_first_token_seconds",
+            "inter_token_latency_seconds",
+        ):
+            if endpoint_results.get(name):
+                metrics[f"{endpoint} {name} p95"] = endpoint_results[name]["p95"]
+        for name in ("tokens_per_second", "requests_per_second"):
+            if endpoint_results.get(name):
+                metrics[f"{endpoint} {name}"] = endpoint_results[name]
+    return metrics
+
+
+def _compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """
+    Prints how the metrics changed compared to the baseline run
+
+    :return: The metrics that regressed by more than the threshold
+    """
+    baseline_metrics = _comparable_metrics(baseline)
+    regressions = []
+
+    for name, value in _comparable_metrics(current).items():
+        previous = baseline_metrics.get(name)
+        if not previous:
+            continue
+
+        change = (value - previous) / previous
+        regressed = (
+            change < -threshold
+            if name.split(" ")[-1] in HIGHER_IS_BETTER
+            else change > threshold
+        )
+        if regressed:
+            regressions.append(name)
+
+        marker = "  REGRESSION" if regressed else ""
+        print(f"{name}: {previous:.4f} -> {value:.4f} ({change:+.1%}){marker}")
+
+    return regressions
+
+
+def main():
+    arguments = _parse_arguments()
+    results = asyncio.run(_run(arguments))
+
+    output = arguments.output or os.path.join(
+        BENCHMARK_DIRECTORY,
+        "results",
+        datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S") + ".json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as baseline_file:
+            regressions = _compare(
+                json.load(baseline_file), results, arguments.regression_threshold
+            )
+        if regressions:
+            print(f"{len(regressions)} metrics regressed", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
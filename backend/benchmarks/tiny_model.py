@@ -0,0 +1,72 @@
+import os
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+# Same layout as the Qwen chat template, without the tool calling / thinking parts
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+TRAINING_TEXT = [
+    "How do I reverse a list in python?",
+    "def reverse(values): return values[::-1]",
+    "Write a function that sorts a dictionary by its values",
+    "SELECT id, name FROM users WHERE create_date > now() ORDER BY name",
+    "const total = items.reduce((sum, item) => sum + item.price, 0);",
+]
+
+
+def build_tiny_model(path: str, seed: int = 0) -> str:
+    """
+    Builds a tiny, randomly initialised causal LM and a matching tokenizer in `path`, unless it already exists there.
+        Nothing is downloaded, the model is only meant to exercise the serving code, not to produce useful text.
+
+    :param path: Directory to save the model and tokenizer to, usable as `CC_MODEL_PATH`
+    :param seed: Seed for the model weights, so runs with the same seed are comparable
+    :return: The path
+    """
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=512,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<unk>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(TRAINING_TEXT * 50, trainer)
+
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        unk_token="<unk>",
+    )
+    fast_tokenizer.chat_template = CHAT_TEMPLATE
+
+    torch.manual_seed(seed)
+    config = Qwen3Config(
+        vocab_size=len(fast_tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=16,
+        max_position_embeddings=16384,
+        eos_token_id=fast_tokenizer.eos_token_id,
+        pad_token_id=fast_tokenizer.pad_token_id,
+    )
+    model = Qwen3ForCausalLM(config)
+
+    model.save_pretrained(path)
+    fast_tokenizer.save_pretrained(path)
+
+    return path
@@ -0,0 +1,39 @@
+"""added chat message status
+
+Revision ID: 9b8b2ddb7897
+Revises: e00715a7b367
+Create Date: 2026-10-18 09:12:41.204913+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9b8b2ddb7897"
+down_revision: Union[str, Sequence[str], None] = "e00715a7b367"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing messages were only ever saved once they were finished
+    op.add_column(
+        "chat_message",
+        sa.Column(
+            "status",
+            sa.String(length=20),
+            nullable=False,
+            server_default="complete",
+        ),
+    )
+    op.alter_column("chat_message", "status", server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("chat_message", "status")
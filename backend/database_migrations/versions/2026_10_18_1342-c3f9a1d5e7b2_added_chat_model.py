@@ -0,0 +1,30 @@
+"""added chat model
+
+Revision ID: c3f9a1d5e7b2
+Revises: 4d1c7e2a9f30
+Create Date: 2026-10-18 13:42:17.530214+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c3f9a1d5e7b2"
+down_revision: Union[str, Sequence[str], None] = "4d1c7e2a9f30"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing chats keep using the default model
+    op.add_column("chat", sa.Column("model", sa.String(length=100), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("chat", "model")
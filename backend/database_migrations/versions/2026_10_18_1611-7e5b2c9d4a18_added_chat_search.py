@@ -0,0 +1,69 @@
+"""added chat search
+
+Revision ID: 7e5b2c9d4a18
+Revises: c3f9a1d5e7b2
+Create Date: 2026-10-18 16:11:42.185406+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7e5b2c9d4a18"
+down_revision: Union[str, Sequence[str], None] = "c3f9a1d5e7b2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Generated columns are filled for the existing rows as they are added
+    op.add_column(
+        "chat",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('english', name)", persisted=True),
+            nullable=False,
+        ),
+    )
+    op.add_column(
+        "chat_message",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('english', content)", persisted=True),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_chat_search_vector",
+        "chat",
+        ["search_vector"],
+        unique=False,
+        postgresql_using="gin",
+    )
+    op.create_index(
+        "ix_chat_message_search_vector",
+        "chat_message",
+        ["search_vector"],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(
+        "ix_chat_message_search_vector",
+        table_name="chat_message",
+        postgresql_using="gin",
+    )
+    op.drop_index("ix_chat_search_vector", table_name="chat", postgresql_using="gin")
+    op.drop_column("chat_message", "search_vector")
+    op.drop_column("chat", "search_vector")
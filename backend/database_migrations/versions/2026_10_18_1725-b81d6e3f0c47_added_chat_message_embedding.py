@@ -0,0 +1,32 @@
+"""added chat message embedding
+
+Revision ID: b81d6e3f0c47
+Revises: 7e5b2c9d4a18
+Create Date: 2026-10-18 17:25:03.614920+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b81d6e3f0c47"
+down_revision: Union[str, Sequence[str], None] = "7e5b2c9d4a18"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing messages are embedded once their chat is first used with retrieval enabled
+    op.add_column(
+        "chat_message", sa.Column("embedding", sa.LargeBinary(), nullable=True)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("chat_message", "embedding")
@@ -0,0 +1,266 @@
+"""added message compression
+
+Revision ID: 5d2a8f1c6b93
+Revises: b81d6e3f0c47
+Create Date: 2026-10-18 19:04:27.530861+00:00
+
+"""
+
+import uuid
+import zlib
+from collections import Counter
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d2a8f1c6b93"
+down_revision: Union[str, Sequence[str], None] = "b81d6e3f0c47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Existing messages are compressed like the app compresses new ones by default (`message_compression_min_characters`).
+#   The app reads compressed messages whatever the setting is
+MIN_CHARACTERS = 1000
+DICTIONARY_SAMPLE_SIZE = 2000
+# Only the start of long messages is sampled, which keeps the memory of training bounded
+DICTIONARY_SAMPLE_CHARACTERS = 16384
+BATCH_SIZE = 1000
+
+chat_message = sa.table(
+    "chat_message",
+    sa.column("id", sa.Uuid()),
+    sa.column("content", sa.String()),
+    sa.column("compressed_content", sa.LargeBinary()),
+    sa.column("content_length", sa.Integer()),
+    sa.column("status", sa.String()),
+    sa.column("create_date", sa.DateTime()),
+)
+message_compression_dictionary = sa.table(
+    "message_compression_dictionary",
+    sa.column("id", sa.Uuid()),
+    sa.column("version", sa.SmallInteger()),
+    sa.column("data", sa.LargeBinary()),
+    sa.column("sample_messages", sa.Integer()),
+    sa.column("create_date", sa.DateTime()),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "message_compression_dictionary",
+        sa.Column("version", sa.SmallInteger(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.Column("sample_messages", sa.Integer(), nullable=False),
+        sa.Column("create_date", sa.DateTime(), nullable=False),
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("version"),
+    )
+    op.add_column(
+        "chat_message", sa.Column("compressed_content", sa.LargeBinary(), nullable=True)
+    )
+    op.add_column(
+        "chat_message", sa.Column("content_length", sa.Integer(), nullable=True)
+    )
+    op.execute(
+        chat_message.update().values(
+            content_length=sa.func.length(chat_message.c.content)
+        )
+    )
+    op.alter_column("chat_message", "content_length", nullable=False)
+    op.alter_column("chat_message", "content", nullable=True)
+    # The search vector keeps its values, from now on the app saves it along with the content
+    op.execute("ALTER TABLE chat_message ALTER COLUMN search_vector DROP EXPRESSION")
+
+    if MIN_CHARACTERS:
+        _compress_messages(op.get_bind())
+
+
+def _compress_messages(connection: sa.Connection):
+    compressible = sa.and_(
+        chat_message.c.content.is_not(None),
+        chat_message.c.content_length >= MIN_CHARACTERS,
+        chat_message.c.status != "streaming",
+    )
+
+    samples = connection.scalars(
+        sa.select(sa.func.left(chat_message.c.content, DICTIONARY_SAMPLE_CHARACTERS))
+        .where(compressible)
+        .order_by(chat_message.c.create_date.desc())
+        .limit(DICTIONARY_SAMPLE_SIZE)
+    ).all()
+    dictionary = train_dictionary(samples)
+    version = 0
+    if dictionary:
+        version = 1
+        connection.execute(
+            message_compression_dictionary.insert().values(
+                id=uuid.uuid4(),
+                version=version,
+                data=dictionary,
+                sample_messages=len(samples),
+                create_date=sa.func.now(),
+            )
+        )
+
+    compress_message = (
+        chat_message.update()
+        .where(chat_message.c.id == sa.bindparam("message_id"))
+        .values(content=None, compressed_content=sa.bindparam("compressed"))
+    )
+    last_id = None
+    while True:
+        query = (
+            sa.select(chat_message.c.id, chat_message.c.content)
+            .where(compressible)
+            .order_by(chat_message.c.id)
+            .limit(BATCH_SIZE)
+        )
+        if last_id is not None:
+            query = query.where(chat_message.c.id > last_id)
+        rows = connection.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        compressed_rows = []
+        for row in rows:
+            compressed = compress(row.content, version, dictionary)
+            if len(compressed) < len(row.content.encode()):
+                compressed_rows.append({"message_id": row.id, "compressed": compressed})
+        if compressed_rows:
+            connection.execute(compress_message, compressed_rows)
+
+
+# Copies of `src.util.dictionary_compression` as of this revision, so the migration keeps writing and reading this
+#   format however the app changes
+
+
+def _segments(text: str) -> set[bytes]:
+    segments = set()
+    for line in text.encode().splitlines(keepends=True):
+        if 8 <= len(line) <= 512:
+            segments.add(line)
+
+    words = text.split(" ")
+    for start in range(len(words) - 4 + 1):
+        phrase = (" ".join(words[start : start + 4]) + " ").encode()
+        if 8 <= len(phrase) <= 512:
+            segments.add(phrase)
+    return segments
+
+
+def train_dictionary(samples: list[str], size: int = 32 * 1024) -> bytes:
+    counts = Counter()
+    for sample in samples:
+        counts.update(_segments(sample))
+
+    ranked = sorted(
+        (segment for segment, count in counts.items() if count > 1),
+        key=lambda segment: counts[segment] * len(segment),
+        reverse=True,
+    )
+    chosen = []
+    used = 0
+    for segment in ranked:
+        if used + len(segment) <= size:
+            chosen.append(segment)
+            used += len(segment)
+
+    return b"".join(reversed(chosen))
+
+
+def compress(text: str, version: int, dictionary: bytes) -> bytes:
+    options = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, **options)
+    return (
+        version.to_bytes(2, "big")
+        + compressor.compress(text.encode())
+        + compressor.flush()
+    )
+
+
+def dictionary_version(data: bytes) -> int:
+    return int.from_bytes(data[:2], "big")
+
+
+def decompress(data: bytes, dictionary: bytes) -> str:
+    options = {"zdict": dictionary} if dictionary else {}
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, **options)
+    return (decompressor.decompress(data[2:]) + decompressor.flush()).decode()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    connection = op.get_bind()
+    dictionaries = dict(
+        connection.execute(
+            sa.select(
+                message_compression_dictionary.c.version,
+                message_compression_dictionary.c.data,
+            )
+        ).all()
+    )
+    dictionaries[0] = b""
+
+    decompress_message = (
+        chat_message.update()
+        .where(chat_message.c.id == sa.bindparam("message_id"))
+        .values(content=sa.bindparam("text"), compressed_content=None)
+    )
+    while True:
+        # Decompressed rows drop out of the query, so every batch is the next one
+        rows = connection.execute(
+            sa.select(chat_message.c.id, chat_message.c.compressed_content)
+            .where(chat_message.c.compressed_content.is_not(None))
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            decompress_message,
+            [
+                {
+                    "message_id": row.id,
+                    "text": decompress(
+                        row.compressed_content,
+                        dictionaries[dictionary_version(row.compressed_content)],
+                    ),
+                }
+                for row in rows
+            ],
+        )
+
+    op.alter_column("chat_message", "content", nullable=False)
+    op.drop_column("chat_message", "content_length")
+    op.drop_column("chat_message", "compressed_content")
+    op.drop_table("message_compression_dictionary")
+
+    # A column can't be turned back into a generated one, it is added again instead
+    op.drop_index(
+        "ix_chat_message_search_vector",
+        table_name="chat_message",
+        postgresql_using="gin",
+    )
+    op.drop_column("chat_message", "search_vector")
+    op.add_column(
+        "chat_message",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('english', content)", persisted=True),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_chat_message_search_vector",
+        "chat_message",
+        ["search_vector"],
+        unique=False,
+        postgresql_using="gin",
+    )
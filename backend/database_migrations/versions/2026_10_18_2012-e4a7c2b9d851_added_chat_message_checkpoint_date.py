@@ -0,0 +1,48 @@
+"""added chat message checkpoint date
+
+Revision ID: e4a7c2b9d851
+Revises: 5d2a8f1c6b93
+Create Date: 2026-10-18 20:12:36.118402+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e4a7c2b9d851"
+down_revision: Union[str, Sequence[str], None] = "5d2a8f1c6b93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "chat_message", sa.Column("checkpoint_date", sa.DateTime(), nullable=True)
+    )
+    # Replies that are still streaming count as saved when they were created, they are aborted by the next sweep if
+    #   that was long ago
+    op.execute(
+        "UPDATE chat_message SET checkpoint_date = create_date WHERE status = 'streaming'"
+    )
+    op.create_index(
+        "ix_chat_message_streaming_checkpoint_date",
+        "chat_message",
+        ["checkpoint_date"],
+        unique=False,
+        postgresql_where=sa.text("status = 'streaming'"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(
+        "ix_chat_message_streaming_checkpoint_date",
+        table_name="chat_message",
+        postgresql_where=sa.text("status = 'streaming'"),
+    )
+    op.drop_column("chat_message", "checkpoint_date")
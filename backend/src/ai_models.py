@@ -1,31 +1,509 @@
-from typing import NamedTuple, Any
-
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import gc
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, NamedTuple, Any
 
 from src.config import CONFIG
+from src.exceptions import ValidationError
+from src.inference.client import InferenceClient, RemoteScheduler
+from src.inference.generation import SamplingParameters
+from src.inference.response_cache import ResponseCache
 from src.logs import get_logger
+from src.metrics import MODEL_LOAD_DURATION, MODEL_UNLOAD_DURATION
+
+# torch and transformers take seconds to import. They are only imported once models are loaded, so the app (and web
+#   workers using an inference server) start without them
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+    from src.inference.scheduler import GenerationScheduler
 
 logger = get_logger(__name__)
 
 
 class AiModel(NamedTuple):
-    tokenizer: AutoTokenizer
+    tokenizer: "AutoTokenizer"
     model: Any
+    scheduler: "GenerationScheduler | RemoteScheduler"
+    # Smaller model with the same tokenizer, used for speculative decoding
+    draft_model: Any = None
+    # Memory used by the weights of the model and its draft model
+    memory_bytes: int = 0
 
 
-AI_MODELS: dict[str, AiModel] = {}
+class ModelInfo(NamedTuple):
+    name: str
+    default: bool
+    loaded: bool
+    memory_bytes: int
+    load_seconds: float
 
 
-def initialize_model():
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(
-            CONFIG.model_path, local_files_only=True
+class ModelRegistryStatistics(NamedTuple):
+    available_models: int
+    loaded_models: int
+    memory_budget_bytes: int
+    used_memory_bytes: int
+    loads: int
+    coalesced_loads: int
+    unloads: int
+    last_load_seconds: float
+    last_unload_seconds: float
+
+
+def _load_draft_model(tokenizer, model):
+    """
+    Loads the configured draft model onto the device of the main model, if it is compatible with the main model
+
+    :return: The draft model, or None if there is none or it can't be used
+    """
+    from transformers import AutoTokenizer
+
+    from src.inference.model_loading import load_causal_lm, model_memory_bytes
+
+    if CONFIG.draft_model_path is None:
+        return None
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(
+        CONFIG.draft_model_path, local_files_only=True
+    )
+    # Draft tokens are verified by id, so both models have to map text to exactly the same ids
+    if (
+        draft_tokenizer.get_vocab() != tokenizer.get_vocab()
+        or draft_tokenizer.eos_token_id != tokenizer.eos_token_id
+    ):
+        logger.warning(
+            f"Draft model {CONFIG.draft_model_path} uses a different tokenizer than {CONFIG.model_path}, "
+            f"speculative decoding is disabled"
+        )
+        return None
+
+    draft_model = load_causal_lm(
+        CONFIG.draft_model_path, CONFIG.model_quantization, device_map=model.device
+    )
+    logger.info(
+        f"Loaded draft model {CONFIG.draft_model_path} ({model_memory_bytes(draft_model) / 2**20:.0f} MB), "
+        f"drafting {CONFIG.draft_tokens} tokens per step"
+    )
+    return draft_model
+
+
+class ModelRegistry:
+    """
+    The models chats can be created with, by name. Models are loaded on first use.
+
+    Once the loaded models take up more than `memory_budget_bytes`, the least recently used ones are unloaded again,
+        but only while nothing is using them and their scheduler is idle. Concurrent requests for a model that is not
+        loaded yet all wait for a single load of it.
+    """
+
+    def __init__(
+        self,
+        model_paths: dict[str, str],
+        default_model: str,
+        memory_budget_bytes: int = 0,
+        response_cache: ResponseCache | None = None,
+    ):
+        self.model_paths = model_paths
+        self.default_model = default_model
+        self.memory_budget_bytes = memory_budget_bytes
+        # Shared by all models, the cache keys include the model
+        self.response_cache = response_cache
+
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in model_paths}
+        # Loaded models, least recently used first
+        self._models: OrderedDict[str, AiModel] = OrderedDict()
+        # Number of requests currently using each model, these are never unloaded
+        self._users: dict[str, int] = {}
+        # Memory used by the model the last time it was loaded, to make room before loading it again
+        self._memory_bytes: dict[str, int] = {}
+        self._load_seconds: dict[str, float] = {}
+
+        self._loads = 0
+        self._coalesced_loads = 0
+        self._unloads = 0
+        self._last_load_seconds = 0.0
+        self._last_unload_seconds = 0.0
+
+    @contextmanager
+    def use(self, name: str | None = None) -> Iterator[AiModel]:
+        """
+        Loads the model if it isn't already, and keeps it from being unloaded until the block is left. Requests
+            submitted to the scheduler within the block keep it loaded until they are finished.
+
+        :param name: Name of the model, None for the default model
+        :raises ValidationError: If no model with this name is configured
+        """
+        name = name if name is not None else self.default_model
+        self.validate_model_name(name)
+
+        ai_model = self._acquire(name)
+        try:
+            yield ai_model
+        finally:
+            with self._lock:
+                self._users[name] -= 1
+
+    def validate_model_name(self, name: str):
+        if name not in self.model_paths:
+            raise ValidationError(f"Model {name} is not available")
+
+    def loaded_models(self) -> list[tuple[str, AiModel]]:
+        with self._lock:
+            return list(self._models.items())
+
+    def models(self) -> list[ModelInfo]:
+        with self._lock:
+            return [
+                ModelInfo(
+                    name=name,
+                    default=name == self.default_model,
+                    loaded=name in self._models,
+                    memory_bytes=self._memory_bytes.get(name, 0),
+                    load_seconds=self._load_seconds.get(name, 0.0),
+                )
+                for name in self.model_paths
+            ]
+
+    def statistics(self) -> ModelRegistryStatistics:
+        with self._lock:
+            return ModelRegistryStatistics(
+                available_models=len(self.model_paths),
+                loaded_models=len(self._models),
+                memory_budget_bytes=self.memory_budget_bytes,
+                used_memory_bytes=sum(
+                    ai_model.memory_bytes for ai_model in self._models.values()
+                ),
+                loads=self._loads,
+                coalesced_loads=self._coalesced_loads,
+                unloads=self._unloads,
+                last_load_seconds=self._last_load_seconds,
+                last_unload_seconds=self._last_unload_seconds,
+            )
+
+    def shutdown(self):
+        with self._lock:
+            names = list(self._models)
+
+        for name in names:
+            with self._lock:
+                ai_model = self._models.pop(name)
+
+            start = time.perf_counter()
+            ai_model.scheduler.stop()
+            del ai_model
+            self._release_memory(name, start)
+
+    def _take_loaded(self, name: str) -> AiModel | None:
+        # Must be called with the lock held
+        ai_model = self._models.get(name)
+        if ai_model is not None:
+            self._models.move_to_end(name)
+            self._users[name] = self._users.get(name, 0) + 1
+        return ai_model
+
+    def _acquire(self, name: str) -> AiModel:
+        with self._lock:
+            ai_model = self._take_loaded(name)
+        if ai_model is not None:
+            return ai_model
+
+        with self._load_locks[name]:
+            with self._lock:
+                ai_model = self._take_loaded(name)
+                if ai_model is not None:
+                    # Loaded by a concurrent request while this one was waiting for it
+                    self._coalesced_loads += 1
+                    return ai_model
+
+            self._make_room(self._memory_bytes.get(name, 0), keep=name)
+
+            start = time.perf_counter()
+            ai_model = self._load(name)
+            load_seconds = time.perf_counter() - start
+            MODEL_LOAD_DURATION.labels(name).observe(load_seconds)
+            logger.info(
+                f"Loaded model {name} in {load_seconds:.1f}s ({ai_model.memory_bytes / 2**20:.0f} MB)"
+            )
+
+            with self._lock:
+                self._models[name] = ai_model
+                self._users[name] = self._users.get(name, 0) + 1
+                self._memory_bytes[name] = ai_model.memory_bytes
+                self._load_seconds[name] = load_seconds
+                self._loads += 1
+                self._last_load_seconds = load_seconds
+
+        # The size of a model is only known for sure once it is loaded
+        self._make_room(0, keep=name)
+        return ai_model
+
+    def _make_room(self, needed_bytes: int, keep: str):
+        """
+        Unloads least recently used models until `needed_bytes` more fit into the memory budget
+        """
+        if self.memory_budget_bytes <= 0:
+            return
+
+        while True:
+            with self._lock:
+                used_bytes = sum(
+                    ai_model.memory_bytes for ai_model in self._models.values()
+                )
+                if used_bytes + needed_bytes <= self.memory_budget_bytes:
+                    return
+
+                name = next(
+                    (
+                        name
+                        for name, ai_model in self._models.items()
+                        if name != keep
+                        and self._users.get(name, 0) == 0
+                        and ai_model.scheduler.is_idle()
+                    ),
+                    None,
+                )
+                if name is None:
+                    logger.warning(
+                        f"Loaded models use {used_bytes / 2**20:.0f} MB, more than the budget of "
+                        f"{self.memory_budget_bytes / 2**20:.0f} MB, but all of them are in use"
+                    )
+                    return
+
+                ai_model = self._models.pop(name)
+
+            start = time.perf_counter()
+            ai_model.scheduler.stop()
+            del ai_model
+            self._release_memory(name, start)
+
+    def _load(self, name: str) -> AiModel:
+        import torch
+        from transformers import AutoTokenizer
+
+        from src.inference.model_loading import (
+            load_causal_lm,
+            measure_decode_throughput,
+            model_fingerprint,
+            model_memory_bytes,
+        )
+        from src.inference.scheduler import GenerationScheduler
+        from src.inference.session_cache import SessionCache
+
+        model_path = self.model_paths[name]
+
+        tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        model = load_causal_lm(model_path, CONFIG.model_quantization)
+        logger.info(
+            f"Loaded model weights of {name} with quantization {CONFIG.model_quantization}: "
+            f"{model_memory_bytes(model) / 2**20:.0f} MB, {torch.get_num_threads()} CPU threads"
+        )
+        if CONFIG.model_warmup_tokens > 0:
+            tokens_per_second = measure_decode_throughput(
+                tokenizer, model, CONFIG.model_warmup_tokens
+            )
+            logger.info(
+                f"Warm-up of {name} generated {CONFIG.model_warmup_tokens} tokens at {tokens_per_second:.1f} tokens/s"
+            )
+
+        # The draft model is made for the default model
+        draft_model = (
+            _load_draft_model(tokenizer, model) if name == self.default_model else None
+        )
+
+        scheduler = GenerationScheduler(
+            tokenizer,
+            model,
+            max_batch_size=CONFIG.generation_max_batch_size,
+            max_queued_requests=CONFIG.generation_max_queued_requests,
+            session_cache=SessionCache(CONFIG.generation_session_cache_mb * 1024 * 1024)
+            if CONFIG.generation_session_cache_mb > 0
+            else None,
+            response_cache=self.response_cache,
+            default_sampling=SamplingParameters(do_sample=False)
+            if CONFIG.generation_greedy
+            else None,
+            draft_model=draft_model,
+            draft_tokens=CONFIG.draft_tokens,
+            model_fingerprint=model_fingerprint(model_path, CONFIG.model_quantization),
         )
-        model = AutoModelForCausalLM.from_pretrained(
-            CONFIG.model_path, dtype="auto", device_map="auto"
+        scheduler.start()
+        logger.info(f"Loaded model {model_path} on device: {model.device}")
+
+        memory_bytes = model_memory_bytes(model)
+        if draft_model is not None:
+            memory_bytes += model_memory_bytes(draft_model)
+
+        return AiModel(tokenizer, model, scheduler, draft_model, memory_bytes)
+
+    def _release_memory(self, name: str, unload_start: float):
+        """
+        Frees the memory of an unloaded model. The caller must not hold on to any reference to the model anymore,
+            otherwise its weights stay in memory
+        """
+        import torch
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        unload_seconds = time.perf_counter() - unload_start
+        MODEL_UNLOAD_DURATION.labels(name).observe(unload_seconds)
+        with self._lock:
+            self._unloads += 1
+            self._last_unload_seconds = unload_seconds
+        logger.info(f"Unloaded model {name} in {unload_seconds:.1f}s")
+
+
+class RemoteModelRegistry:
+    """
+    The models of the inference server this web worker is connected to, with the same interface as `ModelRegistry`.
+
+    Only the tokenizers are loaded here, to build the prompts. Loading, unloading and generating all happen in the
+        inference server.
+    """
+
+    def __init__(
+        self, client: InferenceClient, model_paths: dict[str, str], default_model: str
+    ):
+        self.model_paths = model_paths
+        self.default_model = default_model
+
+        self._client = client
+        self._lock = threading.Lock()
+        self._tokenizers: dict[str, "AutoTokenizer"] = {}
+
+    @contextmanager
+    def use(self, name: str | None = None) -> Iterator[AiModel]:
+        """
+        The model is loaded by the inference server once a request is submitted to it
+        """
+        name = name if name is not None else self.default_model
+        self.validate_model_name(name)
+
+        yield self._remote_model(name)
+
+    def validate_model_name(self, name: str):
+        if name not in self.model_paths:
+            raise ValidationError(f"Model {name} is not available")
+
+    def loaded_models(self) -> list[tuple[str, AiModel]]:
+        return [
+            (name, self._remote_model(name))
+            for name in self._client.call("loaded_models")
+        ]
+
+    def models(self) -> list[ModelInfo]:
+        return self._client.call("models")
+
+    def statistics(self) -> ModelRegistryStatistics:
+        return self._client.call("registry_statistics")
+
+    @property
+    def client(self) -> InferenceClient:
+        return self._client
+
+    def shutdown(self):
+        self._client.close()
+
+    def _remote_model(self, name: str) -> AiModel:
+        from transformers import AutoTokenizer
+
+        with self._lock:
+            tokenizer = self._tokenizers.get(name)
+            if tokenizer is None:
+                tokenizer = AutoTokenizer.from_pretrained(
+                    self.model_paths[name], local_files_only=True
+                )
+                self._tokenizers[name] = tokenizer
+
+        return AiModel(tokenizer, None, RemoteScheduler(self._client, name))
+
+
+MODEL_REGISTRY: ModelRegistry | RemoteModelRegistry | None = None
+
+
+def get_model_registry() -> ModelRegistry | RemoteModelRegistry:
+    if MODEL_REGISTRY is None:
+        raise ValueError("Models must be loaded before processing messages")
+
+    return MODEL_REGISTRY
+
+
+def get_inference_client() -> InferenceClient | None:
+    """
+    The connection to the inference server, None if the models run in this process
+    """
+    if isinstance(MODEL_REGISTRY, RemoteModelRegistry):
+        return MODEL_REGISTRY.client
+    return None
+
+
+def loaded_models() -> list[tuple[str, AiModel]]:
+    return MODEL_REGISTRY.loaded_models() if MODEL_REGISTRY is not None else []
+
+
+def _configured_model_paths() -> dict[str, str]:
+    return {CONFIG.model_name: CONFIG.model_path, **CONFIG.models}
+
+
+def initialize_model():
+    """
+    Connects to the inference server if one is configured, otherwise loads the models into this process
+    """
+    global MODEL_REGISTRY
+
+    if CONFIG.inference_socket is None:
+        initialize_local_models()
+        return
+
+    client = InferenceClient(
+        CONFIG.inference_socket, CONFIG.inference_connect_timeout_seconds
+    )
+    MODEL_REGISTRY = RemoteModelRegistry(
+        client, _configured_model_paths(), CONFIG.model_name
+    )
+    logger.info(f"Connected to the inference server at {CONFIG.inference_socket}")
+
+
+def initialize_local_models():
+    global MODEL_REGISTRY
+
+    import torch
+
+    if CONFIG.torch_threads is not None:
+        torch.set_num_threads(CONFIG.torch_threads)
+
+    response_cache = None
+    if CONFIG.response_cache_mb > 0:
+        response_cache = ResponseCache(
+            CONFIG.response_cache_mb * 1024 * 1024,
+            directory=CONFIG.response_cache_directory,
+            max_disk_bytes=CONFIG.response_cache_disk_mb * 1024 * 1024,
         )
-        AI_MODELS[CONFIG.model_path] = AiModel(tokenizer, model)
-        logger.info(f"Loaded model {CONFIG.model_path} on device: {model.device}")
+
+    MODEL_REGISTRY = ModelRegistry(
+        _configured_model_paths(),
+        default_model=CONFIG.model_name,
+        memory_budget_bytes=CONFIG.model_memory_budget_mb * 1024 * 1024,
+        response_cache=response_cache,
+    )
+
+    # The default model is loaded right away, it also summarizes messages in the background
+    try:
+        with MODEL_REGISTRY.use():
+            pass
     except:
         logger.error(f"Failed to load model {CONFIG.model_path}")
         raise
+
+
+def shutdown_models():
+    global MODEL_REGISTRY
+
+    if MODEL_REGISTRY is not None:
+        MODEL_REGISTRY.shutdown()
+        MODEL_REGISTRY = None
@@ -1,9 +1,13 @@
 import secrets
+from typing import Literal
 
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+ModelQuantization = Literal["none", "bf16", "int8_dynamic"]
+
+
 def generate_random_jwt_secret() -> str:
     return secrets.token_urlsafe(128)
 
@@ -32,12 +36,111 @@ class ApplicationSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="CC_", env_nested_delimiter="_")
 
     model_path: str
+    # Name of the model at `model_path`, which is used for chats that don't choose a model
+    model_name: str = "default"
+    # Further models chats can be created with, by name, e.g. {"large": "/path/to/qwen3-8B"}. Loaded on first use
+    models: dict[str, str] = {}
+    # Memory the loaded models may take up before the least recently used ones are unloaded. 0 is unlimited
+    model_memory_budget_mb: int = 0
+    # How the model weights are loaded: as stored ("none"), as bfloat16 ("bf16") or with the Linear layers quantized to
+    #   int8 for the CPU ("int8_dynamic"). The draft model is loaded the same way
+    model_quantization: ModelQuantization = "none"
+    # Number of threads torch uses on the CPU, defaults to the number of physical cores
+    torch_threads: int | None = None
+    # Tokens generated when the model is loaded, to warm it up and log its speed. 0 disables
+    model_warmup_tokens: int = 16
 
     serve_static_files: bool = True
     static_directory: str = "static"
 
     db: DatabaseSettings
 
+    # Connection pool settings for the shared database engine
+    db_pool_size: int = 10
+    db_pool_max_overflow: int = 20
+    db_pool_timeout_seconds: float = 30
+    db_pool_pre_ping: bool = True
+    db_pool_recycle_seconds: int = 1800
+
+    # Unix socket of a separate inference server (`python -m src.inference.server`) that runs the models for all web
+    #   workers of the host, so they are only loaded once. Web workers only load the tokenizers when this is set, the
+    #   embedding model and the background summarization run in the inference server as well
+    inference_socket: str | None = None
+    # How long web workers wait for the inference server to come up
+    inference_connect_timeout_seconds: float = 60
+
+    # Continuous batching settings for the generation scheduler
+    generation_max_batch_size: int = 8
+    generation_max_queued_requests: int = 64
+    generation_max_new_tokens: int = 32768
+    # Optional smaller model with the same tokenizer, used to draft tokens for speculative decoding (greedy only)
+    draft_model_path: str | None = None
+    draft_tokens: int = 4
+    # Always pick the most likely token instead of sampling as configured by the model, makes replies deterministic
+    generation_greedy: bool = False
+    # Memory to use for keeping the KV cache of recent chats, so follow up messages only prefill new tokens. 0 disables
+    generation_session_cache_mb: int = 2048
+
+    # Memory to use for remembering replies to repeated prompts, only used for greedy generation. 0 disables.
+    #   Replies evicted from memory are kept in the directory, if one is set, up to the disk limit
+    response_cache_mb: int = 0
+    response_cache_directory: str | None = None
+    response_cache_disk_mb: int = 1024
+
+    # Token budget for the prompt, older chat history is summarized, truncated or dropped to fit into it
+    context_max_tokens: int = 8192
+    # Number of newest messages that are always sent in full (if they fit) rather than as their summary
+    context_recent_messages: int = 2
+    # Optional retrieval of relevant history. With an embedding model (e.g. a sentence-transformers model), prompts hold
+    #   the newest messages and the turns most similar to the new message, rather than as much history as fits.
+    #   Embeddings of the most recently used chats are kept in memory
+    embedding_model_path: str | None = None
+    retrieval_recent_messages: int = 6
+    retrieval_top_k: int = 4
+    retrieval_cached_chats: int = 1000
+
+    # Background summarization of long messages, summaries are used in place of old messages that don't fit the context
+    summarization_enabled: bool = True
+    summarization_min_characters: int = 2000
+    summarization_batch_size: int = 8
+    summarization_max_queued_messages: int = 10000
+    summarization_max_new_tokens: int = 256
+
+    # How often replies are saved while they are being generated, whichever of the two is reached first
+    message_checkpoint_interval_seconds: float = 2.0
+    message_checkpoint_characters: int = 2000
+    # Messages of at least this many characters are stored zlib compressed, with a dictionary trained on the messages
+    #   of the deployment (`python -m src.services.message_compression`). 0 stores all messages as plain text
+    message_compression_min_characters: int = 1000
+    # Messages of all requests are saved by a background writer, which commits everything queued within this many
+    #   seconds together, in batches of up to this many writes. 0 saves every write right away in its own transaction.
+    #   Writes that don't fit into the queue are saved right away as well
+    message_write_interval_seconds: float = 0.01
+    message_write_batch_size: int = 500
+    message_write_max_queued: int = 10000
+    # How long a reply keeps being generated once no client is streaming it anymore, so a dropped connection can
+    #   still resume it. After that the generation is cancelled and the partial reply is saved as aborted
+    generation_disconnect_grace_seconds: float = 30.0
+    # Text of streamed replies is sent in chunks of up to this many seconds or characters, whichever is reached first,
+    #   rather than one write per token. 0 seconds sends text as soon as it is generated
+    stream_coalesce_seconds: float = 0.05
+    stream_coalesce_characters: int = 1024
+
+    # Rows fetched from the database per round trip when exporting chats, and rows inserted per statement when
+    #   importing them. Memory use of both only depends on these, not on the size of the history
+    chat_export_batch_size: int = 1000
+    chat_import_batch_size: int = 1000
+
     jwt_sign_secret: str = generate_random_jwt_secret()
+    # Argon2 cost of password and refresh token hashes, higher is harder to crack but slower to log in
+    password_hash_time_cost: int = 3
+    password_hash_memory_cost_kib: int = 65536
+    password_hash_parallelism: int = 4
+    # Hashes computed at once, and how many more may wait before logins are rejected
+    password_hashing_workers: int = 2
+    password_hashing_max_queued: int = 16
+
+    # Number of verified access tokens to remember, so they are not verified again on every request. 0 disables
+    auth_token_cache_size: int = 10000
 
     json_logs: bool = False
@@ -1,30 +1,152 @@
 import datetime
 import uuid
+from enum import StrEnum
 
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import (
+    ColumnElement,
+    Computed,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    SmallInteger,
+    String,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column
 
 from src.data_models.base import CoderChatBaseModel, generate_current_date
 
+# Text search configuration (language) the chats and messages are indexed with for the full-text search
+SEARCH_CONFIGURATION = "english"
+
+
+def _search_vector(column: str) -> Mapped[str]:
+    # Kept up to date by the database on every insert and update. Only used to filter and rank in queries, so it is
+    #   neither loaded with the entity nor fetched back after inserts (see `eager_defaults` of the models)
+    return mapped_column(
+        TSVECTOR,
+        Computed(f"to_tsvector('{SEARCH_CONFIGURATION}', {column})", persisted=True),
+        deferred=True,
+    )
+
+
+def message_search_vector(content) -> ColumnElement:
+    """
+    Search vector of the text of a message, see `ChatMessage.search_vector`
+    """
+    return func.to_tsvector(SEARCH_CONFIGURATION, content)
+
 
 class Chat(CoderChatBaseModel):
     __tablename__ = "chat"
+    __table_args__ = (
+        Index("ix_chat_user_id_create_date", "user_id", "create_date"),
+        Index("ix_chat_search_vector", "search_vector", postgresql_using="gin"),
+    )
+    __mapper_args__ = {"eager_defaults": False}
 
     name: Mapped[str] = mapped_column(nullable=False)
     language: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    # Name of the model replies are generated with, None for the default model
+    model: Mapped[str | None] = mapped_column(String(100), nullable=True)
     user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("user.id"), nullable=False)
     create_date: Mapped[datetime.datetime] = mapped_column(
         nullable=False, default=generate_current_date
     )
+    search_vector: Mapped[str] = _search_vector("name")
+
+
+class ChatMessageStatus(StrEnum):
+    # The reply is still being generated, `content` holds the last checkpoint
+    STREAMING = "streaming"
+    COMPLETE = "complete"
+    # Generation stopped before the reply was finished, `content` holds everything generated until then
+    ABORTED = "aborted"
 
 
 class ChatMessage(CoderChatBaseModel):
     __tablename__ = "chat_message"
+    __table_args__ = (
+        Index("ix_chat_message_chat_id_create_date", "chat_id", "create_date"),
+        Index("ix_chat_message_search_vector", "search_vector", postgresql_using="gin"),
+        Index(
+            "ix_chat_message_streaming_checkpoint_date",
+            "checkpoint_date",
+            postgresql_where=text(f"status = '{ChatMessageStatus.STREAMING}'"),
+        ),
+    )
+    __mapper_args__ = {"eager_defaults": False}
 
     chat_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("chat.id"), nullable=False)
-    content: Mapped[str] = mapped_column(nullable=False)
+    # Text of the message, None if it is stored in `compressed_content` instead. Read it through `content`
+    plain_content: Mapped[str | None] = mapped_column("content", nullable=True)
+    compressed_content: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    # Length of the text in characters, as it can't be read from compressed content in queries
+    content_length: Mapped[int] = mapped_column(nullable=False)
     summary: Mapped[str | None] = mapped_column(nullable=True)
     from_user: Mapped[bool]
+    status: Mapped[str] = mapped_column(
+        String(20), nullable=False, default=ChatMessageStatus.COMPLETE
+    )
+    create_date: Mapped[datetime.datetime] = mapped_column(
+        nullable=False, default=generate_current_date
+    )
+    # When a streaming reply was last saved by the process generating it. Replies that go without a checkpoint for too
+    #   long were left behind by a process that stopped, see `abort_abandoned_replies`
+    checkpoint_date: Mapped[datetime.datetime | None] = mapped_column(nullable=True)
+    # Saved together with the content (see `content`), the database can't compute it from compressed content
+    search_vector: Mapped[str] = mapped_column(TSVECTOR, nullable=False, deferred=True)
+    # float16 embedding of the content for retrieving relevant history, None until the message is embedded
+    embedding: Mapped[bytes | None] = mapped_column(
+        LargeBinary, nullable=True, deferred=True
+    )
+
+    # (compressed content, its text) of the last decompression, not mapped
+    _decompressed = None
+
+    @property
+    def content(self) -> str:
+        if self.plain_content is not None:
+            return self.plain_content
+
+        # Decompressed on the first read, once per loaded content
+        compressed_content = self.compressed_content
+        if (
+            self._decompressed is None
+            or self._decompressed[0] is not compressed_content
+        ):
+            from src.services.message_compression import decompress_content
+
+            self._decompressed = (
+                compressed_content,
+                decompress_content(compressed_content),
+            )
+        return self._decompressed[1]
+
+    @content.setter
+    def content(self, content: str):
+        from src.services.message_compression import message_content_values
+
+        for key, value in message_content_values(content).items():
+            setattr(self, key, value)
+        self.search_vector = message_search_vector(content)
+
+
+class MessageCompressionDictionary(CoderChatBaseModel):
+    """
+    A zlib dictionary trained on the messages of this deployment, see `src.services.message_compression`. Compressed
+        messages start with the version of the dictionary they were compressed with, so dictionaries are never changed
+        or deleted once they are used.
+    """
+
+    __tablename__ = "message_compression_dictionary"
+
+    version: Mapped[int] = mapped_column(SmallInteger, nullable=False, unique=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Number of messages it was trained on
+    sample_messages: Mapped[int] = mapped_column(nullable=False)
     create_date: Mapped[datetime.datetime] = mapped_column(
         nullable=False, default=generate_current_date
     )
@@ -1,30 +1,151 @@
+import threading
+import time
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, NamedTuple
 
-from alembic import command
-from alembic.config import Config
 from fastapi import Depends
-from sqlalchemy import create_engine, URL
+from sqlalchemy import create_engine, URL, Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 
 from src.config import CONFIG
 from src.logs import get_logger
+from src.metrics import DATABASE_SESSION_DURATION
 from src.util.database_utils import create_database_connection_url
 
 logger = get_logger(__name__)
 
 
+class PoolStatistics(NamedTuple):
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    timeouts: int
+    total_wait_seconds: float
+    max_wait_seconds: float
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that keeps track of how long callers had to wait to check out a connection, so the pool can be sized
+        based on real numbers instead of guesses.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self._checkouts += 1
+            self._total_wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+
+        return connection
+
+    def statistics(self) -> PoolStatistics:
+        with self._stats_lock:
+            return PoolStatistics(
+                size=self.size(),
+                checked_in=self.checkedin(),
+                checked_out=self.checkedout(),
+                overflow=max(self.overflow(), 0),
+                checkouts=self._checkouts,
+                timeouts=self._timeouts,
+                total_wait_seconds=self._total_wait_seconds,
+                max_wait_seconds=self._max_wait_seconds,
+            )
+
+
+_DATABASE_ENGINE: Engine | None = None
+
+
+def initialize_database_engine(db_url: URL = None) -> Engine:
+    """
+    Creates the process wide database engine (and its connection pool). Should be called once at startup, every
+        request then checks connections out of the same pool instead of opening a new one.
+
+    :param db_url: The database to connect to, defaults to the configured database
+    :return: The created engine
+    """
+    global _DATABASE_ENGINE
+
+    if db_url is None:
+        db_url = create_database_connection_url(CONFIG.db)
+
+    _DATABASE_ENGINE = create_engine(
+        db_url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=CONFIG.db_pool_size,
+        max_overflow=CONFIG.db_pool_max_overflow,
+        pool_timeout=CONFIG.db_pool_timeout_seconds,
+        pool_pre_ping=CONFIG.db_pool_pre_ping,
+        pool_recycle=CONFIG.db_pool_recycle_seconds,
+    )
+    logger.info(
+        "Created database engine with pool size %s and max overflow %s",
+        CONFIG.db_pool_size,
+        CONFIG.db_pool_max_overflow,
+    )
+
+    return _DATABASE_ENGINE
+
+
+def dispose_database_engine():
+    global _DATABASE_ENGINE
+
+    if _DATABASE_ENGINE is not None:
+        _DATABASE_ENGINE.dispose()
+        _DATABASE_ENGINE = None
+
+
+def get_database_engine() -> Engine:
+    if _DATABASE_ENGINE is None:
+        raise ValueError("Database engine must be initialized before creating sessions")
+
+    return _DATABASE_ENGINE
+
+
+def get_database_pool_statistics() -> PoolStatistics | None:
+    if _DATABASE_ENGINE is None:
+        return None
+
+    return _DATABASE_ENGINE.pool.statistics()
+
+
 def get_database_session():
-    db_url = create_database_connection_url(CONFIG.db)
-    engine = create_engine(db_url)
-    with Session(engine) as session:
-        yield session
+    start = time.perf_counter()
+    try:
+        with Session(get_database_engine()) as session:
+            yield session
+    finally:
+        DATABASE_SESSION_DURATION.observe(time.perf_counter() - start)
 
 
 DatabaseSessionDepend = Annotated[Session, Depends(get_database_session)]
 
 
 def run_database_migrations(db_url: URL = None):
+    # Only needed once at startup, importing alembic is deferred to keep importing the app fast
+    from alembic import command
+    from alembic.config import Config
+
     try:
         logger.info("Starting database migrations")
         if db_url is None:
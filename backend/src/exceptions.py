@@ -16,3 +16,15 @@ class UserLockedError(Exception):
 
 class EntityNotFoundError(Exception):
     pass
+
+
+class GenerationQueueFullError(Exception):
+    pass
+
+
+class GenerationInOtherWorkerError(Exception):
+    pass
+
+
+class PasswordHashingBusyError(Exception):
+    pass
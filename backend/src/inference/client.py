@@ -0,0 +1,331 @@
+import itertools
+import threading
+import time
+from multiprocessing.connection import Client, Connection
+from typing import TYPE_CHECKING, Any, Hashable
+
+from src.exceptions import GenerationQueueFullError, ValidationError
+from src.inference.generation import (
+    GenerationPriority,
+    GenerationStream,
+    SamplingParameters,
+    SchedulerStatistics,
+)
+from src.logs import get_logger
+
+if TYPE_CHECKING:
+    import torch
+
+logger = get_logger(__name__)
+
+# Errors raised in the inference server that are raised as the same type in the web worker, anything else is raised
+#   as a RuntimeError
+REMOTE_ERRORS: dict[str, type[Exception]] = {
+    error.__name__: error
+    for error in (GenerationQueueFullError, ValidationError, ValueError)
+}
+
+# How long to wait between attempts to connect to an inference server that is not up yet
+CONNECT_RETRY_SECONDS = 0.5
+# How long to wait for the inference server to acknowledge closing the connection
+CLOSE_TIMEOUT_SECONDS = 5
+
+
+class _PendingCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Exception | None = None
+
+
+class _RemoteGenerationStream(GenerationStream):
+    def __init__(self, client: "InferenceClient", prompt_tokens: int):
+        super().__init__(prompt_tokens)
+        self._client = client
+        self.call_id: int | None = None
+
+    def cancel(self):
+        super().cancel()
+        if self.call_id is not None:
+            try:
+                self._client._send(("cancel", self.call_id))
+            except OSError:
+                # without a connection, the server has already cancelled the generation
+                pass
+
+
+class InferenceClient:
+    """
+    Connection of a web worker to the inference server (see `src.inference.server`), which runs the models for all
+        web workers of the host.
+
+    Calls and generation streams of all threads share the single connection, every message carries the id of the
+        call it belongs to. A reader thread hands results and generated text to the waiting calls and streams, so a
+        slow consumer of one stream never holds up the others.
+    """
+
+    def __init__(self, socket_path: str, connect_timeout_seconds: float = 60):
+        self.socket_path = socket_path
+
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._call_ids = itertools.count()
+        self._pending: dict[int, _PendingCall] = {}
+        self._streams: dict[int, _RemoteGenerationStream] = {}
+
+        self._closing = False
+        self._connection: Connection | None = None
+        self._reader: threading.Thread | None = None
+        with self._send_lock:
+            self._connect(connect_timeout_seconds)
+
+    def _connect(self, timeout_seconds: float):
+        # Must be called with the send lock held
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            try:
+                connection = Client(self.socket_path, family="AF_UNIX")
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(CONNECT_RETRY_SECONDS)
+
+        self._connection = connection
+        self._reader = threading.Thread(
+            target=self._read, args=(connection,), name="inference-client", daemon=True
+        )
+        self._reader.start()
+
+    def call(self, method: str, *args):
+        """
+        Calls a method of the inference server and waits for its result
+
+        :raises GenerationQueueFullError, ValidationError: As raised by the inference server
+        """
+        pending = _PendingCall()
+        call_id = next(self._call_ids)
+        with self._lock:
+            self._pending[call_id] = pending
+
+        self._send_call(call_id, ("call", call_id, method, args))
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def cancel_session(self, session_id: Hashable) -> int:
+        """
+        Cancels the generations of the session of all web workers, see `InferenceServer.cancel_session`
+
+        :return: Number of generations that were cancelled
+        """
+        return self.call("cancel_session", session_id)
+
+    def notify(self, method: str, *args):
+        """
+        Calls a method of the inference server without waiting for it, nor finding out whether it succeeded. Safe to
+            call from the event loop
+        """
+        try:
+            self._send(("notify", None, method, args))
+        except OSError:
+            logger.exception(f"Could not notify the inference server of {method}")
+
+    def submit(
+        self,
+        model_name: str,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+        priority: GenerationPriority,
+        sampling: SamplingParameters | None,
+        session_id: Hashable | None,
+    ) -> GenerationStream:
+        stream = _RemoteGenerationStream(self, prompt_tokens=len(prompt_ids))
+
+        # The stream is registered before the request is sent, the first text can arrive right after it is queued
+        pending = _PendingCall()
+        call_id = next(self._call_ids)
+        stream.call_id = call_id
+        with self._lock:
+            self._pending[call_id] = pending
+            self._streams[call_id] = stream
+
+        self._send_call(
+            call_id,
+            (
+                "submit",
+                call_id,
+                model_name,
+                list(prompt_ids),
+                max_new_tokens,
+                int(priority),
+                sampling,
+                session_id,
+            ),
+        )
+        pending.done.wait()
+
+        if pending.error is not None:
+            with self._lock:
+                self._streams.pop(call_id, None)
+            raise pending.error
+        return stream
+
+    def close(self):
+        """
+        Closes the connection, which makes the server cancel all generations of this worker
+        """
+        with self._send_lock:
+            self._closing = True
+            connection, reader = self._connection, self._reader
+            self._connection = None
+            if connection is not None:
+                # The server closes its end in return, which ends the reader thread
+                try:
+                    connection.send(("close", None))
+                except OSError:
+                    pass
+
+        if reader is not None:
+            reader.join(timeout=CLOSE_TIMEOUT_SECONDS)
+        if connection is not None:
+            connection.close()
+
+    def _send(self, message: tuple):
+        with self._send_lock:
+            if self._connection is None:
+                if self._closing:
+                    raise ConnectionError("Inference client is closed")
+                # The server went away (e.g. it was restarted), try once to get a new connection
+                self._connect(0)
+            self._connection.send(message)
+
+    def _send_call(self, call_id: int, message: tuple):
+        try:
+            self._send(message)
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(call_id, None)
+                self._streams.pop(call_id, None)
+            raise ConnectionError("Could not reach the inference server") from e
+
+    def _read(self, connection: Connection):
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            kind, call_id = message[0], message[1]
+            if kind == "text":
+                stream = self._streams.get(call_id)
+                if stream is not None:
+                    stream._push_text(message[2])
+            elif kind == "cancelled":
+                # Cancelled by another worker, its end follows
+                stream = self._streams.get(call_id)
+                if stream is not None:
+                    stream.cancelled = True
+            elif kind == "end":
+                with self._lock:
+                    stream = self._streams.pop(call_id, None)
+                if stream is not None:
+                    stream.generated_tokens = message[2]
+                    stream._finish()
+            elif kind == "failed":
+                with self._lock:
+                    stream = self._streams.pop(call_id, None)
+                if stream is not None:
+                    stream._fail(RuntimeError(message[2]))
+            else:
+                with self._lock:
+                    pending = self._pending.pop(call_id)
+                if kind == "result":
+                    pending.result = message[2]
+                else:
+                    pending.error = REMOTE_ERRORS.get(message[2], RuntimeError)(
+                        message[3]
+                    )
+                pending.done.set()
+
+        if not self._closing:
+            logger.error("Lost the connection to the inference server")
+        self._fail_all(ConnectionError("Connection to the inference server was lost"))
+
+        # Only reconnect once everything that used this connection has failed
+        with self._send_lock:
+            if self._connection is connection:
+                self._connection = None
+        connection.close()
+
+    def _fail_all(self, error: Exception):
+        with self._lock:
+            pending_calls = list(self._pending.values())
+            streams = list(self._streams.values())
+            self._pending.clear()
+            self._streams.clear()
+
+        for pending in pending_calls:
+            pending.error = error
+            pending.done.set()
+        for stream in streams:
+            stream._fail(error)
+
+
+class RemoteEmbeddingModel:
+    """
+    Stands in for the `EmbeddingModel` that runs in the inference server
+    """
+
+    def __init__(self, client: InferenceClient):
+        self._client = client
+        self.dimensions: int = client.call("embedding_dimensions")
+
+    def embed(self, texts: list[str]) -> "torch.Tensor":
+        import torch
+
+        # Sent as a numpy array, as torch tensors are pickled into shared memory that only works between related
+        #   processes
+        return torch.from_numpy(self._client.call("embed", list(texts)))
+
+
+class RemoteScheduler:
+    """
+    Stands in for the `GenerationScheduler` of a model that runs in the inference server
+    """
+
+    # The caches live in the inference server
+    session_cache = None
+    response_cache = None
+
+    def __init__(self, client: InferenceClient, model_name: str):
+        self._client = client
+        self.model_name = model_name
+
+    def submit(
+        self,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+        priority: GenerationPriority = GenerationPriority.INTERACTIVE,
+        sampling: SamplingParameters | None = None,
+        session_id: Hashable | None = None,
+    ) -> GenerationStream:
+        return self._client.submit(
+            self.model_name,
+            prompt_ids,
+            max_new_tokens,
+            priority,
+            sampling,
+            session_id,
+        )
+
+    def statistics(self) -> SchedulerStatistics | None:
+        """
+        :return: None if the model is not loaded (anymore)
+        """
+        return self._client.call("scheduler_statistics", self.model_name)
+
+    def stop(self):
+        pass
@@ -0,0 +1,124 @@
+import threading
+from uuid import UUID
+
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+# Embeddings are stored and indexed as float16, half the size of float32 with no noticeable loss for cosine similarity
+EMBEDDING_DTYPE = torch.float16
+
+
+def encode_embedding(vector: torch.Tensor) -> bytes:
+    return vector.to(EMBEDDING_DTYPE).cpu().numpy().tobytes()
+
+
+def decode_embedding(data: bytes) -> torch.Tensor:
+    return torch.frombuffer(bytearray(data), dtype=EMBEDDING_DTYPE)
+
+
+class EmbeddingModel:
+    """
+    Embeds texts into unit length vectors, by mean pooling the last hidden states of a transformer encoder (e.g. a
+        sentence-transformers model). Runs on the CPU, calls from several threads are serialized.
+    """
+
+    def __init__(self, path: str, max_tokens: int = 512, batch_size: int = 32):
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+
+        self._tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+        if self._tokenizer.pad_token is None:
+            self._tokenizer.pad_token = self._tokenizer.eos_token
+        self._model = AutoModel.from_pretrained(path, local_files_only=True).eval()
+        self._lock = threading.Lock()
+
+        self.dimensions = self._model.config.hidden_size
+
+    @torch.inference_mode()
+    def embed(self, texts: list[str]) -> torch.Tensor:
+        """
+        :return: One row per text, normalized to unit length
+        """
+        batches = []
+        with self._lock:
+            for start in range(0, len(texts), self.batch_size):
+                inputs = self._tokenizer(
+                    texts[start : start + self.batch_size],
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_tokens,
+                    return_tensors="pt",
+                )
+                hidden_states = self._model(**inputs).last_hidden_state
+
+                mask = inputs.attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+                pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(
+                    min=1
+                )
+                batches.append(torch.nn.functional.normalize(pooled.float(), dim=-1))
+
+        if not batches:
+            return torch.empty((0, self.dimensions))
+        return torch.cat(batches)
+
+
+class ChatEmbeddingIndex:
+    """
+    Embeddings of the messages of a single chat, in the order they were added, as rows of one preallocated matrix.
+        The capacity doubles when it is full, so adding a message is amortized constant time.
+    """
+
+    def __init__(self, dimensions: int, capacity: int = 16):
+        self.message_ids: list[UUID] = []
+        self.from_user: list[bool] = []
+        self._positions: dict[UUID, int] = {}
+        self._vectors = torch.empty((capacity, dimensions), dtype=EMBEDDING_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.message_ids)
+
+    def __contains__(self, message_id: UUID) -> bool:
+        return message_id in self._positions
+
+    def add(self, message_id: UUID, from_user: bool, vector: torch.Tensor):
+        size = len(self.message_ids)
+        if size == self._vectors.shape[0]:
+            grown = torch.empty(
+                (size * 2, self._vectors.shape[1]), dtype=EMBEDDING_DTYPE
+            )
+            grown[:size] = self._vectors
+            self._vectors = grown
+
+        self._vectors[size] = vector.to(EMBEDDING_DTYPE)
+        self._positions[message_id] = size
+        self.message_ids.append(message_id)
+        self.from_user.append(from_user)
+
+    def most_similar(
+        self, query: torch.Tensor, k: int, exclude: set[UUID]
+    ) -> list[int]:
+        """
+        :param query: Unit length embedding of the query
+        :return: Positions of up to k messages not in `exclude`, most similar first
+        """
+        size = len(self.message_ids)
+        if size == 0 or k <= 0:
+            return []
+
+        # All vectors have unit length, so the dot products are the cosine similarities
+        similarities = self._vectors[:size].float() @ query.float()
+        for message_id in exclude:
+            position = self._positions.get(message_id)
+            if position is not None:
+                similarities[position] = -torch.inf
+
+        candidates = min(k, size)
+        scores, positions = torch.topk(similarities, candidates)
+        return [
+            position
+            for score, position in zip(scores.tolist(), positions.tolist())
+            if score != -torch.inf
+        ]
+
+    def memory_bytes(self) -> int:
+        return self._vectors.numel() * self._vectors.element_size()
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import NamedTuple
+
+
+class GenerationPriority(IntEnum):
+    """
+    Lower values are admitted into the running batch first
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class SamplingParameters(NamedTuple):
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+
+    @classmethod
+    def from_generation_config(cls, generation_config) -> "SamplingParameters":
+        if generation_config is None or not generation_config.do_sample:
+            return cls(do_sample=False)
+
+        return cls(
+            do_sample=True,
+            temperature=generation_config.temperature or 1.0,
+            top_k=generation_config.top_k or 0,
+            top_p=generation_config.top_p or 1.0,
+        )
+
+
+class SchedulerStatistics(NamedTuple):
+    max_batch_size: int
+    max_queued_requests: int
+    active_requests: int
+    queued_requests: int
+    completed_requests: int
+    cancelled_requests: int
+    generated_tokens: int
+    decode_steps: int
+    speculative_steps: int
+    draft_tokens: int
+    accepted_draft_tokens: int
+    draft_acceptance_rate: float
+    # Tokens produced per forward pass of the main model while decoding speculatively, 1.0 means no speedup
+    tokens_per_speculative_step: float
+
+
+_STREAM_END = object()
+
+
+class GenerationStream:
+    """
+    Stream of the text generated for a single request, which can be consumed with either a regular or an async for loop.
+
+    The scheduler thread pushes decoded text into the stream as tokens are produced. Iterating blocks (or awaits)
+        until the next piece of text is available and stops once generation has finished. Async consumers are woken up
+        through their event loop, so they never tie up a thread while waiting for tokens.
+    """
+
+    def __init__(self, prompt_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.generated_tokens = 0
+        self.created_at = time.perf_counter()
+        self.cancelled = False
+
+        self._items: deque = deque()
+        self._condition = threading.Condition()
+        self._finished = False
+
+        # Only set once the stream is consumed from an event loop
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._ready: asyncio.Event | None = None
+
+    def cancel(self):
+        """
+        Asks the scheduler to stop generating for this stream. The stream ends normally with the text generated until
+            the scheduler notices, which is at the latest after its current step.
+        """
+        self.cancelled = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self._finished:
+            raise StopIteration
+
+        with self._condition:
+            while not self._items:
+                self._condition.wait()
+            item = self._items.popleft()
+
+        return self._unwrap(item, StopIteration)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self._finished:
+            raise StopAsyncIteration
+
+        with self._condition:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+                self._ready = asyncio.Event()
+
+        while True:
+            with self._condition:
+                if self._items:
+                    item = self._items.popleft()
+                    break
+                self._ready.clear()
+
+            await self._ready.wait()
+
+        return self._unwrap(item, StopAsyncIteration)
+
+    def _unwrap(self, item, stop_exception: type[Exception]) -> str:
+        if item is _STREAM_END:
+            self._finished = True
+            raise stop_exception
+
+        if isinstance(item, BaseException):
+            self._finished = True
+            raise item
+
+        return item
+
+    def _put(self, item):
+        with self._condition:
+            self._items.append(item)
+            self._condition.notify_all()
+            loop, ready = self._loop, self._ready
+
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # the consumer's event loop has already been closed, nobody is listening anymore
+                pass
+
+    def _push_text(self, text: str):
+        self._put(text)
+
+    def _finish(self):
+        self._put(_STREAM_END)
+
+    def _fail(self, error: BaseException):
+        self._put(error)
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import NamedTuple
+
+from src.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Rough bookkeeping overhead of a cached entry (key, list node, array header), on top of its tokens
+ENTRY_OVERHEAD_BYTES = 128
+
+
+class ResponseCacheStatistics(NamedTuple):
+    max_bytes: int
+    used_bytes: int
+    entries: int
+    max_disk_bytes: int
+    used_disk_bytes: int
+    disk_entries: int
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    reused_tokens: int
+
+
+def response_cache_key(
+    model_fingerprint: str, prompt_ids: list[int], max_new_tokens: int, sampling: tuple
+) -> str:
+    """
+    Key of a generation: the same model, prompt and parameters produce the same tokens under deterministic decoding
+
+    :param model_fingerprint: Identifies the weights of the model and how they are loaded (see `model_fingerprint`),
+        entries kept on disk outlive the process
+    :param prompt_ids: The token ids of the fully rendered prompt
+    :param max_new_tokens: The maximum number of tokens to generate
+    :param sampling: The sampling parameters
+    """
+    digest = hashlib.sha256()
+    digest.update(model_fingerprint.encode())
+    digest.update(repr((max_new_tokens, tuple(sampling))).encode())
+    digest.update(array("i", prompt_ids).tobytes())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Remembers the tokens generated for a prompt, so the exact same request can be answered without running the model.
+
+    Only valid for deterministic (greedy) decoding, which the scheduler checks before using it. Entries are kept in
+        memory up to `max_bytes`, least recently used first out. If a `directory` is given, entries evicted from
+        memory are written there instead of being dropped, up to `max_disk_bytes`, and moved back into memory on a hit.
+    """
+
+    def __init__(
+        self, max_bytes: int, directory: str | None = None, max_disk_bytes: int = 0
+    ):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes if directory is not None else 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, array] = OrderedDict()
+        self._used_bytes = 0
+        self._disk_entries: OrderedDict[str, int] = OrderedDict()
+        self._used_disk_bytes = 0
+
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._reused_tokens = 0
+
+        if self.directory is not None:
+            self._load_disk_index()
+
+    @staticmethod
+    def _size(token_ids: array) -> int:
+        return len(token_ids) * token_ids.itemsize + ENTRY_OVERHEAD_BYTES
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.tokens")
+
+    def _load_disk_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".tokens"):
+                stat = entry.stat()
+                files.append(
+                    (stat.st_mtime, entry.name[: -len(".tokens")], stat.st_size)
+                )
+
+        for _, key, size in sorted(files):
+            self._disk_entries[key] = size
+            self._used_disk_bytes += size
+
+        logger.info(
+            f"Found {len(self._disk_entries)} cached responses in {self.directory}"
+        )
+
+    def get(self, key: str) -> list[int] | None:
+        with self._lock:
+            token_ids = self._entries.get(key)
+            if token_ids is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                self._reused_tokens += len(token_ids)
+                return token_ids.tolist()
+
+            if key not in self._disk_entries:
+                self._misses += 1
+                return None
+
+            token_ids = self._read_from_disk(key)
+            if token_ids is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._disk_hits += 1
+            self._reused_tokens += len(token_ids)
+            self._store(key, token_ids)
+            return token_ids.tolist()
+
+    def put(self, key: str, token_ids: list[int]):
+        token_ids = array("i", token_ids)
+        if self._size(token_ids) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._store(key, token_ids)
+
+    def _store(self, key: str, token_ids: array):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._used_bytes -= self._size(previous)
+
+        size = self._size(token_ids)
+        while self._entries and self._used_bytes + size > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._used_bytes -= self._size(evicted)
+            self._evictions += 1
+            self._write_to_disk(evicted_key, evicted)
+
+        self._entries[key] = token_ids
+        self._used_bytes += size
+
+    def _read_from_disk(self, key: str) -> array | None:
+        self._used_disk_bytes -= self._disk_entries.pop(key)
+        token_ids = array("i")
+        try:
+            with open(self._path(key), "rb") as cache_file:
+                token_ids.frombytes(cache_file.read())
+            os.remove(self._path(key))
+        except (OSError, ValueError):
+            logger.warning(f"Could not read cached response {key}", exc_info=True)
+            return None
+
+        return token_ids
+
+    def _write_to_disk(self, key: str, token_ids: array):
+        if self.max_disk_bytes <= 0 or key in self._disk_entries:
+            return
+
+        size = len(token_ids) * token_ids.itemsize
+        if size > self.max_disk_bytes:
+            return
+
+        while self._disk_entries and self._used_disk_bytes + size > self.max_disk_bytes:
+            removed_key, removed_size = self._disk_entries.popitem(last=False)
+            self._used_disk_bytes -= removed_size
+            try:
+                os.remove(self._path(removed_key))
+            except OSError:
+                pass
+
+        try:
+            with open(self._path(key), "wb") as cache_file:
+                cache_file.write(token_ids.tobytes())
+        except OSError:
+            logger.warning(f"Could not write cached response {key}", exc_info=True)
+            return
+
+        self._disk_entries[key] = size
+        self._used_disk_bytes += size
+
+    def statistics(self) -> ResponseCacheStatistics:
+        with self._lock:
+            return ResponseCacheStatistics(
+                max_bytes=self.max_bytes,
+                used_bytes=self._used_bytes,
+                entries=len(self._entries),
+                max_disk_bytes=self.max_disk_bytes,
+                used_disk_bytes=self._used_disk_bytes,
+                disk_entries=len(self._disk_entries),
+                hits=self._hits,
+                disk_hits=self._disk_hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                reused_tokens=self._reused_tokens,
+            )
@@ -0,0 +1,729 @@
+import heapq
+import itertools
+import threading
+from typing import Any, Hashable
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from src.exceptions import GenerationQueueFullError
+from src.inference.generation import (
+    GenerationPriority,
+    GenerationStream,
+    SamplingParameters,
+    SchedulerStatistics,
+)
+from src.inference.response_cache import ResponseCache, response_cache_key
+from src.inference.session_cache import SessionCache
+from src.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class _IncrementalDecoder:
+    """
+    Decodes generated tokens into text one token at a time, without re-decoding the whole sequence on every token.
+
+    Only a small window of tokens is decoded each time, text is held back while the window ends in an incomplete
+        multibyte character.
+    """
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+        self._token_ids: list[int] = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def add_token(self, token_id: int) -> str:
+        self._token_ids.append(token_id)
+
+        prefix_text = self._tokenizer.decode(
+            self._token_ids[self._prefix_offset : self._read_offset],
+            skip_special_tokens=True,
+        )
+        new_text = self._tokenizer.decode(
+            self._token_ids[self._prefix_offset :], skip_special_tokens=True
+        )
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(self._token_ids)
+            return new_text[len(prefix_text) :]
+
+        return ""
+
+
+class _ScheduledRequest:
+    def __init__(
+        self,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+        sampling: SamplingParameters,
+        decoder: _IncrementalDecoder,
+        session_id: Hashable | None,
+    ):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.decoder = decoder
+        self.session_id = session_id
+        self.response_cache_key: str | None = None
+        self.stream = GenerationStream(prompt_tokens=len(prompt_ids))
+        self.generated_ids: list[int] = []
+
+        # Number of real (non padding) tokens in the KV cache for this request
+        self.position = 0
+        # Token that will be fed into the model on the next decode step
+        self.next_token: int | None = None
+
+        # KV cache of the draft model and the number of tokens in it, only used for speculative decoding
+        self.draft_cache: list[tuple[torch.Tensor, torch.Tensor]] | None = None
+        self.draft_position = 0
+        self.draft_tokens = 0
+        self.accepted_draft_tokens = 0
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    padding = length - tensor.shape[dim]
+    if padding == 0:
+        return tensor
+
+    # F.pad takes padding pairs starting from the last dimension
+    pad = [0, 0] * (tensor.dim() - dim - 1) + [padding, 0]
+    return F.pad(tensor, pad)
+
+
+def _sample_token(logits: torch.Tensor, sampling: SamplingParameters) -> int:
+    logits = logits.float() / max(sampling.temperature, 1e-5)
+
+    if sampling.top_k > 0:
+        top_k = min(sampling.top_k, logits.shape[-1])
+        kth_value = torch.topk(logits, top_k).values[-1]
+        logits = logits.masked_fill(logits < kth_value, float("-inf"))
+
+    if sampling.top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # remove tokens once the tokens before them already cover top_p, this always keeps the most likely token
+        remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > sampling.top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(
+            0, sorted_indices, sorted_logits
+        )
+
+    return int(torch.multinomial(logits.softmax(dim=-1), 1))
+
+
+class GenerationScheduler:
+    """
+    Runs generation for all requests against a single model with continuous batching.
+
+    A single scheduler thread owns the model. Every step it admits waiting requests into the running batch (up to
+        `max_batch_size`), prefills them, and then runs one decode step for the whole batch, fanning the new tokens out
+        to each request's stream. Finished requests leave the batch at the same token boundary, so new requests never
+        have to wait for the longest running generation to complete.
+
+    Requests of different lengths share the batch by left padding their KV caches, with the attention mask hiding the
+        padding and explicit position ids keeping every request's positions correct.
+
+    Requests submitted with a `session_id` keep their KV cache in the `session_cache` once they finish, the next
+        request for the same session then only prefills the part of its prompt that is not already cached.
+
+    With a `draft_model`, a request that has the model to itself and decodes greedily is decoded speculatively: the
+        draft model proposes `draft_tokens` tokens, which the main model verifies in a single forward pass. The output
+        is exactly what the main model generates on its own, but several tokens can be produced per forward pass.
+
+    With a `response_cache`, the tokens of finished greedy requests are remembered. An identical greedy request later
+        on is answered from the cache without ever entering the batch, streamed through the same incremental decoder.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        model,
+        max_batch_size: int = 8,
+        max_queued_requests: int = 64,
+        session_cache: SessionCache | None = None,
+        response_cache: ResponseCache | None = None,
+        default_sampling: SamplingParameters | None = None,
+        draft_model=None,
+        draft_tokens: int = 4,
+        model_fingerprint: str | None = None,
+    ):
+        self._tokenizer = tokenizer
+        self._model = model
+        # Part of the response cache keys, so cached replies are only used for the same weights and quantization
+        self.model_fingerprint = (
+            model_fingerprint
+            if model_fingerprint is not None
+            else getattr(model, "name_or_path", "")
+        )
+        self.max_batch_size = max_batch_size
+        self.max_queued_requests = max_queued_requests
+        self.session_cache = session_cache
+        self.response_cache = response_cache
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens
+
+        generation_config = getattr(model, "generation_config", None)
+        self.default_sampling = (
+            default_sampling
+            if default_sampling is not None
+            else SamplingParameters.from_generation_config(generation_config)
+        )
+        self._eos_token_ids = self._find_eos_token_ids(tokenizer, generation_config)
+
+        self._condition = threading.Condition()
+        self._waiting: list[tuple[int, int, _ScheduledRequest]] = []
+        self._sequence = itertools.count()
+        self._running = False
+        self._thread: threading.Thread | None = None
+        # Requests taken off the queue that are not in the batch yet, while their prompt is prefilled
+        self._admitting = 0
+
+        # batch state, only touched by the scheduler thread
+        self._active: list[_ScheduledRequest] = []
+        self._cache: list[tuple[torch.Tensor, torch.Tensor]] | None = None
+        self._attention_mask: torch.Tensor | None = None
+
+        self._completed_requests = 0
+        self._cancelled_requests = 0
+        self._generated_tokens = 0
+        self._decode_steps = 0
+        self._speculative_steps = 0
+        self._speculative_tokens = 0
+        self._draft_tokens = 0
+        self._accepted_draft_tokens = 0
+
+    @staticmethod
+    def _find_eos_token_ids(tokenizer, generation_config) -> set[int]:
+        eos_token_ids = set()
+
+        candidates: list[Any] = [getattr(tokenizer, "eos_token_id", None)]
+        if generation_config is not None:
+            candidates.append(generation_config.eos_token_id)
+
+        for candidate in candidates:
+            if isinstance(candidate, int):
+                eos_token_ids.add(candidate)
+            elif candidate is not None:
+                eos_token_ids.update(candidate)
+
+        return eos_token_ids
+
+    @property
+    def _device(self):
+        return self._model.device
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(
+            target=self._run, name="generation-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+        priority: GenerationPriority = GenerationPriority.INTERACTIVE,
+        sampling: SamplingParameters | None = None,
+        session_id: Hashable | None = None,
+    ) -> GenerationStream:
+        """
+        Queues a prompt for generation
+
+        :param prompt_ids: The token ids of the fully rendered prompt
+        :param max_new_tokens: The maximum number of tokens to generate
+        :param priority: Requests with a lower priority value are admitted into the batch first
+        :param sampling: How to pick the next token, defaults to the model's generation config
+        :param session_id: Reuse and keep the KV cache of this session (chat), if a session cache is configured
+        :return: Stream of the generated text
+        :raises GenerationQueueFullError: If `max_queued_requests` requests are already waiting
+        """
+        request = _ScheduledRequest(
+            prompt_ids=list(prompt_ids),
+            max_new_tokens=max_new_tokens,
+            sampling=sampling if sampling is not None else self.default_sampling,
+            decoder=_IncrementalDecoder(self._tokenizer),
+            session_id=session_id,
+        )
+
+        # Sampled generations differ every time, only greedy ones can be answered from the cache
+        if self.response_cache is not None and not request.sampling.do_sample:
+            key = response_cache_key(
+                self.model_fingerprint,
+                request.prompt_ids,
+                max_new_tokens,
+                request.sampling,
+            )
+            cached_ids = self.response_cache.get(key)
+            if cached_ids is not None:
+                self._replay(request, cached_ids)
+                return request.stream
+            request.response_cache_key = key
+
+        with self._condition:
+            if not self._running:
+                raise ValueError("Generation scheduler must be started before use")
+
+            if len(self._waiting) >= self.max_queued_requests:
+                raise GenerationQueueFullError(
+                    f"{len(self._waiting)} generation requests are already queued"
+                )
+
+            heapq.heappush(
+                self._waiting, (int(priority), next(self._sequence), request)
+            )
+            self._condition.notify()
+
+        return request.stream
+
+    def is_idle(self) -> bool:
+        """
+        Whether no request is queued or being generated, i.e. stopping the scheduler would not interrupt anything
+        """
+        with self._condition:
+            return not self._waiting and not self._active and self._admitting == 0
+
+    def statistics(self) -> SchedulerStatistics:
+        with self._condition:
+            return SchedulerStatistics(
+                max_batch_size=self.max_batch_size,
+                max_queued_requests=self.max_queued_requests,
+                active_requests=len(self._active),
+                queued_requests=len(self._waiting),
+                completed_requests=self._completed_requests,
+                cancelled_requests=self._cancelled_requests,
+                generated_tokens=self._generated_tokens,
+                decode_steps=self._decode_steps,
+                speculative_steps=self._speculative_steps,
+                draft_tokens=self._draft_tokens,
+                accepted_draft_tokens=self._accepted_draft_tokens,
+                draft_acceptance_rate=self._accepted_draft_tokens / self._draft_tokens
+                if self._draft_tokens
+                else 0.0,
+                tokens_per_speculative_step=self._speculative_tokens
+                / self._speculative_steps
+                if self._speculative_steps
+                else 0.0,
+            )
+
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                with self._condition:
+                    while self._running and not self._waiting and not self._active:
+                        self._condition.wait()
+
+                    if not self._running:
+                        break
+
+                    admitted = []
+                    cancelled = []
+                    while (
+                        self._waiting
+                        and len(self._active) + len(admitted) < self.max_batch_size
+                    ):
+                        request = heapq.heappop(self._waiting)[2]
+                        if request.stream.cancelled:
+                            cancelled.append(request)
+                        else:
+                            admitted.append(request)
+                    self._admitting = len(admitted)
+
+                # Requests cancelled while they were waiting never enter the batch
+                self._finish_requests(cancelled)
+
+                for request in admitted:
+                    try:
+                        self._prefill(request)
+                    except Exception as e:
+                        logger.exception("Exception occurred while calling LLM")
+                        self._remove_from_batch([request])
+                        request.stream._fail(e)
+
+                with self._condition:
+                    self._admitting = 0
+
+                self._finish_requests(
+                    [request for request in self._active if request.stream.cancelled]
+                )
+                if not self._active:
+                    continue
+
+                try:
+                    draft_tokens = self._speculative_draft_tokens()
+                    if draft_tokens > 0:
+                        self._speculative_step(draft_tokens)
+                    else:
+                        self._decode_step()
+                except Exception as e:
+                    logger.exception("Exception occurred while calling LLM")
+                    self._fail_active(e)
+
+        with self._condition:
+            waiting = [request for _, _, request in self._waiting]
+            self._waiting = []
+
+        error = RuntimeError("Generation scheduler was stopped")
+        for request in waiting:
+            request.stream._fail(error)
+        self._fail_active(error)
+
+    def _prefill(self, request: _ScheduledRequest):
+        reused, cache = 0, None
+        if self.session_cache is not None and request.session_id is not None:
+            reused, cache = self.session_cache.take(
+                request.session_id, request.prompt_ids
+            )
+
+        input_ids = torch.tensor([request.prompt_ids[reused:]], device=self._device)
+        outputs = self._model(
+            input_ids=input_ids,
+            past_key_values=DynamicCache.from_legacy_cache(cache)
+            if cache is not None
+            else DynamicCache(),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        request.position = len(request.prompt_ids)
+
+        self._merge_into_batch(request, outputs.past_key_values.to_legacy_cache())
+        tokens = self._select_next_tokens(outputs.logits[:, -1, :], [request])
+        self._finish_requests(self._accept_tokens([request], tokens))
+
+    def _decode_step(self):
+        input_ids = torch.tensor(
+            [[request.next_token] for request in self._active], device=self._device
+        )
+        position_ids = torch.tensor(
+            [[request.position] for request in self._active], device=self._device
+        )
+        attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((len(self._active), 1)),
+            ],
+            dim=1,
+        )
+
+        outputs = self._model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self._cache),
+            use_cache=True,
+        )
+        self._cache = list(outputs.past_key_values.to_legacy_cache())
+        self._attention_mask = attention_mask
+        self._decode_steps += 1
+
+        for request in self._active:
+            request.position += 1
+
+        tokens = self._select_next_tokens(outputs.logits[:, -1, :], self._active)
+        self._finish_requests(self._accept_tokens(self._active, tokens))
+
+    def _speculative_draft_tokens(self) -> int:
+        """
+        Number of tokens to draft for the next step, 0 if the next step should be a regular decode step
+        """
+        if self.draft_model is None or len(self._active) != 1 or self._waiting:
+            return 0
+
+        request = self._active[0]
+        if self._attention_mask.shape[1] != request.position:
+            # the cache still has padding left over from a shared batch
+            return 0
+
+        if request.sampling.do_sample:
+            # verifying sampled drafts needs rejection sampling, only greedy decoding is sped up
+            return 0
+
+        # the main model adds one token of its own to the accepted draft tokens
+        remaining = request.max_new_tokens - request.stream.generated_tokens
+        return max(min(self.draft_tokens, remaining - 1), 0)
+
+    def _speculative_step(self, draft_tokens: int):
+        request = self._active[0]
+        position = request.position
+        token_ids = request.prompt_ids + request.generated_ids
+
+        # Bring the draft model's cache up to the main model's, e.g. after the request shared the batch with others
+        if request.draft_cache is None or request.draft_position < position:
+            outputs = self.draft_model(
+                input_ids=torch.tensor(
+                    [token_ids[request.draft_position : position]], device=self._device
+                ),
+                past_key_values=DynamicCache.from_legacy_cache(request.draft_cache)
+                if request.draft_cache is not None
+                else DynamicCache(),
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            request.draft_cache = list(outputs.past_key_values.to_legacy_cache())
+            request.draft_position = position
+
+        draft = []
+        draft_input = request.next_token
+        for _ in range(draft_tokens):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([[draft_input]], device=self._device),
+                past_key_values=DynamicCache.from_legacy_cache(request.draft_cache),
+                use_cache=True,
+            )
+            request.draft_cache = list(outputs.past_key_values.to_legacy_cache())
+            draft_input = int(outputs.logits[0, -1].argmax())
+            draft.append(draft_input)
+        request.draft_position += draft_tokens
+
+        # The main model scores the next token and all drafted tokens at once. Its prediction after each of them
+        #   tells how many drafted tokens it would have generated itself, plus the token that follows those
+        outputs = self._model(
+            input_ids=torch.tensor([[request.next_token] + draft], device=self._device),
+            position_ids=torch.arange(
+                position, position + draft_tokens + 1, device=self._device
+            ).unsqueeze(0),
+            past_key_values=DynamicCache.from_legacy_cache(self._cache),
+            use_cache=True,
+        )
+        predictions = outputs.logits[0].argmax(dim=-1).tolist()
+
+        accepted = 0
+        while accepted < draft_tokens and draft[accepted] == predictions[accepted]:
+            accepted += 1
+        new_tokens = draft[:accepted] + [predictions[accepted]]
+
+        self._decode_steps += 1
+        self._speculative_steps += 1
+        self._speculative_tokens += len(new_tokens)
+        self._draft_tokens += draft_tokens
+        self._accepted_draft_tokens += accepted
+        request.draft_tokens += draft_tokens
+        request.accepted_draft_tokens += accepted
+
+        finished = []
+        emitted = 0
+        for token in new_tokens:
+            emitted += 1
+            finished = self._accept_tokens([request], [token])
+            if finished:
+                break
+
+        # Only the next token and the accepted draft tokens are valid in the caches, cut off the rest. The last
+        #   emitted token becomes the next token, which is never in the cache yet
+        request.position = position + emitted
+        self._cache = [
+            (keys[:, :, : request.position], values[:, :, : request.position])
+            for keys, values in outputs.past_key_values.to_legacy_cache()
+        ]
+        self._attention_mask = self._attention_mask.new_ones((1, request.position))
+
+        request.draft_position = min(request.draft_position, request.position)
+        request.draft_cache = [
+            (
+                keys[:, :, : request.draft_position],
+                values[:, :, : request.draft_position],
+            )
+            for keys, values in request.draft_cache
+        ]
+
+        self._finish_requests(finished)
+
+    def _select_next_tokens(
+        self, logits: torch.Tensor, requests: list[_ScheduledRequest]
+    ) -> list[int]:
+        tokens = logits.argmax(dim=-1).tolist()
+
+        for index, request in enumerate(requests):
+            if request.sampling.do_sample:
+                tokens[index] = _sample_token(logits[index], request.sampling)
+
+        return tokens
+
+    def _accept_tokens(
+        self, requests: list[_ScheduledRequest], tokens: list[int]
+    ) -> list[_ScheduledRequest]:
+        """
+        Pushes the text of the newly generated tokens to their streams
+
+        :return: The requests that have finished generating
+        """
+        finished = []
+
+        for request, token in zip(requests, tokens):
+            request.next_token = token
+            request.generated_ids.append(token)
+            request.stream.generated_tokens += 1
+            self._generated_tokens += 1
+
+            if token in self._eos_token_ids:
+                finished.append(request)
+                continue
+
+            text = request.decoder.add_token(token)
+            if text:
+                request.stream._push_text(text)
+
+            if request.stream.generated_tokens >= request.max_new_tokens:
+                finished.append(request)
+
+        return finished
+
+    def _replay(self, request: _ScheduledRequest, token_ids: list[int]):
+        """
+        Streams previously generated tokens exactly like `_accept_tokens` would have while generating them
+        """
+        for token in token_ids:
+            request.stream.generated_tokens += 1
+            if token in self._eos_token_ids:
+                break
+
+            text = request.decoder.add_token(token)
+            if text:
+                request.stream._push_text(text)
+
+        request.stream._finish()
+
+    def _finish_requests(self, requests: list[_ScheduledRequest]):
+        if self.session_cache is not None:
+            for request in requests:
+                # requests cancelled before they were admitted have no cache to store
+                if request.session_id is not None and request in self._active:
+                    self._store_session(request)
+
+        if self.response_cache is not None:
+            for request in requests:
+                # a cancelled request has not generated its whole reply
+                if (
+                    request.response_cache_key is not None
+                    and not request.stream.cancelled
+                ):
+                    self.response_cache.put(
+                        request.response_cache_key, request.generated_ids
+                    )
+
+        self._remove_from_batch(requests)
+
+        # only end the streams once the session is stored, so a follow up message can already reuse it
+        for request in requests:
+            request.stream._finish()
+            if request.stream.cancelled:
+                self._cancelled_requests += 1
+            else:
+                self._completed_requests += 1
+
+            if request.draft_tokens:
+                logger.info(
+                    f"Speculative decoding accepted {request.accepted_draft_tokens} of {request.draft_tokens} draft "
+                    f"tokens ({request.accepted_draft_tokens / request.draft_tokens:.0%}), generated "
+                    f"{request.stream.generated_tokens} tokens"
+                )
+
+    def _store_session(self, request: _ScheduledRequest):
+        row = self._active.index(request)
+        # the batch is left padded, so the request's own tokens are the last `position` entries of its row. Copy them
+        #   out so the stored cache does not keep the whole batch's tensors alive
+        cache = [
+            (
+                keys[row : row + 1, :, -request.position :].clone(),
+                values[row : row + 1, :, -request.position :].clone(),
+            )
+            for keys, values in self._cache
+        ]
+        token_ids = (request.prompt_ids + request.generated_ids)[: request.position]
+
+        self.session_cache.put(request.session_id, token_ids, cache)
+
+    def _merge_into_batch(self, request: _ScheduledRequest, cache):
+        """
+        Adds the request and its prefilled KV cache to the running batch, left padding either side as needed so
+            all requests in the batch share the same cache length
+        """
+        attention_mask = torch.ones(
+            (1, cache[0][0].shape[2]), dtype=torch.long, device=self._device
+        )
+
+        if self._cache is None:
+            self._cache = list(cache)
+            self._attention_mask = attention_mask
+        else:
+            length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+            self._cache = [
+                (
+                    torch.cat(
+                        [_left_pad(batch_keys, length, 2), _left_pad(keys, length, 2)]
+                    ),
+                    torch.cat(
+                        [
+                            _left_pad(batch_values, length, 2),
+                            _left_pad(values, length, 2),
+                        ]
+                    ),
+                )
+                for (batch_keys, batch_values), (keys, values) in zip(
+                    self._cache, cache
+                )
+            ]
+            self._attention_mask = torch.cat(
+                [
+                    _left_pad(self._attention_mask, length, 1),
+                    _left_pad(attention_mask, length, 1),
+                ]
+            )
+
+        self._active.append(request)
+
+    def _remove_from_batch(self, requests: list[_ScheduledRequest]):
+        removed = [request for request in requests if request in self._active]
+        if not removed:
+            return
+
+        keep = [
+            index
+            for index, request in enumerate(self._active)
+            if request not in removed
+        ]
+        self._active = [self._active[index] for index in keep]
+
+        if not keep:
+            self._cache = None
+            self._attention_mask = None
+            return
+
+        index = torch.tensor(keep, device=self._device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # drop the leading columns that are now padding for every remaining request
+        start = int(attention_mask.sum(dim=0).nonzero()[0])
+
+        self._attention_mask = attention_mask[:, start:]
+        self._cache = [
+            (
+                keys.index_select(0, index)[:, :, start:],
+                values.index_select(0, index)[:, :, start:],
+            )
+            for keys, values in self._cache
+        ]
+
+    def _fail_active(self, error: BaseException):
+        for request in self._active:
+            request.stream._fail(error)
+
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
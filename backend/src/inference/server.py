@@ -0,0 +1,343 @@
+import os
+import signal
+import sys
+import threading
+from multiprocessing.connection import Connection, Listener
+from typing import TYPE_CHECKING, Callable, Hashable
+
+from src import ai_models
+from src.config import CONFIG
+from src.database import dispose_database_engine, initialize_database_engine
+from src.inference.generation import GenerationPriority, GenerationStream
+from src.logs import configure_logging, get_logger
+from src.services import summarization
+
+if TYPE_CHECKING:
+    from src.inference.embedding import EmbeddingModel
+
+logger = get_logger(__name__)
+
+
+class _WorkerConnection:
+    """
+    Serves the calls and generation requests of a single web worker
+    """
+
+    def __init__(
+        self,
+        connection: Connection,
+        registry: ai_models.ModelRegistry,
+        embedding_model: "EmbeddingModel | None",
+        cancel_session: Callable[[Hashable], int],
+    ):
+        self._connection = connection
+        self._registry = registry
+        self._embedding_model = embedding_model
+        self._cancel_session = cancel_session
+
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._streams: dict[int, GenerationStream] = {}
+        # Call id -> session id of the generations that have one
+        self._stream_sessions: dict[int, Hashable] = {}
+        # Generations cancelled before they were queued, e.g. while their model was loading
+        self._cancelled: set[int] = set()
+        self._closed = False
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    message = self._connection.recv()
+                except (EOFError, OSError):
+                    break
+
+                kind = message[0]
+                if kind == "close":
+                    break
+                elif kind == "cancel":
+                    with self._lock:
+                        stream = self._streams.get(message[1])
+                        if stream is None:
+                            self._cancelled.add(message[1])
+                    if stream is not None:
+                        stream.cancel()
+                elif kind == "notify":
+                    self._notify(*message[2:])
+                elif kind == "call" and message[2] == "embed":
+                    # Embedding long chats takes a while, other calls and cancels of the worker are served meanwhile
+                    threading.Thread(
+                        target=self._call,
+                        args=message[1:],
+                        name=f"inference-embedding-{message[1]}",
+                        daemon=True,
+                    ).start()
+                elif kind == "submit":
+                    # Loading the model can take a while, calls of the worker are served in the meantime
+                    threading.Thread(
+                        target=self._run_generation,
+                        args=message[1:],
+                        name=f"inference-generation-{message[1]}",
+                        daemon=True,
+                    ).start()
+                else:
+                    self._call(*message[1:])
+        finally:
+            # Nobody is left to read the results of this worker's generations
+            with self._lock:
+                self._closed = True
+                streams = list(self._streams.values())
+            for stream in streams:
+                stream.cancel()
+
+            self._connection.close()
+
+    def _send(self, message: tuple):
+        with self._send_lock:
+            try:
+                self._connection.send(message)
+            except OSError:
+                # the worker went away, its generations are cancelled once the connection is closed
+                pass
+
+    def _send_error(self, call_id: int, error: Exception):
+        self._send(("error", call_id, type(error).__name__, str(error)))
+
+    def _call(self, call_id: int, method: str, args: tuple):
+        try:
+            if method == "models":
+                result = self._registry.models()
+            elif method == "loaded_models":
+                result = [name for name, _ in self._registry.loaded_models()]
+            elif method == "registry_statistics":
+                result = self._registry.statistics()
+            elif method == "summarization_statistics":
+                result = (
+                    summarization.SUMMARIZATION_WORKER.statistics()
+                    if summarization.SUMMARIZATION_WORKER is not None
+                    else None
+                )
+            elif method == "cancel_session":
+                result = self._cancel_session(args[0])
+            elif method == "embedding_dimensions":
+                result = self._get_embedding_model().dimensions
+            elif method == "embed":
+                result = self._get_embedding_model().embed(args[0]).numpy()
+            elif method == "scheduler_statistics":
+                # Never loads the model, None if it was unloaded since the worker listed the loaded models
+                ai_model = dict(self._registry.loaded_models()).get(args[0])
+                result = (
+                    ai_model.scheduler.statistics() if ai_model is not None else None
+                )
+            else:
+                raise ValueError(f"Unknown method {method}")
+        except Exception as e:
+            self._send_error(call_id, e)
+            return
+
+        self._send(("result", call_id, result))
+
+    def cancel_session_generations(self, session_id: Hashable) -> int:
+        """
+        Cancels the generations of this worker that belong to the session. The worker is told before their streams
+            end, so it saves them as cancelled rather than as finished
+
+        :return: Number of generations that were cancelled
+        """
+        with self._lock:
+            streams = [
+                (call_id, stream)
+                for call_id, stream in self._streams.items()
+                if self._stream_sessions.get(call_id) == session_id
+                and not stream.cancelled
+            ]
+        for call_id, stream in streams:
+            self._send(("cancelled", call_id))
+            stream.cancel()
+        return len(streams)
+
+    def _get_embedding_model(self) -> "EmbeddingModel":
+        if self._embedding_model is None:
+            raise ValueError("The inference server has no embedding model")
+        return self._embedding_model
+
+    def _notify(self, method: str, args: tuple):
+        # Nobody waits for the result, failures are only logged
+        try:
+            if method == "summarize":
+                # The web worker only forwards messages that are long enough
+                if summarization.SUMMARIZATION_WORKER is not None:
+                    summarization.SUMMARIZATION_WORKER.enqueue(*args)
+            else:
+                raise ValueError(f"Unknown method {method}")
+        except Exception:
+            logger.exception(f"Failed to handle {method} of a web worker")
+
+    def _run_generation(
+        self,
+        call_id: int,
+        model_name: str,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+        priority: int,
+        sampling,
+        session_id,
+    ):
+        try:
+            with self._registry.use(model_name) as ai_model:
+                stream = ai_model.scheduler.submit(
+                    prompt_ids,
+                    max_new_tokens=max_new_tokens,
+                    priority=GenerationPriority(priority),
+                    sampling=sampling,
+                    session_id=session_id,
+                )
+        except Exception as e:
+            self._send_error(call_id, e)
+            return
+
+        with self._lock:
+            self._streams[call_id] = stream
+            if session_id is not None:
+                self._stream_sessions[call_id] = session_id
+            cancelled = self._closed or call_id in self._cancelled
+            self._cancelled.discard(call_id)
+        if cancelled:
+            stream.cancel()
+        self._send(("result", call_id, None))
+
+        try:
+            for text in stream:
+                self._send(("text", call_id, text))
+        except Exception as e:
+            self._send(("failed", call_id, str(e)))
+        else:
+            self._send(("end", call_id, stream.generated_tokens))
+        finally:
+            with self._lock:
+                self._streams.pop(call_id, None)
+                self._stream_sessions.pop(call_id, None)
+
+
+class InferenceServer:
+    """
+    Runs the models for all web workers of a host, so they are loaded only once. The embedding model for retrieval and
+        the summarization of messages run here as well.
+
+    Web workers connect over the Unix socket at `socket_path` (see `InferenceClient`). Every connection is served by
+        its own thread, and every generation by a thread that forwards its text to the worker as it is generated.
+        Requests of all workers share the models' schedulers, so they are batched together. Generations are cancelled
+        when the worker asks for it or goes away, or when any worker cancels their session (the replies of a chat).
+    """
+
+    def __init__(
+        self,
+        registry: ai_models.ModelRegistry,
+        socket_path: str,
+        embedding_model: "EmbeddingModel | None" = None,
+    ):
+        self._registry = registry
+        self.socket_path = socket_path
+        self._embedding_model = embedding_model
+        self._listener: Listener | None = None
+        self._connections_lock = threading.Lock()
+        self._connections: set[_WorkerConnection] = set()
+
+    def serve_forever(self):
+        # A socket left behind by a previous server that did not shut down cleanly would block binding
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._listener = Listener(self.socket_path, family="AF_UNIX")
+        os.chmod(self.socket_path, 0o660)
+        logger.info(f"Inference server listening on {self.socket_path}")
+
+        while True:
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                # the listener was closed
+                break
+
+            worker_connection = _WorkerConnection(
+                connection, self._registry, self._embedding_model, self.cancel_session
+            )
+            with self._connections_lock:
+                self._connections.add(worker_connection)
+            threading.Thread(
+                target=self._serve_worker,
+                args=(worker_connection,),
+                name="inference-worker",
+                daemon=True,
+            ).start()
+
+    def _serve_worker(self, worker_connection: _WorkerConnection):
+        try:
+            worker_connection.run()
+        finally:
+            with self._connections_lock:
+                self._connections.discard(worker_connection)
+
+    def cancel_session(self, session_id: Hashable) -> int:
+        """
+        Cancels the generations of the session, whichever worker they belong to
+
+        :return: Number of generations that were cancelled
+        """
+        with self._connections_lock:
+            connections = list(self._connections)
+        return sum(
+            connection.cancel_session_generations(session_id)
+            for connection in connections
+        )
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+
+def main():
+    configure_logging()
+
+    if CONFIG.inference_socket is None:
+        logger.error("CC_INFERENCE_SOCKET must be set to run the inference server")
+        sys.exit(1)
+
+    ai_models.initialize_local_models()
+    embedding_model = None
+    if CONFIG.embedding_model_path is not None:
+        from src.inference.embedding import EmbeddingModel
+
+        embedding_model = EmbeddingModel(CONFIG.embedding_model_path)
+        logger.info(f"Loaded embedding model {CONFIG.embedding_model_path}")
+
+    # Summaries of the messages of all web workers are generated here, once, rather than by every web worker
+    initialize_database_engine()
+    try:
+        summarization.initialize_summarization_worker()
+    except Exception:
+        # e.g. the web workers have not migrated the database yet. New messages are still summarized
+        logger.exception("Failed to queue existing messages for summarization")
+
+    server = InferenceServer(
+        ai_models.get_model_registry(), CONFIG.inference_socket, embedding_model
+    )
+
+    def stop(*_):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+        summarization.shutdown_summarization_worker()
+        ai_models.shutdown_models()
+        dispose_database_engine()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, NamedTuple
+
+import torch
+
+
+class SessionCacheStatistics(NamedTuple):
+    max_bytes: int
+    used_bytes: int
+    sessions: int
+    hits: int
+    misses: int
+    evictions: int
+    reused_tokens: int
+
+
+class _CachedSession(NamedTuple):
+    token_ids: list[int]
+    cache: list[tuple[torch.Tensor, torch.Tensor]]
+    size_bytes: int
+
+
+def _common_prefix_length(first: list[int], second: list[int]) -> int:
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+
+    return length
+
+
+class SessionCache:
+    """
+    Keeps the KV cache of the last turn of each chat, so the next turn only has to prefill the tokens that changed.
+
+    Entries are matched on the longest common token prefix with the new prompt, so a cache is only ever reused for
+        exactly the tokens it was computed from. Least recently used sessions are evicted once the cached tensors
+        exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._sessions: OrderedDict[Hashable, _CachedSession] = OrderedDict()
+        self._used_bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._reused_tokens = 0
+
+    def take(
+        self, session_id: Hashable, prompt_ids: list[int]
+    ) -> tuple[int, list[tuple[torch.Tensor, torch.Tensor]] | None]:
+        """
+        Removes the cache of the given session, cropped to the part that can be reused for the given prompt.
+            The caller owns the cache until it is handed back with `put`.
+
+        :param session_id: The session (chat) to look up
+        :param prompt_ids: The token ids of the new prompt
+        :return: The number of prompt tokens covered by the cache, and the cache itself (None on a miss)
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._used_bytes -= session.size_bytes
+
+            # Always leave at least one prompt token to run through the model, to get the logits for the first token
+            reused = 0
+            if session is not None:
+                reused = min(
+                    _common_prefix_length(session.token_ids, prompt_ids),
+                    len(prompt_ids) - 1,
+                )
+
+            if reused <= 0:
+                self._misses += 1
+                return 0, None
+
+            self._hits += 1
+            self._reused_tokens += reused
+
+        return reused, [
+            (keys[:, :, :reused], values[:, :, :reused])
+            for keys, values in session.cache
+        ]
+
+    def put(
+        self,
+        session_id: Hashable,
+        token_ids: list[int],
+        cache: list[tuple[torch.Tensor, torch.Tensor]],
+    ):
+        """
+        Stores the cache for the given session, replacing any previous entry
+
+        :param session_id: The session (chat) the cache belongs to
+        :param token_ids: The token ids the cache was computed from
+        :param cache: The per layer (keys, values) for a single sequence, without any padding
+        """
+        size_bytes = sum(
+            keys.numel() * keys.element_size() + values.numel() * values.element_size()
+            for keys, values in cache
+        )
+        if size_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self._used_bytes -= previous.size_bytes
+
+            while self._sessions and self._used_bytes + size_bytes > self.max_bytes:
+                _, evicted = self._sessions.popitem(last=False)
+                self._used_bytes -= evicted.size_bytes
+                self._evictions += 1
+
+            self._sessions[session_id] = _CachedSession(token_ids, cache, size_bytes)
+            self._used_bytes += size_bytes
+
+    def statistics(self) -> SessionCacheStatistics:
+        with self._lock:
+            return SessionCacheStatistics(
+                max_bytes=self.max_bytes,
+                used_bytes=self._used_bytes,
+                sessions=len(self._sessions),
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                reused_tokens=self._reused_tokens,
+            )
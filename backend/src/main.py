@@ -1,13 +1,37 @@
+import asyncio
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+import anyio
+from fastapi import Depends, FastAPI
 
-from src.ai_models import initialize_model
+from src.ai_models import initialize_model, shutdown_models
 from src.config import CONFIG
-from src.database import run_database_migrations
+from src.database import (
+    run_database_migrations,
+    initialize_database_engine,
+    dispose_database_engine,
+)
 from src.logs import configure_logging
 from src.router.chat import router as chat_router
+from src.router.system import router as system_router
 from src.router.user import router as user_router
+from src.services.chat_retrieval import initialize_retrieval, shutdown_retrieval
+from src.services.live_generation import (
+    start_abandoned_reply_sweep,
+    stop_abandoned_reply_sweep,
+    wait_for_live_generations,
+)
+from src.services.message_compression import load_compression_dictionaries
+from src.services.message_writer import (
+    initialize_message_writer,
+    shutdown_message_writer,
+)
+from src.services.summarization import (
+    initialize_summarization_worker,
+    shutdown_summarization_worker,
+)
+from src.util.http_metrics import HttpMetricsMiddleware
+from src.util.startup import STARTUP, verify_ready
 from src.util.static_files import ReactStaticFiles
 
 
@@ -15,11 +39,47 @@ from src.util.static_files import ReactStaticFiles
 configure_logging()
 
 
+async def _prepare_database():
+    await STARTUP.run_step("migrations", run_database_migrations)
+    await STARTUP.run_step("database", initialize_database_engine)
+    await STARTUP.run_step("compression", load_compression_dictionaries)
+    await STARTUP.run_step("message_writer", initialize_message_writer)
+    start_abandoned_reply_sweep()
+
+
+async def _start_up():
+    """
+    Runs the slow parts of the startup while the app already answers health checks. The database and the models
+        don't depend on each other, so they are prepared at the same time.
+    """
+    STARTUP.begin()
+    try:
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(_prepare_database)
+            task_group.start_soon(STARTUP.run_step, "models", initialize_model)
+            task_group.start_soon(STARTUP.run_step, "embeddings", initialize_retrieval)
+        await STARTUP.run_step("summarization", initialize_summarization_worker)
+    except Exception as e:
+        STARTUP.mark_failed(e)
+        return
+
+    STARTUP.mark_ready()
+
+
 @asynccontextmanager
 async def init_lifespan(_: FastAPI):
-    run_database_migrations()
-    initialize_model()
+    startup_task = asyncio.create_task(_start_up())
     yield
+    # Loading can't be interrupted, let it finish so everything it started is shut down below
+    await startup_task
+    await stop_abandoned_reply_sweep()
+    shutdown_summarization_worker()
+    shutdown_retrieval()
+    shutdown_models()
+    await wait_for_live_generations()
+    # Saves the writes that are still queued, which include the final state of the replies above
+    await anyio.to_thread.run_sync(shutdown_message_writer)
+    dispose_database_engine()
 
 
 def app_factory() -> FastAPI:
@@ -28,8 +88,11 @@ def app_factory() -> FastAPI:
     # Add our APIs
 
     api = FastAPI()
-    api.include_router(chat_router)
-    api.include_router(user_router)
+    api.add_middleware(HttpMetricsMiddleware)
+    # Both need the database and the models, the system router stays reachable to check on the startup
+    api.include_router(chat_router, dependencies=[Depends(verify_ready)])
+    api.include_router(user_router, dependencies=[Depends(verify_ready)])
+    api.include_router(system_router)
 
     # mount this before static, so that calls to /api are processed first / don't get caught up in the static handler
     _app.mount("/api", api)
@@ -0,0 +1,315 @@
+import math
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Iterable, NamedTuple
+
+# Buckets for request / generation latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: Iterable[str], label_values: Iterable[str]) -> str:
+    labels = ",".join(
+        f'{name}="{_escape_label_value(value)}"'
+        for name, value in zip(label_names, label_values)
+    )
+    return f"{{{labels}}}" if labels else ""
+
+
+class _Metric(ABC):
+    metric_type = ""
+
+    def __init__(
+        self, name: str, documentation: str, label_names: tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+
+        self._lock = threading.Lock()
+        self._children: dict[tuple[str, ...], object] = {}
+
+        REGISTRY.append(self)
+
+    def labels(self, *label_values: str):
+        """
+        Returns the metric for the given label values, in the order of `label_names`
+        """
+        label_values = tuple(str(value) for value in label_values)
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """
+        Creates the value of one combination of label values
+        """
+
+    def _default(self):
+        # Metrics without labels are used directly, without calling `labels()` first
+        return self.labels()
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        if not self.label_names:
+            # Metrics without labels are exported from the start, rather than only once they are first updated
+            self._default()
+
+        for label_values, child in list(self._children.items()):
+            lines.extend(self._render_child(label_values, child))
+        return lines
+
+    @abstractmethod
+    def _render_child(self, label_values: tuple[str, ...], child) -> list[str]:
+        """
+        Renders the sample lines of the value of one combination of label values
+        """
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def get(self) -> float:
+        return self._value
+
+
+class _ValueMetric(_Metric):
+    """
+    Metric with a single number per combination of label values
+    """
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, label_values: tuple[str, ...], child) -> list[str]:
+        labels = _format_labels(self.label_names, label_values)
+        return [f"{self.name}{labels} {_format_value(child.get())}"]
+
+
+class Counter(_ValueMetric):
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class Gauge(_ValueMetric):
+    metric_type = "gauge"
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._bucket_counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._bucket_counts[index] += 1
+            self._sum += value
+
+    def get(self) -> tuple[list[int], float]:
+        with self._lock:
+            return list(self._bucket_counts), self._sum
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def _render_child(self, label_values: tuple[str, ...], child) -> list[str]:
+        bucket_counts, total = child.get()
+
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (math.inf,), bucket_counts):
+            cumulative += count
+            labels = _format_labels(
+                self.label_names + ("le",), label_values + (_format_value(upper_bound),)
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render_statistics(
+    prefix: str, labelled_statistics: list[tuple[dict[str, str], NamedTuple]]
+) -> list[str]:
+    """
+    Renders the fields of `statistics()` snapshots (pool, scheduler, caches, ...) as gauges named `<prefix>_<field>`.
+        These are read when the metrics are collected, so they cost nothing in between.
+
+    :param prefix: Prefix of the metric names
+    :param labelled_statistics: The labels and statistics of every instance, e.g. one per model
+    """
+    if not labelled_statistics:
+        return []
+
+    lines = []
+    for field in labelled_statistics[0][1]._fields:
+        name = f"{prefix}_{field}"
+        lines.append(f"# TYPE {name} gauge")
+        for labels, statistics in labelled_statistics:
+            value = getattr(statistics, field)
+            lines.append(
+                f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(float(value))}"
+            )
+    return lines
+
+
+def render_metrics(extra_lines: list[str] = ()) -> str:
+    """
+    Renders all metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
+
+
+# HTTP
+
+HTTP_REQUESTS = Counter(
+    "coderchat_http_requests_total",
+    "HTTP requests handled, by route and status code",
+    ("method", "route", "status"),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "coderchat_http_request_duration_seconds",
+    "Time until the response was fully sent, including streamed bodies",
+    ("method", "route"),
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "coderchat_http_requests_in_progress", "HTTP requests currently being handled"
+)
+
+# Generation
+
+GENERATION_PROMPT_TOKENS = Histogram(
+    "coderchat_generation_prompt_tokens",
+    "Number of tokens in the prompt of chat messages",
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768),
+)
+GENERATION_CONTEXT_DROPPED_TOKENS = Counter(
+    "coderchat_generation_context_dropped_tokens_total",
+    "Tokens of chat history left out of prompts to fit the context budget",
+)
+GENERATION_TIME_TO_FIRST_TOKEN = Histogram(
+    "coderchat_generation_time_to_first_token_seconds",
+    "Time from queueing a chat message until the first text of the reply",
+)
+GENERATION_DURATION = Histogram(
+    "coderchat_generation_duration_seconds",
+    "Time from queueing a chat message until its reply is finished",
+)
+GENERATION_TOKENS = Counter(
+    "coderchat_generation_tokens_total", "Tokens generated for chat replies"
+)
+GENERATION_TOKENS_PER_SECOND = Histogram(
+    "coderchat_generation_tokens_per_second",
+    "Decoding speed of chat replies, after the first token",
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500),
+)
+GENERATION_ACTIVE = Gauge(
+    "coderchat_generation_active", "Chat replies currently being generated"
+)
+GENERATION_FINISHED = Counter(
+    "coderchat_generation_finished_total",
+    "Chat replies finished, by their final status",
+    ("status",),
+)
+GENERATION_CANCELLED = Counter(
+    "coderchat_generation_cancelled_total",
+    "Chat replies cancelled before they were finished, by the reason they were cancelled",
+    ("reason",),
+)
+GENERATION_CANCELLED_UNUSED_TOKENS = Counter(
+    "coderchat_generation_cancelled_unused_tokens_total",
+    "Token budget of cancelled chat replies that was left unused, i.e. freed for other requests",
+)
+
+# Models
+
+MODEL_LOAD_DURATION = Histogram(
+    "coderchat_model_load_duration_seconds",
+    "Time to load a model, including its warm-up",
+    ("model",),
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+MODEL_UNLOAD_DURATION = Histogram(
+    "coderchat_model_unload_duration_seconds",
+    "Time to unload a model to stay within the memory budget",
+    ("model",),
+)
+
+# Database
+
+DATABASE_SESSION_DURATION = Histogram(
+    "coderchat_database_session_duration_seconds",
+    "Time a request held on to its database session",
+)
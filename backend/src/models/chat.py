@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime
+from typing import Annotated, Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class ChatRequestModel(BaseModel):
@@ -9,28 +10,104 @@ class ChatRequestModel(BaseModel):
 
 
 class ChatMessageResponseModel(BaseModel):
+    id: uuid.UUID
     from_user: bool
     content: str
     summary: str | None = None
+    status: str
 
 
 class CreateChatRequestModel(BaseModel):
     name: str
     language: str | None
+    # Name of the model to chat with, see `/models/`. The default model if not given
+    model: str | None = None
 
 
 class CreateChatWithMessageRequestModel(BaseModel):
     message: str
     name: str | None = None
     language: str | None = None
+    model: str | None = None
 
 
 class SimpleChatResponseModel(BaseModel):
     id: uuid.UUID
     name: str
     language: str | None
+    model: str
     create_date: datetime
 
 
 class ChatResponseModel(SimpleChatResponseModel):
     messages: list[ChatMessageResponseModel]
+    # Cursor for the messages before the ones included, None if there are no older messages
+    next_messages_cursor: str | None = None
+
+
+class ChatPageResponseModel(BaseModel):
+    items: list[SimpleChatResponseModel]
+    next_cursor: str | None
+
+
+class ChatMessagePageResponseModel(BaseModel):
+    items: list[ChatMessageResponseModel]
+    next_cursor: str | None
+
+
+class ModelResponseModel(BaseModel):
+    name: str
+    default: bool
+    loaded: bool
+
+
+class ExportedChatModel(BaseModel):
+    """
+    A chat in the NDJSON export, it is followed by the lines of its messages
+    """
+
+    type: Literal["chat"] = "chat"
+    id: uuid.UUID
+    name: str
+    language: str | None
+    # None for the default model of the exporting deployment
+    model: str | None
+    create_date: datetime
+
+
+class ExportedChatMessageModel(BaseModel):
+    type: Literal["message"] = "message"
+    id: uuid.UUID
+    chat_id: uuid.UUID
+    from_user: bool
+    content: str
+    summary: str | None
+    status: str
+    create_date: datetime
+
+
+ExportedLineModel = Annotated[
+    ExportedChatModel | ExportedChatMessageModel, Field(discriminator="type")
+]
+
+
+class ImportChatsResponseModel(BaseModel):
+    chats: int
+    messages: int
+
+
+class ChatSearchResultModel(BaseModel):
+    chat_id: uuid.UUID
+    chat_name: str
+    # The matching message, None if the name of the chat matched
+    message_id: uuid.UUID | None
+    from_user: bool | None
+    # The best matching parts of the text as HTML, with the text escaped and the matched words in <mark> tags
+    snippet: str
+    rank: float
+    create_date: datetime
+
+
+class ChatSearchPageResponseModel(BaseModel):
+    items: list[ChatSearchResultModel]
+    next_cursor: str | None
@@ -1,9 +1,17 @@
+from contextlib import contextmanager
+from typing import Annotated, AsyncIterator
 from uuid import UUID
 
-from fastapi import APIRouter, HTTPException, Depends
+import anyio
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, status
 from fastapi.responses import StreamingResponse
 
 from src.database import DatabaseSessionDepend
+from src.exceptions import (
+    GenerationInOtherWorkerError,
+    GenerationQueueFullError,
+    ValidationError,
+)
 from src.models.chat import (
     ChatRequestModel,
     CreateChatRequestModel,
@@ -16,26 +24,145 @@ from src.services.chat import (
     get_chat,
     create_chat_with_message,
     get_chats_for_user,
+    get_chat_messages,
+    get_message_stream,
+    get_models,
+    cancel_chat_generations,
 )
+from src.services.chat_export import export_chat, export_chats, import_chats
+from src.services.chat_search import search_chats
 from src.util.auth import verify_auth_token
+from src.util.stream_framing import (
+    StreamEvent,
+    StreamFormat,
+    frame_events,
+    negotiate_stream_format,
+)
 
 router = APIRouter()
 
+MAX_PAGE_SIZE = 100
+
 
 @router.get("/chat/{chat_id}/")
 def fetch_chat_r(
-    chat_id: UUID, db: DatabaseSessionDepend, user=Depends(verify_auth_token)
+    chat_id: UUID,
+    db: DatabaseSessionDepend,
+    message_limit: int = Query(default=50, ge=1, le=MAX_PAGE_SIZE),
+    user=Depends(verify_auth_token),
 ):
-    chat = get_chat(chat_id, user, db)
+    """
+    Returns the chat with its newest messages. Older messages can be loaded from `/chat/{chat_id}/messages/` with
+        the returned `next_messages_cursor`.
+    """
+    chat = get_chat(chat_id, user, db, message_limit)
     if chat is None:
         raise HTTPException(status_code=404, detail="No chat with given ID found")
 
     return chat
 
 
+@router.get("/chat/{chat_id}/messages/")
+def fetch_chat_messages_r(
+    chat_id: UUID,
+    db: DatabaseSessionDepend,
+    cursor: str | None = None,
+    limit: int = Query(default=50, ge=1, le=MAX_PAGE_SIZE),
+    user=Depends(verify_auth_token),
+):
+    """
+    Returns a page of messages of the chat, newest page first. Pass the returned `next_cursor` to get the page of
+        messages before it, it is None once the first message of the chat is included.
+    """
+    with _raise_if_invalid_request():
+        messages = get_chat_messages(chat_id, user, db, cursor, limit)
+    if messages is None:
+        raise HTTPException(status_code=404, detail="No chat with given ID found")
+
+    return messages
+
+
 @router.get("/chat/")
-def fetch_all_chats_r(db: DatabaseSessionDepend, user=Depends(verify_auth_token)):
-    return get_chats_for_user(user, db)
+def fetch_all_chats_r(
+    db: DatabaseSessionDepend,
+    cursor: str | None = None,
+    limit: int = Query(default=25, ge=1, le=MAX_PAGE_SIZE),
+    user=Depends(verify_auth_token),
+):
+    """
+    Returns a page of the chats of the user, newest first. Pass the returned `next_cursor` to get the next page,
+        it is None on the last page.
+    """
+    with _raise_if_invalid_request():
+        return get_chats_for_user(user, db, cursor, limit)
+
+
+@router.get("/chat/search")
+def search_chats_r(
+    db: DatabaseSessionDepend,
+    q: str = Query(min_length=1, max_length=500),
+    cursor: str | None = None,
+    limit: int = Query(default=25, ge=1, le=MAX_PAGE_SIZE),
+    user=Depends(verify_auth_token),
+):
+    """
+    Searches the user's chats by name and message content, best matches first, with highlighted snippets. Pass the
+        returned `next_cursor` to get the next page, it is None on the last page.
+    """
+    with _raise_if_invalid_request():
+        return search_chats(q, user, db, cursor, limit)
+
+
+@router.get("/chat/export")
+def export_chats_r(user=Depends(verify_auth_token)):
+    """
+    Exports all chats of the user with their messages as NDJSON, see `export_chats`. The export can be imported with
+        `/chat/import`.
+    """
+    return StreamingResponse(export_chats(user), media_type="application/x-ndjson")
+
+
+@router.get("/chat/{chat_id}/export")
+def export_chat_r(
+    chat_id: UUID, db: DatabaseSessionDepend, user=Depends(verify_auth_token)
+):
+    """
+    Exports a single chat with its messages, in the same format as `/chat/export`
+    """
+    lines = export_chat(chat_id, user, db)
+    if lines is None:
+        raise HTTPException(status_code=404, detail="No chat with given ID found")
+
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@router.post("/chat/import")
+async def import_chats_r(
+    request: Request, db: DatabaseSessionDepend, user=Depends(verify_auth_token)
+):
+    """
+    Imports chats exported with `/chat/export` (from this or another deployment) into the chats of the user. The
+        export is sent as the request body and is inserted while it is received, so it can be of any size.
+    """
+    with _raise_if_invalid_request():
+        return await import_chats(request.stream(), user, db)
+
+
+@contextmanager
+def _raise_if_invalid_request():
+    try:
+        yield
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@router.get("/models/")
+def fetch_models_r(user=Depends(verify_auth_token)):
+    """
+    Returns the models chats can be created with. Models that are not loaded yet take longer to answer the first
+        message.
+    """
+    return get_models()
 
 
 @router.post("/chat/")
@@ -44,18 +171,120 @@ def create_chat_r(
     db: DatabaseSessionDepend,
     user=Depends(verify_auth_token),
 ):
-    return create_chat(model, user, db)
+    with _raise_if_invalid_request():
+        return create_chat(model, user, db)
+
+
+AcceptHeader = Annotated[str | None, Header()]
+
+
+def _streaming_reply_response(
+    events: AsyncIterator[StreamEvent],
+    accept: str | None,
+    headers: dict[str, str] | None = None,
+) -> StreamingResponse:
+    """
+    Streams a reply as plain text, or as NDJSON or server-sent events if the client accepts them. The framed formats
+        carry the id of the reply and its token usage as events of their own.
+    """
+    stream_format = negotiate_stream_format(accept)
+    headers = dict(headers or {})
+    if stream_format == StreamFormat.SSE:
+        # Proxies must pass the events on as they come
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return StreamingResponse(
+        frame_events(events, stream_format),
+        media_type=stream_format.media_type,
+        headers=headers,
+    )
 
 
 @router.post("/chat/{chat_id}/message")
-def send_message(
+async def send_message(
     chat_id: UUID,
     model: ChatRequestModel,
     db: DatabaseSessionDepend,
+    accept: AcceptHeader = None,
     user=Depends(verify_auth_token),
 ):
-    response_generator = send_message_to_chat(chat_id, model.message, user, db)
-    return StreamingResponse(response_generator)
+    """
+    Sends a message to the chat and streams the reply. Pass `Accept: application/x-ndjson` or
+        `Accept: text/event-stream` for a framed stream, see `StreamEvent`.
+    """
+    # The response is streamed from the event loop, only the database work runs on a worker thread. This way a long
+    #   generation does not hold on to a threadpool slot for its whole duration
+    with _raise_if_generation_queue_full(), _raise_if_invalid_request():
+        live_generation = await anyio.to_thread.run_sync(
+            send_message_to_chat, chat_id, model.message, user, db
+        )
+
+    # The id of the reply allows resuming the stream after a dropped connection
+    return _streaming_reply_response(
+        live_generation.events(),
+        accept,
+        headers={"X-Message-Id": str(live_generation.message_id)},
+    )
+
+
+@router.get("/chat/{chat_id}/message/{message_id}/stream")
+def resume_message_stream_r(
+    chat_id: UUID,
+    message_id: UUID,
+    db: DatabaseSessionDepend,
+    offset: int = Query(default=0, ge=0),
+    accept: AcceptHeader = None,
+    user=Depends(verify_auth_token),
+):
+    """
+    Streams a reply of the assistant again, e.g. after the connection of the original request was lost.
+        Everything that has been generated so far is sent first, if the reply is still being generated the stream then
+        follows it until it is finished. Nothing is generated a second time.
+
+    :param chat_id:
+    :param message_id: The id of the reply, as returned in the `X-Message-Id` header or the chat
+    :param db:
+    :param offset: Number of characters of the reply the client already received, these are skipped
+    :param accept: As for sending a message
+    :param user:
+    :return:
+    """
+    events = get_message_stream(chat_id, message_id, offset, user, db)
+    if events is None:
+        raise HTTPException(status_code=404, detail="No message with given ID found")
+
+    return _streaming_reply_response(events, accept)
+
+
+@router.post("/chat/{chat_id}/message/cancel")
+async def cancel_message_r(
+    chat_id: UUID,
+    db: DatabaseSessionDepend,
+    user=Depends(verify_auth_token),
+):
+    """
+    Stops generating the reply of the chat, e.g. when the user presses stop. The streams of the reply end, and what
+        was generated until then is kept as an aborted message.
+
+    Replies are also cancelled on their own once no client has been streaming them for a while. Without an inference
+        server, replies that another web worker generates can't be stopped, this answers with 409 then.
+
+    :param chat_id:
+    :param db:
+    :param user:
+    :return: The ids of the replies that were cancelled, empty if none was being generated
+    """
+    try:
+        cancelled_message_ids = await cancel_chat_generations(chat_id, user, db)
+    except GenerationInOtherWorkerError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The reply is being generated by another worker, try again later",
+        )
+    if cancelled_message_ids is None:
+        raise HTTPException(status_code=404, detail="No chat with given ID found")
+
+    return {"cancelled_message_ids": cancelled_message_ids}
 
 
 def chat_with_message_streaming_response(chat: ChatResponseModel, chat_response):
@@ -64,10 +293,22 @@ def chat_with_message_streaming_response(chat: ChatResponseModel, chat_response)
     yield from chat_response
 
 
+@contextmanager
+def _raise_if_generation_queue_full():
+    try:
+        yield
+    except GenerationQueueFullError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many messages are currently being processed, try again later",
+        )
+
+
 @router.post("/chat/message")
-def create_chat_with_message_r(
+async def create_chat_with_message_r(
     model: CreateChatWithMessageRequestModel,
     db: DatabaseSessionDepend,
+    accept: AcceptHeader = None,
     user=Depends(verify_auth_token),
 ):
     """
@@ -78,9 +319,18 @@ def create_chat_with_message_r(
         The first line will be the chat model in JSON
         The following lines will be the response to the chat message
 
+    The chat model includes the reply that is being generated, its id can be used to resume the stream.
+
+    In the framed formats (see `send_message`), the chat model is sent as the `chat` event instead.
+
     :param model:
     :param db:
+    :param accept:
     :param user:
     :return:
     """
-    return StreamingResponse(create_chat_with_message(model, user, db))
+    with _raise_if_generation_queue_full(), _raise_if_invalid_request():
+        events = await anyio.to_thread.run_sync(
+            create_chat_with_message, model, user, db
+        )
+    return _streaming_reply_response(events, accept)
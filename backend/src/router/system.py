@@ -0,0 +1,181 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from src import ai_models
+from src.ai_models import loaded_models
+from src.database import get_database_pool_statistics
+from src.inference.generation import SchedulerStatistics
+from src.metrics import render_metrics, render_statistics
+from src.services import chat_retrieval, message_writer, summarization
+from src.services.message_compression import MESSAGE_COMPRESSOR
+from src.services.user import HASHING_EXECUTOR, VERIFIED_TOKEN_CACHE
+from src.util.startup import STARTUP, STARTUP_RETRY_AFTER_SECONDS
+
+router = APIRouter()
+
+
+@router.get("/health/live")
+def fetch_liveness_r():
+    """
+    Answers as soon as the process is up, also while it is still starting. Fails only if the startup failed, the
+        process has to be restarted then.
+
+    :return:
+    """
+    if STARTUP.failed:
+        return JSONResponse(
+            {"status": "failed"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return {"status": "alive"}
+
+
+@router.get("/health/ready")
+def fetch_readiness_r():
+    """
+    Answers once the database is migrated and the models are loaded, until then requests to the chat and user APIs
+        are rejected. Returns how long each step of the startup took.
+
+    :return:
+    """
+    if not STARTUP.ready:
+        return JSONResponse(
+            {"status": "failed" if STARTUP.failed else "starting"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER_SECONDS)},
+        )
+    return {"status": "ready", "startup_seconds": STARTUP.timings}
+
+
+def _scheduler_statistics() -> list[tuple[str, SchedulerStatistics]]:
+    # A model the inference server unloaded since it listed the loaded models has no statistics anymore
+    scheduler_statistics = []
+    for model_name, ai_model in loaded_models():
+        statistics = ai_model.scheduler.statistics()
+        if statistics is not None:
+            scheduler_statistics.append((model_name, statistics))
+    return scheduler_statistics
+
+
+@router.get("/system/stats/")
+def fetch_system_stats_r():
+    """
+    Returns runtime statistics of the shared resources of this process (database pool, ...), to help size them.
+
+    :return:
+    """
+    pool_statistics = get_database_pool_statistics()
+    summarization_statistics = summarization.summarization_statistics()
+
+    return {
+        "database_pool": pool_statistics._asdict()
+        if pool_statistics is not None
+        else None,
+        "generation": {
+            model_name: statistics._asdict()
+            for model_name, statistics in _scheduler_statistics()
+        },
+        "session_cache": {
+            model_name: ai_model.scheduler.session_cache.statistics()._asdict()
+            for model_name, ai_model in loaded_models()
+            if ai_model.scheduler.session_cache is not None
+        },
+        "response_cache": {
+            model_name: ai_model.scheduler.response_cache.statistics()._asdict()
+            for model_name, ai_model in loaded_models()
+            if ai_model.scheduler.response_cache is not None
+        },
+        "models": ai_models.MODEL_REGISTRY.statistics()._asdict()
+        if ai_models.MODEL_REGISTRY is not None
+        else None,
+        "auth_token_cache": VERIFIED_TOKEN_CACHE.statistics()._asdict(),
+        "password_hashing": HASHING_EXECUTOR.statistics()._asdict(),
+        "summarization": summarization_statistics._asdict()
+        if summarization_statistics is not None
+        else None,
+        "retrieval": chat_retrieval.CHAT_RETRIEVER.statistics()._asdict()
+        if chat_retrieval.CHAT_RETRIEVER is not None
+        else None,
+        "message_compression": MESSAGE_COMPRESSOR.statistics()._asdict(),
+        "message_writer": message_writer.MESSAGE_WRITER.statistics()._asdict()
+        if message_writer.MESSAGE_WRITER is not None
+        else None,
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def fetch_metrics_r():
+    """
+    Returns the metrics of this process in the Prometheus text format. Request and generation metrics are recorded as
+        they happen, the statistics of the shared resources (see `/system/stats/`) are added as gauges.
+
+    :return:
+    """
+    pool_statistics = get_database_pool_statistics()
+    summarization_statistics = summarization.summarization_statistics()
+
+    extra_lines = [
+        *render_statistics(
+            "coderchat_database_pool",
+            [({}, pool_statistics)] if pool_statistics is not None else [],
+        ),
+        *render_statistics(
+            "coderchat_scheduler",
+            [
+                ({"model": model_name}, statistics)
+                for model_name, statistics in _scheduler_statistics()
+            ],
+        ),
+        *render_statistics(
+            "coderchat_session_cache",
+            [
+                ({"model": model_name}, ai_model.scheduler.session_cache.statistics())
+                for model_name, ai_model in loaded_models()
+                if ai_model.scheduler.session_cache is not None
+            ],
+        ),
+        *render_statistics(
+            "coderchat_response_cache",
+            [
+                ({"model": model_name}, ai_model.scheduler.response_cache.statistics())
+                for model_name, ai_model in loaded_models()
+                if ai_model.scheduler.response_cache is not None
+            ],
+        ),
+        *render_statistics(
+            "coderchat_model_registry",
+            [({}, ai_models.MODEL_REGISTRY.statistics())]
+            if ai_models.MODEL_REGISTRY is not None
+            else [],
+        ),
+        *render_statistics(
+            "coderchat_summarization",
+            [({}, summarization_statistics)]
+            if summarization_statistics is not None
+            else [],
+        ),
+        *render_statistics(
+            "coderchat_retrieval",
+            [({}, chat_retrieval.CHAT_RETRIEVER.statistics())]
+            if chat_retrieval.CHAT_RETRIEVER is not None
+            else [],
+        ),
+        *render_statistics(
+            "coderchat_message_compression", [({}, MESSAGE_COMPRESSOR.statistics())]
+        ),
+        *render_statistics(
+            "coderchat_message_writer",
+            [({}, message_writer.MESSAGE_WRITER.statistics())]
+            if message_writer.MESSAGE_WRITER is not None
+            else [],
+        ),
+        *render_statistics(
+            "coderchat_auth_token_cache", [({}, VERIFIED_TOKEN_CACHE.statistics())]
+        ),
+        *render_statistics(
+            "coderchat_password_hashing", [({}, HASHING_EXECUTOR.statistics())]
+        ),
+    ]
+
+    return PlainTextResponse(
+        render_metrics(extra_lines), media_type="text/plain; version=0.0.4"
+    )
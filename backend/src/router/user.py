@@ -8,6 +8,7 @@ from src.exceptions import (
     ValidationError,
     InvalidCredentialsError,
     UserLockedError,
+    PasswordHashingBusyError,
 )
 from src.models.user import (
     CreateNewUserModel,
@@ -39,6 +40,19 @@ def create_user_r(user: CreateNewUserModel, db: DatabaseSessionDepend):
             content=json.dumps({"error": str(e)}),
         )
 
+    except PasswordHashingBusyError:
+        return _password_hashing_busy_response(
+            "Too many signups at once, try again later"
+        )
+
+
+def _password_hashing_busy_response(message: str) -> Response:
+    return Response(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=json.dumps({"error": message}),
+        headers={"Retry-After": "1"},
+    )
+
 
 def _perform_login(login_fun: Callable[[], UserLoginResponse]):
     try:
@@ -56,6 +70,11 @@ def _perform_login(login_fun: Callable[[], UserLoginResponse]):
             content=json.dumps({"error": "Account is currently locked"}),
         )
 
+    except PasswordHashingBusyError:
+        return _password_hashing_busy_response(
+            "Too many logins at once, try again later"
+        )
+
 
 @router.post(
     "/user/login/", response_model=UserLoginResponse, status_code=status.HTTP_200_OK
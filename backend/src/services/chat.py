@@ -1,25 +1,44 @@
-from typing import Generator
+from typing import AsyncIterator
 
-from threading import Thread
 from uuid import UUID
 
-from sqlalchemy import select, and_
+import anyio
+from sqlalchemy import select, and_, tuple_
 from sqlalchemy.orm import Session
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
 
-from src.ai_models import AI_MODELS
+from src.ai_models import get_model_registry
 from src.config import CONFIG
-from src.data_models.chat import Chat, ChatMessage
-from src.exceptions import EntityNotFoundError
+from src.data_models.base import generate_current_date, generate_uuid
+from src.data_models.chat import Chat, ChatMessage, ChatMessageStatus
+from src.exceptions import EntityNotFoundError, GenerationInOtherWorkerError
+from src.inference.generation import GenerationStream
 from src.logs import get_logger
+from src.metrics import GENERATION_CONTEXT_DROPPED_TOKENS, GENERATION_PROMPT_TOKENS
 from src.models.chat import (
     ChatResponseModel,
     CreateChatRequestModel,
     ChatMessageResponseModel,
+    ChatMessagePageResponseModel,
+    ChatPageResponseModel,
     CreateChatWithMessageRequestModel,
+    ModelResponseModel,
     SimpleChatResponseModel,
 )
+from src.services import chat_retrieval
+from src.services.chat_context import MESSAGE_OVERHEAD_TOKENS, build_chat_context
+from src.services.live_generation import (
+    CancelReason,
+    LiveGeneration,
+    cancel_remote_generations,
+    get_live_generation,
+    get_live_generations_of_chat,
+    start_live_generation,
+)
+from src.services.message_writer import MessageWrite, save_messages
+from src.services.summarization import summarize_chat_message
 from src.services.user import JwtUser
+from src.util.pagination import decode_cursor, encode_cursor
+from src.util.stream_framing import StreamEvent
 
 
 logger = get_logger(__name__)
@@ -29,9 +48,11 @@ def _chat_message_to_response_model(
     chat_message: ChatMessage,
 ) -> ChatMessageResponseModel:
     return ChatMessageResponseModel(
+        id=chat_message.id,
         content=chat_message.content,
         summary=chat_message.summary,
         from_user=chat_message.from_user,
+        status=chat_message.status,
     )
 
 
@@ -40,14 +61,30 @@ def _chat_to_response_model(chat: Chat, messages: list[ChatMessage]):
         id=chat.id,
         name=chat.name,
         language=chat.language,
+        model=_chat_model_name(chat),
         messages=[_chat_message_to_response_model(message) for message in messages],
         create_date=chat.create_date,
     )
 
 
+def _chat_model_name(chat: Chat) -> str:
+    return chat.model if chat.model is not None else CONFIG.model_name
+
+
 def _query_raw_chat(
-    chat_id: UUID, user: JwtUser, db: Session
-) -> tuple[Chat | None, list[ChatMessage]]:
+    chat_id: UUID,
+    user: JwtUser,
+    db: Session,
+    message_limit: int,
+    message_cursor: str | None = None,
+) -> tuple[Chat | None, list[ChatMessage], str | None]:
+    """
+    Queries the chat together with a page of its messages, newest page first
+
+    :param message_limit: The maximum number of messages to return
+    :param message_cursor: Cursor returned for a previous page, to continue with the messages before it
+    :return: The chat, its messages (oldest first) and the cursor for the messages before them, if there are any
+    """
     chat_query = (
         select(Chat)
         .select_from(Chat)
@@ -55,55 +92,128 @@ def _query_raw_chat(
     )
     chat = db.scalars(chat_query).first()
     if chat is None:
-        return None, []
+        return None, [], None
 
     messages_query = (
         select(ChatMessage)
         .select_from(ChatMessage)
         .where(ChatMessage.chat_id == chat_id)
-        .order_by(ChatMessage.create_date)
+        .order_by(ChatMessage.create_date.desc(), ChatMessage.id.desc())
+        .limit(message_limit + 1)
+    )
+    if message_cursor is not None:
+        messages_query = messages_query.where(
+            _before_cursor(ChatMessage, message_cursor)
+        )
+    chat_messages = list(db.scalars(messages_query).all())
+
+    next_cursor = None
+    if len(chat_messages) > message_limit:
+        chat_messages = chat_messages[:message_limit]
+        next_cursor = encode_cursor(chat_messages[-1].create_date, chat_messages[-1].id)
+    chat_messages.reverse()
+
+    return chat, chat_messages, next_cursor
+
+
+def _before_cursor(model: type[Chat] | type[ChatMessage], cursor: str):
+    create_date, entity_id = decode_cursor(cursor)
+
+    # The plain comparison on the date lets the create_date indexes start the scan at the cursor, the row
+    #   comparison breaks ties between entities created at the same time
+    return and_(
+        model.create_date <= create_date,
+        tuple_(model.create_date, model.id) < tuple_(create_date, entity_id),
     )
-    chat_messages = db.scalars(messages_query).all()
 
-    return chat, chat_messages
+
+def get_chat(
+    chat_id: UUID, user: JwtUser, db: Session, message_limit: int = 50
+) -> ChatResponseModel | None:
+    chat, chat_messages, next_cursor = _query_raw_chat(chat_id, user, db, message_limit)
+
+    if chat is None:
+        return None
+
+    chat_response = _chat_to_response_model(chat, chat_messages)
+    chat_response.next_messages_cursor = next_cursor
+    return chat_response
 
 
-def get_chat(chat_id: UUID, user: JwtUser, db: Session) -> ChatResponseModel | None:
-    chat, chat_messages = _query_raw_chat(chat_id, user, db)
+def get_chat_messages(
+    chat_id: UUID,
+    user: JwtUser,
+    db: Session,
+    cursor: str | None = None,
+    limit: int = 50,
+) -> ChatMessagePageResponseModel | None:
+    chat, chat_messages, next_cursor = _query_raw_chat(chat_id, user, db, limit, cursor)
 
     if chat is None:
         return None
 
-    return _chat_to_response_model(chat, chat_messages)
+    return ChatMessagePageResponseModel(
+        items=[_chat_message_to_response_model(message) for message in chat_messages],
+        next_cursor=next_cursor,
+    )
 
 
 def get_chats_for_user(
-    user: JwtUser, db: Session, limit=25
-) -> list[SimpleChatResponseModel]:
+    user: JwtUser, db: Session, cursor: str | None = None, limit: int = 25
+) -> ChatPageResponseModel:
     chats_query = (
         select(Chat)
         .select_from(Chat)
         .where(Chat.user_id == user.id)
-        .order_by(Chat.create_date.desc())
-        .limit(limit)
+        .order_by(Chat.create_date.desc(), Chat.id.desc())
+        .limit(limit + 1)
     )
+    if cursor is not None:
+        chats_query = chats_query.where(_before_cursor(Chat, cursor))
     chats = db.scalars(chats_query).all()
 
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = encode_cursor(chats[-1].create_date, chats[-1].id)
+
+    return ChatPageResponseModel(
+        items=[
+            SimpleChatResponseModel(
+                id=chat.id,
+                name=chat.name,
+                language=chat.language,
+                model=_chat_model_name(chat),
+                create_date=chat.create_date,
+            )
+            for chat in chats
+        ],
+        next_cursor=next_cursor,
+    )
+
+
+def get_models() -> list[ModelResponseModel]:
     return [
-        SimpleChatResponseModel(
-            id=chat.id,
-            name=chat.name,
-            language=chat.language,
-            create_date=chat.create_date,
-        )
-        for chat in chats
+        ModelResponseModel(name=model.name, default=model.default, loaded=model.loaded)
+        for model in get_model_registry().models()
     ]
 
 
 def create_chat(
     create_model: CreateChatRequestModel, user: JwtUser, db: Session
 ) -> ChatResponseModel:
-    chat = Chat(name=create_model.name, language=create_model.language, user_id=user.id)
+    """
+    :raises ValidationError: If the chosen model is not available
+    """
+    if create_model.model is not None:
+        get_model_registry().validate_model_name(create_model.model)
+
+    chat = Chat(
+        name=create_model.name,
+        language=create_model.language,
+        model=create_model.model,
+        user_id=user.id,
+    )
     db.add(chat)
     db.commit()
 
@@ -112,137 +222,351 @@ def create_chat(
 
 def create_chat_with_message(
     create_model: CreateChatWithMessageRequestModel, user: JwtUser, db: Session
-):
+) -> AsyncIterator[StreamEvent]:
+    """
+    Must be called from a worker thread of the event loop that will stream the response
+
+    :raises ValidationError: If the chosen model is not available
+    """
+    # Nothing is read, the request's connection is not needed while the reply streams
+    db.close()
     name = create_model.name if create_model.name else create_model.message[:50]
 
-    chat = Chat(name=name, language=create_model.language, user_id=user.id)
-    db.add(chat)
-    db.flush()
-
-    message_model = ChatMessage(
-        chat_id=chat.id, content=create_model.message, from_user=True
+    chat = {
+        "id": generate_uuid(),
+        "name": name,
+        "language": create_model.language,
+        "model": create_model.model,
+        "user_id": user.id,
+        "create_date": generate_current_date(),
+    }
+    message = _new_message(chat["id"], create_model.message, True)
+    reply = _new_assistant_message(chat["id"])
+
+    retriever = chat_retrieval.CHAT_RETRIEVER
+    message_embedding = None
+    if retriever is not None:
+        message_embedding = retriever.embed(create_model.message)
+        message["embedding"] = retriever.encode(message_embedding)
+
+    # Queue the message before saving, so no chat is created if the generation queue is full
+    results_stream = process_message(
+        chat["id"], create_model.message, [], create_model.language, chat["model"]
     )
-    db.add(message_model)
-    db.commit()
-
-    chat_response = _chat_to_response_model(chat, [message_model])
-    yield chat_response.model_dump_json()
-    yield "\n"
+    _save_new_messages(
+        MessageWrite(new_chats=(chat,), new_messages=(message, reply)), results_stream
+    )
+    summarize_chat_message(message["id"], create_model.message)
+    if message_embedding is not None:
+        retriever.add_message(chat["id"], message["id"], True, message_embedding)
+
+    chat_response = ChatResponseModel(
+        id=chat["id"],
+        name=chat["name"],
+        language=chat["language"],
+        model=chat["model"] if chat["model"] is not None else CONFIG.model_name,
+        messages=[
+            _new_message_to_response_model(message),
+            _new_message_to_response_model(reply),
+        ],
+        create_date=chat["create_date"],
+    )
+    live_generation = anyio.from_thread.run_sync(
+        start_live_generation, chat["id"], reply["id"], results_stream
+    )
+    return _chat_with_message_events(chat_response, live_generation)
 
-    results_stream = process_message(create_model.message, [], create_model.language)
-    yield from stream_message_results(chat.id, results_stream, db)
 
+async def _chat_with_message_events(
+    chat_response: ChatResponseModel, live_generation: LiveGeneration
+) -> AsyncIterator[StreamEvent]:
+    yield StreamEvent("chat", chat_response.model_dump(mode="json"))
 
-def stream_message_results(chat_id: UUID, results_stream, db: Session):
-    message = ""
+    async for event in live_generation.events():
+        yield event
 
-    for text_token in results_stream:
-        message += text_token
-        yield text_token
 
-    chat_message = ChatMessage(chat_id=chat_id, content=message, from_user=False)
-    db.add(chat_message)
-    db.commit()
+def _new_message(
+    chat_id: UUID,
+    content: str,
+    from_user: bool,
+    status: ChatMessageStatus = ChatMessageStatus.COMPLETE,
+) -> dict:
+    # Saved by the message writer, see `MessageWrite`
+    return {
+        "id": generate_uuid(),
+        "chat_id": chat_id,
+        "content": content,
+        "from_user": from_user,
+        "status": status,
+        "create_date": generate_current_date(),
+    }
 
-    # TODO: re-add in the summary, we aren't using them right now anyway though
-    # summarize_chat_message(chat_message)
 
+def _new_assistant_message(chat_id: UUID) -> dict:
+    # The reply is saved up front, so it can be checkpointed while it is generated and resumed by its id
+    return _new_message(chat_id, "", False, ChatMessageStatus.STREAMING)
 
-def send_message_to_chat(chat_id: UUID, message: str, user: JwtUser, db: Session):
-    chat, chat_messages = _query_raw_chat(chat_id, user, db)
-    if chat is None:
-        raise EntityNotFoundError(f"No chat with id {chat_id} exists")
 
-    # the chat exists, we must add our message to the chat now
-    message_model = ChatMessage(chat_id=chat_id, content=message, from_user=True)
-    db.add(message_model)
-    db.commit()
+def _new_message_to_response_model(message: dict) -> ChatMessageResponseModel:
+    return ChatMessageResponseModel(
+        id=message["id"],
+        content=message["content"],
+        from_user=message["from_user"],
+        status=message["status"],
+    )
 
-    previous_messages = [m.content for m in chat_messages]
-    results_stream = process_message(message, previous_messages, chat.language)
 
-    return stream_message_results(chat_id, results_stream, db)
+def _save_new_messages(write: MessageWrite, results_stream: GenerationStream):
+    """
+    Saves the new messages together with those of other requests, and waits until they are committed. The reply is
+        already queued for generation, it is cancelled if they can't be saved.
+    """
+    try:
+        save_messages(write)
+    except Exception:
+        results_stream.cancel()
+        raise
+
+
+def send_message_to_chat(
+    chat_id: UUID, message: str, user: JwtUser, db: Session
+) -> LiveGeneration:
+    """
+    Must be called from a worker thread of the event loop that will stream the response
+    """
+    retriever = chat_retrieval.CHAT_RETRIEVER
+    # Every message takes up at least its overhead in the prompt, older messages could never fit into the context.
+    #   With retrieval, only the newest messages are read, relevant older ones are added below
+    chat, chat_messages, older_messages_cursor = _query_raw_chat(
+        chat_id,
+        user,
+        db,
+        CONFIG.retrieval_recent_messages
+        if retriever is not None
+        else CONFIG.context_max_tokens // MESSAGE_OVERHEAD_TOKENS,
+    )
+    if chat is None:
+        raise EntityNotFoundError(f"No chat with id {chat_id} exists")
 
+    # the chat exists, we must add our message to the chat now. Only save it once the message has been queued
+    message_values = _new_message(chat_id, message, True)
+    reply = _new_assistant_message(chat_id)
+
+    message_embedding = None
+    if retriever is not None:
+        message_embedding = retriever.embed(message)
+        message_values["embedding"] = retriever.encode(message_embedding)
+        if older_messages_cursor is not None:
+            chat_messages = _add_relevant_messages(
+                retriever, chat_id, message_embedding, chat_messages, db
+            )
+    # Everything is read, the messages are saved by the message writer. Closing the session returns its connection
+    #   to the pool rather than keeping it until the reply has been streamed, the loaded messages stay usable
+    db.close()
+
+    # Replies that are still being generated are incomplete, leave them out of the context
+    previous_messages = [
+        chat_message
+        for chat_message in chat_messages
+        if chat_message.status != ChatMessageStatus.STREAMING
+    ]
+    results_stream = process_message(
+        chat_id, message, previous_messages, chat.language, chat.model
+    )
+    _save_new_messages(
+        MessageWrite(new_messages=(message_values, reply)), results_stream
+    )
+    summarize_chat_message(message_values["id"], message)
+    if message_embedding is not None:
+        retriever.add_message(chat_id, message_values["id"], True, message_embedding)
 
-def process_message(
-    message: str, previous_messages: list[str], language: str | None
-) -> Generator[str, None, None]:
-    if CONFIG.model_path not in AI_MODELS:
-        raise ValueError("Models must be loaded before processing messages")
+    return anyio.from_thread.run_sync(
+        start_live_generation, chat_id, reply["id"], results_stream
+    )
 
-    ml_model = AI_MODELS[CONFIG.model_path]
-    tokenizer = ml_model.tokenizer
-    model = ml_model.model
 
-    prompt = ""
-    if language is not None:
-        prompt = f"LANGUAGE: {language}\n"
+def _add_relevant_messages(
+    retriever: chat_retrieval.ChatRetriever,
+    chat_id: UUID,
+    message_embedding,
+    recent_messages: list[ChatMessage],
+    db: Session,
+) -> list[ChatMessage]:
+    """
+    Adds the earlier turns of the chat that are most relevant to the new message to its newest messages
+
+    :return: The messages, oldest first
+    """
+    relevant_message_ids = retriever.relevant_message_ids(
+        chat_id,
+        message_embedding,
+        CONFIG.retrieval_top_k,
+        exclude={chat_message.id for chat_message in recent_messages},
+    )
+    if not relevant_message_ids:
+        return recent_messages
+
+    relevant_messages = db.scalars(
+        select(ChatMessage).where(ChatMessage.id.in_(relevant_message_ids))
+    ).all()
+    return sorted(
+        [*relevant_messages, *recent_messages],
+        key=lambda chat_message: (chat_message.create_date, chat_message.id),
+    )
 
-    if previous_messages is not None and len(previous_messages) > 0:
-        previous_messages_prompt = """
-        PREVIOUS MESSAGES (SEPARATED BY ______)
-        """.strip()
 
-        previous_messages_prompt += "______\n".join(previous_messages) + "______"
-        prompt += previous_messages_prompt
+def get_message_stream(
+    chat_id: UUID, message_id: UUID, offset: int, user: JwtUser, db: Session
+) -> AsyncIterator[StreamEvent] | None:
+    """
+    Streams a reply from the given character offset on. A reply that is still being generated by this process is
+        followed until it is finished, otherwise the saved content is replayed.
+    """
+    # Look up the live generation first. It is only removed once its final content is saved, so if it is already
+    #   gone, the query below is guaranteed to see the finished message
+    live_generation = get_live_generation(message_id)
 
-    prompt += "\nQUESTION:" + message
+    message_query = (
+        select(ChatMessage)
+        .join(Chat, Chat.id == ChatMessage.chat_id)
+        .where(
+            and_(
+                Chat.user_id == user.id,
+                ChatMessage.chat_id == chat_id,
+                ChatMessage.id == message_id,
+            )
+        )
+    )
+    chat_message = db.scalars(message_query).first()
+    if chat_message is None:
+        return None
 
-    messages = [{"role": "user", "content": prompt}]
+    if live_generation is not None:
+        # The reply is followed until it is finished, without holding on to the request's connection
+        db.close()
+        return live_generation.events(offset)
 
-    text = tokenizer.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True, enable_thinking=False
+    return _replay_message(
+        chat_message.id, chat_message.content[offset:], offset, chat_message.status
     )
 
-    streamer = TextIteratorStreamer(
-        tokenizer, skip_prompt=True, skip_special_tokens=True
-    )
 
-    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+async def cancel_chat_generations(
+    chat_id: UUID, user: JwtUser, db: Session
+) -> list[UUID] | None:
+    """
+    Stops generating the replies of the chat. The stream of every client ends, and what was generated so far is
+        saved as an aborted reply. Replies generated by this process are saved before this returns, replies of other
+        web workers are cancelled through the inference server and saved by their web worker shortly after.
+
+    Without an inference server (`inference_socket`) the replies of other web workers can't be reached.
+
+    :return: The ids of the cancelled replies, None if the user has no chat with the given id
+    :raises GenerationInOtherWorkerError: If a reply of the chat is generated by a process that can't be reached
+    """
+    chat_query = select(Chat.id).where(
+        and_(Chat.id == chat_id, Chat.user_id == user.id)
+    )
+    if await anyio.to_thread.run_sync(db.scalar, chat_query) is None:
+        return None
 
-    def generate_fun():
-        try:
-            model.generate(max_new_tokens=32768, streamer=streamer, **model_inputs)
-        except:
-            logger.error("Exception occurred while calling LLM")
-            raise
+    cancelled = [
+        live_generation
+        for live_generation in get_live_generations_of_chat(chat_id)
+        if live_generation.cancel(CancelReason.USER_REQUEST)
+    ]
+    for live_generation in cancelled:
+        await live_generation.wait()
+    cancelled_message_ids = [
+        live_generation.message_id for live_generation in cancelled
+    ]
 
-    thread = Thread(target=generate_fun)
-    thread.start()
+    # Replies of this process are saved as aborted by now, the ones still streaming are generated elsewhere
+    other_query = select(ChatMessage.id).where(
+        and_(
+            ChatMessage.chat_id == chat_id,
+            ChatMessage.status == ChatMessageStatus.STREAMING,
+            ChatMessage.id.not_in(
+                [
+                    live_generation.message_id
+                    for live_generation in get_live_generations_of_chat(chat_id)
+                ]
+            ),
+        )
+    )
+    other_message_ids = list(
+        await anyio.to_thread.run_sync(lambda: db.scalars(other_query).all())
+    )
+    if other_message_ids:
+        if not await anyio.to_thread.run_sync(cancel_remote_generations, chat_id):
+            raise GenerationInOtherWorkerError()
+        cancelled_message_ids.extend(other_message_ids)
 
-    return streamer
+    return cancelled_message_ids
 
 
-# TODO: Re-add generating summaries for messages + actually using them
-# def summarize_chat_message(message: ChatMessage):
-#     def thread_fun():
-#         message.summary = summarize_message(message.content)
-#
-#     thread = Thread(target=thread_fun, kwargs={})
-#     thread.start()
+async def _replay_message(
+    message_id: UUID, content: str, offset: int, status: ChatMessageStatus
+) -> AsyncIterator[StreamEvent]:
+    yield StreamEvent("message", {"message_id": str(message_id), "offset": offset})
 
+    if content:
+        yield StreamEvent("delta", {"text": content})
 
-def summarize_message(message: str) -> str:
-    # TODO: Deduplicate this with process_message above, but leave here for now
-    tokenizer = AutoTokenizer.from_pretrained(CONFIG.model_path)
-    model = AutoModelForCausalLM.from_pretrained(
-        CONFIG.model_path, dtype="auto", device_map="auto"
+    # The token usage is only known while the reply is generated
+    yield StreamEvent(
+        "end",
+        {"message_id": str(message_id), "status": status, "usage": None},
     )
 
-    prompt = """
-        SUMMARIZE THE FOLLOWING MESSAGE:
-    """.strip()
-    prompt += message
 
-    messages = [{"role": "user", "content": prompt}]
+def process_message(
+    chat_id: UUID,
+    message: str,
+    previous_messages: list[ChatMessage],
+    language: str | None,
+    model_name: str | None = None,
+) -> GenerationStream:
+    """
+    :param model_name: Name of the model to generate the reply with, None for the default model. It is loaded if it
+        isn't already
+    :raises ValidationError: If the model is not available
+    """
+    # The model is only kept from being unloaded until the message is queued, from then on the queued request does
+    with get_model_registry().use(model_name) as ml_model:
+        tokenizer = ml_model.tokenizer
+
+        # Previous messages are passed as their own turns, rather than joined into the question. This way the prompt of
+        #   the next message always starts with the prompt of this one, which lets its KV cache be reused
+        context = build_chat_context(
+            tokenizer,
+            message,
+            previous_messages,
+            language,
+            max_tokens=CONFIG.context_max_tokens,
+            recent_messages=CONFIG.context_recent_messages,
+        )
+        logger.info(
+            f"Built context for chat {chat_id}: kept {context.kept_tokens} tokens, dropped {context.dropped_tokens} "
+            f"tokens ({context.dropped_messages} messages dropped, {context.truncated_messages} truncated, "
+            f"{context.summarized_messages} summarized)"
+        )
 
-    text = tokenizer.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True, enable_thinking=False
-    )
-    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+        text = tokenizer.apply_chat_template(
+            context.messages,
+            tokenize=False,
+            add_generation_prompt=True,
+            enable_thinking=False,
+        )
 
-    generated_ids = model.generate(**model_inputs, max_new_tokens=32768)
-    output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
-    content = tokenizer.decode(output_ids[0:], skip_special_tokens=True).strip("\n")
+        prompt_ids = tokenizer([text]).input_ids[0]
+        GENERATION_PROMPT_TOKENS.observe(len(prompt_ids))
+        GENERATION_CONTEXT_DROPPED_TOKENS.inc(context.dropped_tokens)
 
-    return content
+        # Generation runs on the model's scheduler thread, batched together with any other in progress messages
+        return ml_model.scheduler.submit(
+            prompt_ids,
+            max_new_tokens=CONFIG.generation_max_new_tokens,
+            session_id=chat_id,
+        )
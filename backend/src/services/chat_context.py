@@ -0,0 +1,140 @@
+from typing import NamedTuple
+
+from src.data_models.chat import ChatMessage
+
+# Rough number of tokens the chat template adds around every message (role markers, separators, ...)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TRUNCATED_MARKER = "\n[...truncated]"
+
+
+class ChatContext(NamedTuple):
+    messages: list[dict[str, str]]
+    kept_tokens: int
+    dropped_tokens: int
+    summarized_messages: int
+    truncated_messages: int
+    dropped_messages: int
+
+
+def _count_tokens(tokenizer, texts: list[str]) -> list[int]:
+    if not texts:
+        return []
+
+    return [
+        len(input_ids)
+        for input_ids in tokenizer(texts, add_special_tokens=False).input_ids
+    ]
+
+
+def _truncate_to_tokens(tokenizer, text: str, max_tokens: int) -> str | None:
+    """
+    :return: The start of the text followed by the truncation marker, in at most `max_tokens` tokens together. None
+        if not even the marker fits
+    """
+    text_tokens = max_tokens - _count_tokens(tokenizer, [TRUNCATED_MARKER])[0]
+    if text_tokens <= 0:
+        return None
+
+    input_ids = tokenizer(text, add_special_tokens=False).input_ids
+    return tokenizer.decode(input_ids[:text_tokens]) + TRUNCATED_MARKER
+
+
+def build_chat_context(
+    tokenizer,
+    message: str,
+    previous_messages: list[ChatMessage],
+    language: str | None,
+    max_tokens: int,
+    recent_messages: int,
+) -> ChatContext:
+    """
+    Builds the chat messages to send to the model, fitting the chat history into a token budget.
+
+    The language and the new message are always included. The history is then filled in from the newest message
+        backwards:
+        * Messages that fit are kept whole
+        * Messages older than the `recent_messages` newest ones fall back to their summary, if they have one
+        * The first message that does not fit is truncated to the remaining budget, everything older is dropped
+
+    Token counts are approximate, as the tokens added by the chat template itself are only estimated.
+
+    :param tokenizer: Tokenizer of the model the messages are for
+    :param message: The new message from the user
+    :param previous_messages: The previous messages in the chat, oldest first
+    :param language: The language of the chat, if any
+    :param max_tokens: The token budget for the whole prompt
+    :param recent_messages: How many of the newest messages should never be replaced by their summary
+    :return:
+    """
+    system_messages = []
+    if language is not None:
+        system_messages.append({"role": "system", "content": f"LANGUAGE: {language}"})
+    question = {"role": "user", "content": message}
+
+    fixed_tokens = sum(
+        count + MESSAGE_OVERHEAD_TOKENS
+        for count in _count_tokens(
+            tokenizer, [m["content"] for m in system_messages + [question]]
+        )
+    )
+    remaining = max_tokens - fixed_tokens
+
+    content_tokens = _count_tokens(tokenizer, [m.content for m in previous_messages])
+
+    history = []
+    kept_tokens = fixed_tokens
+    dropped_tokens = 0
+    summarized_messages = 0
+    truncated_messages = 0
+    dropped_messages = 0
+
+    for age, (previous_message, tokens) in enumerate(
+        zip(reversed(previous_messages), reversed(content_tokens))
+    ):
+        role = "user" if previous_message.from_user else "assistant"
+
+        if remaining <= MESSAGE_OVERHEAD_TOKENS:
+            dropped_tokens += tokens
+            dropped_messages += 1
+            continue
+
+        content = previous_message.content
+        used_tokens = tokens
+
+        if (
+            tokens + MESSAGE_OVERHEAD_TOKENS > remaining
+            and age >= recent_messages
+            and previous_message.summary
+        ):
+            summary_tokens = _count_tokens(tokenizer, [previous_message.summary])[0]
+            if summary_tokens < tokens:
+                content = previous_message.summary
+                used_tokens = summary_tokens
+                summarized_messages += 1
+
+        if used_tokens + MESSAGE_OVERHEAD_TOKENS > remaining:
+            used_tokens = remaining - MESSAGE_OVERHEAD_TOKENS
+            content = _truncate_to_tokens(tokenizer, content, used_tokens)
+            if content is None:
+                remaining = 0
+                dropped_tokens += tokens
+                dropped_messages += 1
+                continue
+            truncated_messages += 1
+
+        history.append({"role": role, "content": content})
+        remaining -= used_tokens + MESSAGE_OVERHEAD_TOKENS
+        kept_tokens += used_tokens + MESSAGE_OVERHEAD_TOKENS
+        dropped_tokens += max(tokens - used_tokens, 0)
+
+    history.reverse()
+
+    return ChatContext(
+        messages=system_messages + history + [question],
+        kept_tokens=kept_tokens,
+        dropped_tokens=dropped_tokens,
+        summarized_messages=summarized_messages,
+        truncated_messages=truncated_messages,
+        dropped_messages=dropped_messages,
+    )
@@ -0,0 +1,277 @@
+import uuid
+from typing import AsyncIterator, Iterator
+from uuid import UUID
+
+import anyio
+from pydantic import TypeAdapter
+from pydantic import ValidationError as PydanticValidationError
+from sqlalchemy import and_, bindparam, insert, select
+from sqlalchemy.orm import Session
+
+from src.ai_models import get_model_registry
+from src.config import CONFIG
+from src.data_models.chat import (
+    Chat,
+    ChatMessage,
+    ChatMessageStatus,
+    message_search_vector,
+)
+from src.database import get_database_engine
+from src.exceptions import ValidationError
+from src.logs import get_logger
+from src.models.chat import (
+    ExportedChatMessageModel,
+    ExportedChatModel,
+    ExportedLineModel,
+    ImportChatsResponseModel,
+)
+from src.services.message_compression import message_content_values, read_content
+from src.services.user import JwtUser
+
+logger = get_logger(__name__)
+
+_EXPORTED_LINE = TypeAdapter(ExportedLineModel)
+
+# The search vector is computed from the text of each row, also when the row only holds the compressed content
+_INSERT_MESSAGE = insert(ChatMessage).values(
+    search_vector=message_search_vector(bindparam("search_text"))
+)
+
+
+def export_chats(user: JwtUser) -> Iterator[str]:
+    """
+    Exports the chats of the user as NDJSON: every chat is a line of its own, followed by a line for each of its
+        messages, oldest first. See `ExportedChatModel` and `ExportedChatMessageModel`.
+
+    The returned iterator reads the chats through a server-side cursor on a database session of its own, so it doesn't
+        hold a connection of the request while it is streamed and its memory use doesn't grow with the history.
+
+    :return: Chunks of lines
+    """
+    return _export_lines(user.id, None)
+
+
+def export_chat(chat_id: UUID, user: JwtUser, db: Session) -> Iterator[str] | None:
+    """
+    Exports a single chat of the user, like `export_chats`. The request's session is closed once the chat is found,
+        the export is streamed on a session of its own
+
+    :return: Chunks of lines, None if the user has no chat with the given id
+    """
+    chat_query = select(Chat.id).where(
+        and_(Chat.id == chat_id, Chat.user_id == user.id)
+    )
+    chat_exists = db.scalar(chat_query) is not None
+    # Returns the connection to the pool rather than keeping it while the export streams
+    db.close()
+    if not chat_exists:
+        return None
+
+    return _export_lines(user.id, chat_id)
+
+
+def _export_lines(user_id: UUID, chat_id: UUID | None) -> Iterator[str]:
+    # Chats without messages are exported as well, hence the outer join
+    query = (
+        select(
+            Chat.id.label("chat_id"),
+            Chat.name,
+            Chat.language,
+            Chat.model,
+            Chat.create_date.label("chat_create_date"),
+            ChatMessage.id.label("message_id"),
+            ChatMessage.from_user,
+            ChatMessage.plain_content,
+            ChatMessage.compressed_content,
+            ChatMessage.summary,
+            ChatMessage.status,
+            ChatMessage.create_date.label("message_create_date"),
+        )
+        .outerjoin(ChatMessage, ChatMessage.chat_id == Chat.id)
+        .where(Chat.user_id == user_id)
+        .order_by(
+            Chat.create_date,
+            Chat.id,
+            ChatMessage.create_date,
+            ChatMessage.id,
+        )
+    )
+    if chat_id is not None:
+        query = query.where(Chat.id == chat_id)
+
+    with Session(get_database_engine()) as db:
+        # yield_per streams the rows from a server-side cursor, one batch per round trip
+        result = db.execute(
+            query.execution_options(yield_per=CONFIG.chat_export_batch_size)
+        )
+
+        current_chat_id = None
+        for rows in result.partitions():
+            lines = []
+            for row in rows:
+                if row.chat_id != current_chat_id:
+                    current_chat_id = row.chat_id
+                    lines.append(
+                        ExportedChatModel(
+                            id=row.chat_id,
+                            name=row.name,
+                            language=row.language,
+                            model=row.model,
+                            create_date=row.chat_create_date,
+                        ).model_dump_json()
+                    )
+                if row.message_id is not None:
+                    lines.append(
+                        ExportedChatMessageModel(
+                            id=row.message_id,
+                            chat_id=row.chat_id,
+                            from_user=row.from_user,
+                            content=read_content(
+                                row.plain_content, row.compressed_content
+                            ),
+                            summary=row.summary,
+                            status=row.status,
+                            create_date=row.message_create_date,
+                        ).model_dump_json()
+                    )
+
+            # One write per batch of rows, rather than one per line
+            yield "\n".join(lines) + "\n"
+
+
+class _ChatImport:
+    """
+    Inserts the lines of an export into the database in batches. Chats get new ids, so a history can be imported
+        next to the chats that already exist, even into the deployment it was exported from.
+    """
+
+    def __init__(self, user: JwtUser, db: Session):
+        self._user = user
+        self._db = db
+
+        # Id of every imported chat in the export -> its id in this deployment
+        self._chat_ids: dict[UUID, UUID] = {}
+        self._chats: list[dict] = []
+        self._messages: list[dict] = []
+        self._line_number = 0
+
+        self.imported_chats = 0
+        self.imported_messages = 0
+
+    def add_lines(self, lines: list[bytes]):
+        """
+        :raises ValidationError: If a line is not part of a valid export
+        """
+        for line in lines:
+            self._line_number += 1
+            if not line.strip():
+                continue
+
+            try:
+                exported = _EXPORTED_LINE.validate_json(line)
+            except PydanticValidationError as e:
+                raise ValidationError(
+                    f"Line {self._line_number} is not a valid chat or message: {e.errors()[0]['msg']}"
+                )
+
+            if isinstance(exported, ExportedChatModel):
+                self._add_chat(exported)
+            else:
+                self._add_message(exported)
+
+            if len(self._chats) + len(self._messages) >= CONFIG.chat_import_batch_size:
+                self._flush()
+
+    def _add_chat(self, exported: ExportedChatModel):
+        if exported.id in self._chat_ids:
+            raise ValidationError(
+                f"Line {self._line_number}: Chat {exported.id} is included twice"
+            )
+        if exported.model is not None:
+            get_model_registry().validate_model_name(exported.model)
+
+        chat_id = uuid.uuid4()
+        self._chat_ids[exported.id] = chat_id
+        self._chats.append(
+            {
+                "id": chat_id,
+                "name": exported.name,
+                "language": exported.language,
+                "model": exported.model,
+                "user_id": self._user.id,
+                "create_date": exported.create_date,
+            }
+        )
+
+    def _add_message(self, exported: ExportedChatMessageModel):
+        chat_id = self._chat_ids.get(exported.chat_id)
+        if chat_id is None:
+            raise ValidationError(
+                f"Line {self._line_number}: Message {exported.id} comes before its chat {exported.chat_id}"
+            )
+
+        try:
+            status = ChatMessageStatus(exported.status)
+        except ValueError:
+            raise ValidationError(
+                f"Line {self._line_number}: Unknown message status {exported.status}"
+            )
+        # A reply that was being generated during the export will never be finished
+        if status == ChatMessageStatus.STREAMING:
+            status = ChatMessageStatus.ABORTED
+
+        self._messages.append(
+            {
+                "id": uuid.uuid4(),
+                "chat_id": chat_id,
+                **message_content_values(exported.content),
+                "search_text": exported.content,
+                "summary": exported.summary,
+                "from_user": exported.from_user,
+                "status": status,
+                "create_date": exported.create_date,
+            }
+        )
+
+    def _flush(self):
+        # Chats first, the messages of this batch may belong to them. A list of rows is inserted with executemany
+        if self._chats:
+            self._db.execute(insert(Chat), self._chats)
+            self.imported_chats += len(self._chats)
+            self._chats = []
+        if self._messages:
+            self._db.execute(_INSERT_MESSAGE, self._messages)
+            self.imported_messages += len(self._messages)
+            self._messages = []
+
+    def finish(self) -> ImportChatsResponseModel:
+        self._flush()
+        self._db.commit()
+
+        logger.info(
+            f"Imported {self.imported_chats} chats with {self.imported_messages} messages for user {self._user.id}"
+        )
+        return ImportChatsResponseModel(
+            chats=self.imported_chats, messages=self.imported_messages
+        )
+
+
+async def import_chats(
+    body: AsyncIterator[bytes], user: JwtUser, db: Session
+) -> ImportChatsResponseModel:
+    """
+    Imports chats from an export (see `export_chats`) into the chats of the user, while the export is still being
+        received. Either all chats of the export are imported or, if any line is invalid, none.
+
+    :raises ValidationError: If the export is not valid, or uses a model that is not available
+    """
+    chat_import = _ChatImport(user, db)
+
+    pending = b""
+    async for chunk in body:
+        *lines, pending = (pending + chunk).split(b"\n")
+        if lines:
+            await anyio.to_thread.run_sync(chat_import.add_lines, lines)
+
+    await anyio.to_thread.run_sync(chat_import.add_lines, [pending])
+    return await anyio.to_thread.run_sync(chat_import.finish)
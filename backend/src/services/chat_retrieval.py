@@ -0,0 +1,385 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, NamedTuple
+from uuid import UUID
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from src.config import CONFIG
+from src.data_models.chat import ChatMessage, ChatMessageStatus
+from src.database import get_database_engine
+from src.logs import get_logger
+from src.services.message_compression import read_content
+
+# torch is only imported once retrieval is enabled, see `initialize_retrieval`
+if TYPE_CHECKING:
+    import torch
+
+    from src.inference.client import InferenceClient, RemoteEmbeddingModel
+    from src.inference.embedding import ChatEmbeddingIndex, EmbeddingModel
+
+logger = get_logger(__name__)
+
+# Messages without an embedding that a request embeds itself when it indexes their chat. Chats with more of them are
+#   indexed in the background, in batches of this many messages, and their prompts only hold the newest messages
+#   until then
+SYNCHRONOUS_EMBEDDING_LIMIT = 32
+
+
+class RetrievalStatistics(NamedTuple):
+    cached_chats: int
+    cached_messages: int
+    cached_bytes: int
+    embedded_messages: int
+    failed_embeddings: int
+    retrievals: int
+    average_retrieval_seconds: float
+
+
+class ChatRetriever:
+    """
+    Finds the earlier turns of a chat that are most relevant to a new message, so the prompt can hold those and the
+        newest messages rather than as much of the history as fits.
+
+    Every message is embedded once and its embedding is saved with it: messages of the user while they are sent,
+        replies in the background once they are finished. Messages without an embedding, e.g. from before retrieval
+        was enabled or imported ones, are embedded when their chat is indexed, in the background if there are more
+        than `SYNCHRONOUS_EMBEDDING_LIMIT`. The embeddings of the `max_cached_chats` most recently used chats are
+        kept in memory, one `ChatEmbeddingIndex` per chat.
+    """
+
+    def __init__(
+        self,
+        embedding_model: "EmbeddingModel | RemoteEmbeddingModel",
+        max_cached_chats: int,
+    ):
+        self._model = embedding_model
+        self.max_cached_chats = max_cached_chats
+
+        self._lock = threading.Lock()
+        self._indexes: OrderedDict[UUID, "ChatEmbeddingIndex"] = OrderedDict()
+        # Messages added to chats while their index is built, they may be missing from what the build read
+        self._building: dict[UUID, list[tuple[UUID, bool, "torch.Tensor"]]] = {}
+        # Chats that are indexed in the background, as too many of their messages have to be embedded
+        self._backfilling: set[UUID] = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="embedding"
+        )
+
+        self._embedded_messages = 0
+        self._failed_embeddings = 0
+        self._retrievals = 0
+        self._total_retrieval_seconds = 0.0
+
+    def stop(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def embed(self, text: str) -> "torch.Tensor":
+        return self._model.embed([text])[0]
+
+    @staticmethod
+    def encode(vector: "torch.Tensor") -> bytes:
+        """
+        Encodes an embedding as it is saved in `ChatMessage.embedding`
+        """
+        from src.inference.embedding import encode_embedding
+
+        return encode_embedding(vector)
+
+    def add_message(
+        self, chat_id: UUID, message_id: UUID, from_user: bool, vector: "torch.Tensor"
+    ):
+        """
+        Adds an embedded message to the index of its chat, once the embedding is saved
+        """
+        with self._lock:
+            self._embedded_messages += 1
+
+            pending = self._building.get(chat_id)
+            if pending is not None:
+                pending.append((message_id, from_user, vector))
+
+            # Chats that are not cached include the message once they are indexed
+            index = self._indexes.get(chat_id)
+            if index is not None and message_id not in index:
+                index.add(message_id, from_user, vector)
+
+    def embed_message_later(
+        self, chat_id: UUID, message_id: UUID, from_user: bool, content: str
+    ):
+        self._executor.submit(
+            self._embed_message, chat_id, message_id, from_user, content
+        )
+
+    def relevant_message_ids(
+        self,
+        chat_id: UUID,
+        query: "torch.Tensor",
+        turns: int,
+        exclude: set[UUID],
+    ) -> list[UUID]:
+        """
+        :param query: Embedding of the new message
+        :param turns: Number of turns to find. Together with the best matching message, the other message of its turn
+            (the question of a reply, or the reply to a question) is returned
+        :param exclude: Messages that are already part of the prompt
+        :return: Ids of the messages, oldest first. Empty while the chat is indexed in the background
+        """
+        start = time.perf_counter()
+        index = self._get_index(chat_id, SYNCHRONOUS_EMBEDDING_LIMIT)
+        if index is None:
+            return []
+
+        with self._lock:
+            selected = set()
+            for position in index.most_similar(query, turns, exclude):
+                selected.add(position)
+                partner = position + 1 if index.from_user[position] else position - 1
+                if (
+                    0 <= partner < len(index)
+                    and index.from_user[partner] != index.from_user[position]
+                ):
+                    selected.add(partner)
+
+            message_ids = [
+                index.message_ids[position]
+                for position in sorted(selected)
+                if index.message_ids[position] not in exclude
+            ]
+
+            self._retrievals += 1
+            self._total_retrieval_seconds += time.perf_counter() - start
+
+        return message_ids
+
+    def statistics(self) -> RetrievalStatistics:
+        with self._lock:
+            return RetrievalStatistics(
+                cached_chats=len(self._indexes),
+                cached_messages=sum(len(index) for index in self._indexes.values()),
+                cached_bytes=sum(
+                    index.memory_bytes() for index in self._indexes.values()
+                ),
+                embedded_messages=self._embedded_messages,
+                failed_embeddings=self._failed_embeddings,
+                retrievals=self._retrievals,
+                average_retrieval_seconds=self._total_retrieval_seconds
+                / self._retrievals
+                if self._retrievals
+                else 0.0,
+            )
+
+    def _embed_message(
+        self, chat_id: UUID, message_id: UUID, from_user: bool, content: str
+    ):
+        from src.inference.embedding import encode_embedding
+
+        try:
+            vector = self.embed(content)
+            with Session(get_database_engine()) as db:
+                db.execute(
+                    update(ChatMessage)
+                    .where(ChatMessage.id == message_id)
+                    .values(embedding=encode_embedding(vector))
+                )
+                db.commit()
+        except Exception:
+            logger.exception(f"Failed to embed message {message_id}")
+            with self._lock:
+                self._failed_embeddings += 1
+            return
+
+        self.add_message(chat_id, message_id, from_user, vector)
+
+    def _get_index(
+        self, chat_id: UUID, max_missing: int | None
+    ) -> "ChatEmbeddingIndex | None":
+        """
+        :param max_missing: Number of messages without an embedding that may be embedded right away. Chats with more
+            are indexed in the background, None embeds all of them
+        :return: None if the chat is indexed in the background
+        """
+        with self._lock:
+            index = self._indexes.get(chat_id)
+            if index is not None:
+                self._indexes.move_to_end(chat_id)
+                return index
+            self._building.setdefault(chat_id, [])
+
+        # Built without holding the lock, it may have to embed messages
+        try:
+            index = self._build_index(chat_id, max_missing)
+        except BaseException:
+            with self._lock:
+                self._building.pop(chat_id, None)
+            raise
+
+        with self._lock:
+            if index is None:
+                # The messages added in the meantime are left for the background build
+                if chat_id not in self._backfilling:
+                    self._backfilling.add(chat_id)
+                    self._executor.submit(self._backfill_index, chat_id)
+                return None
+
+            for message_id, from_user, vector in self._building.pop(chat_id, []):
+                if message_id not in index:
+                    index.add(message_id, from_user, vector)
+
+            self._indexes[chat_id] = index
+            self._indexes.move_to_end(chat_id)
+            while len(self._indexes) > self.max_cached_chats:
+                self._indexes.popitem(last=False)
+
+        return index
+
+    def _backfill_index(self, chat_id: UUID):
+        try:
+            self._get_index(chat_id, None)
+        except Exception:
+            logger.exception(f"Failed to index chat {chat_id}")
+        finally:
+            with self._lock:
+                self._backfilling.discard(chat_id)
+
+    def _build_index(
+        self, chat_id: UUID, max_missing: int | None
+    ) -> "ChatEmbeddingIndex | None":
+        from src.inference.embedding import ChatEmbeddingIndex, decode_embedding
+
+        embedding_bytes = self._model.dimensions * 2
+        query = (
+            select(ChatMessage.id, ChatMessage.from_user, ChatMessage.embedding)
+            .where(
+                ChatMessage.chat_id == chat_id,
+                ChatMessage.status != ChatMessageStatus.STREAMING,
+            )
+            .order_by(ChatMessage.create_date, ChatMessage.id)
+        )
+        with Session(get_database_engine()) as db:
+            rows = db.execute(query).all()
+
+        # Embeddings of another embedding model (of a different size) are replaced as well
+        missing = [
+            row
+            for row in rows
+            if row.embedding is None or len(row.embedding) != embedding_bytes
+        ]
+        if max_missing is not None and len(missing) > max_missing:
+            return None
+
+        vectors = {}
+        # Saved batch by batch, so what is embedded is kept if indexing a long chat is interrupted
+        for start in range(0, len(missing), SYNCHRONOUS_EMBEDDING_LIMIT):
+            vectors.update(
+                self._embed_messages(
+                    [
+                        row.id
+                        for row in missing[start : start + SYNCHRONOUS_EMBEDDING_LIMIT]
+                    ]
+                )
+            )
+        if missing:
+            logger.info(f"Embedded {len(missing)} messages of chat {chat_id}")
+
+        index = ChatEmbeddingIndex(self._model.dimensions, capacity=max(len(rows), 16))
+        for row in rows:
+            vector = vectors.get(row.id)
+            index.add(
+                row.id,
+                row.from_user,
+                vector if vector is not None else decode_embedding(row.embedding),
+            )
+
+        with self._lock:
+            self._embedded_messages += len(missing)
+        return index
+
+    def _embed_messages(self, message_ids: list[UUID]) -> dict[UUID, "torch.Tensor"]:
+        """
+        Embeds the messages and saves their embeddings
+        """
+        from src.inference.embedding import encode_embedding
+
+        # The content is only read for the messages that have to be embedded
+        with Session(get_database_engine()) as db:
+            contents = {
+                row.id: read_content(row.plain_content, row.compressed_content)
+                for row in db.execute(
+                    select(
+                        ChatMessage.id,
+                        ChatMessage.plain_content,
+                        ChatMessage.compressed_content,
+                    ).where(ChatMessage.id.in_(message_ids))
+                )
+            }
+
+        embedded = self._model.embed(
+            [contents[message_id] for message_id in message_ids]
+        )
+        vectors = dict(zip(message_ids, embedded))
+        with Session(get_database_engine()) as db:
+            db.execute(
+                update(ChatMessage),
+                [
+                    {"id": message_id, "embedding": encode_embedding(vector)}
+                    for message_id, vector in vectors.items()
+                ],
+            )
+            db.commit()
+        return vectors
+
+
+CHAT_RETRIEVER: ChatRetriever | None = None
+# Connection to the inference server, which runs the embedding model when one is configured
+_EMBEDDING_CLIENT: "InferenceClient | None" = None
+
+
+def initialize_retrieval():
+    global CHAT_RETRIEVER, _EMBEDDING_CLIENT
+
+    if CONFIG.embedding_model_path is None:
+        return
+
+    start = time.perf_counter()
+    if CONFIG.inference_socket is not None:
+        # The inference server loads the embedding model once for all web workers. This connection is separate from
+        #   the one of the models, so retrieval can start up at the same time as them
+        from src.inference.client import InferenceClient, RemoteEmbeddingModel
+
+        _EMBEDDING_CLIENT = InferenceClient(
+            CONFIG.inference_socket, CONFIG.inference_connect_timeout_seconds
+        )
+        embedding_model = RemoteEmbeddingModel(_EMBEDDING_CLIENT)
+    else:
+        from src.inference.embedding import EmbeddingModel
+
+        embedding_model = EmbeddingModel(CONFIG.embedding_model_path)
+
+    CHAT_RETRIEVER = ChatRetriever(embedding_model, CONFIG.retrieval_cached_chats)
+    logger.info(
+        f"Loaded embedding model {CONFIG.embedding_model_path} in {time.perf_counter() - start:.1f}s "
+        f"({embedding_model.dimensions} dimensions)"
+    )
+
+
+def shutdown_retrieval():
+    global CHAT_RETRIEVER, _EMBEDDING_CLIENT
+
+    if CHAT_RETRIEVER is not None:
+        CHAT_RETRIEVER.stop()
+        CHAT_RETRIEVER = None
+    if _EMBEDDING_CLIENT is not None:
+        _EMBEDDING_CLIENT.close()
+        _EMBEDDING_CLIENT = None
+
+
+def embed_chat_message(chat_id: UUID, message_id: UUID, from_user: bool, content: str):
+    """
+    Queues the message to have its embedding computed and saved in the background, if retrieval is enabled
+    """
+    if CHAT_RETRIEVER is not None:
+        CHAT_RETRIEVER.embed_message_later(chat_id, message_id, from_user, content)
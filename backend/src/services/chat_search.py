@@ -0,0 +1,190 @@
+import html
+from uuid import UUID
+
+from sqlalchemy import (
+    ColumnElement,
+    Float,
+    Row,
+    Text,
+    Uuid,
+    and_,
+    case,
+    cast,
+    func,
+    literal,
+    literal_column,
+    null,
+    select,
+    tuple_,
+    union_all,
+)
+from sqlalchemy.orm import Session
+
+from src.data_models.chat import SEARCH_CONFIGURATION, Chat, ChatMessage
+from src.models.chat import ChatSearchPageResponseModel, ChatSearchResultModel
+from src.services.message_compression import read_content
+from src.services.user import JwtUser
+from src.util.pagination import decode_rank_cursor, encode_rank_cursor
+
+# Same configuration the search vectors are built with, or words would be stemmed differently than in the index
+_CONFIGURATION = literal_column(f"'{SEARCH_CONFIGURATION}'::regconfig")
+
+# ts_headline doesn't escape the text, the matches are marked with characters of the private use area instead of
+#   tags, which are replaced with <mark> tags once the snippet is escaped (see `_highlighted_snippet`)
+_MATCH_START = "\ue000"
+_MATCH_STOP = "\ue001"
+# Up to two fragments of the text around the matches, a whole short text if it has no better fragments
+_SNIPPET_OPTIONS = (
+    f"StartSel={_MATCH_START}, StopSel={_MATCH_STOP}, "
+    "MaxFragments=2, MaxWords=25, MinWords=10"
+)
+
+
+def search_chats(
+    query: str,
+    user: JwtUser,
+    db: Session,
+    cursor: str | None = None,
+    limit: int = 25,
+) -> ChatSearchPageResponseModel:
+    """
+    Searches the names of the user's chats and the content of their messages, best matches first. The query
+        supports the syntax of web search engines: "quoted phrases", `or` and `-excluded` words.
+
+    Matches are found through the GIN indexes on the search vectors. The ranked page is selected first, the snippets
+        are only built for the results on it.
+
+    :param cursor: Cursor returned for a previous page, to continue after its last result
+    :raises ValidationError: If the cursor is not valid
+    """
+    ts_query = func.websearch_to_tsquery(_CONFIGURATION, query)
+
+    message_hits = (
+        select(
+            ChatMessage.id.label("id"),
+            ChatMessage.chat_id.label("chat_id"),
+            ChatMessage.id.label("message_id"),
+            cast(func.ts_rank_cd(ChatMessage.search_vector, ts_query), Float).label(
+                "rank"
+            ),
+        )
+        .join(Chat, Chat.id == ChatMessage.chat_id)
+        .where(
+            and_(
+                Chat.user_id == user.id,
+                ChatMessage.search_vector.op("@@")(ts_query),
+            )
+        )
+    )
+    chat_hits = select(
+        Chat.id.label("id"),
+        Chat.id.label("chat_id"),
+        cast(null(), Uuid).label("message_id"),
+        cast(func.ts_rank_cd(Chat.search_vector, ts_query), Float).label("rank"),
+    ).where(and_(Chat.user_id == user.id, Chat.search_vector.op("@@")(ts_query)))
+    hits = union_all(message_hits, chat_hits).subquery()
+
+    page_query = (
+        select(hits).order_by(hits.c.rank.desc(), hits.c.id.desc()).limit(limit + 1)
+    )
+    if cursor is not None:
+        cursor_rank, cursor_id = decode_rank_cursor(cursor)
+        page_query = page_query.where(
+            tuple_(hits.c.rank, hits.c.id) < tuple_(cursor_rank, cursor_id)
+        )
+    page = page_query.subquery()
+
+    # The snippets of compressed messages are built from their decompressed text below
+    snippet = case(
+        (
+            page.c.message_id.is_(None),
+            func.ts_headline(_CONFIGURATION, Chat.name, ts_query, _SNIPPET_OPTIONS),
+        ),
+        (
+            ChatMessage.plain_content.is_not(None),
+            func.ts_headline(
+                _CONFIGURATION, ChatMessage.plain_content, ts_query, _SNIPPET_OPTIONS
+            ),
+        ),
+        else_=null(),
+    )
+    results_query = (
+        select(
+            page.c.id,
+            page.c.chat_id,
+            page.c.message_id,
+            page.c.rank,
+            Chat.name,
+            ChatMessage.from_user,
+            func.coalesce(ChatMessage.create_date, Chat.create_date).label(
+                "create_date"
+            ),
+            snippet.label("snippet"),
+            ChatMessage.compressed_content,
+        )
+        .select_from(page)
+        .join(Chat, Chat.id == page.c.chat_id)
+        .outerjoin(ChatMessage, ChatMessage.id == page.c.message_id)
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+    rows = db.execute(results_query).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_rank_cursor(rows[-1].rank, rows[-1].id)
+
+    snippets = _compressed_message_snippets(rows, ts_query, db)
+    return ChatSearchPageResponseModel(
+        items=[
+            ChatSearchResultModel(
+                chat_id=row.chat_id,
+                chat_name=row.name,
+                message_id=row.message_id,
+                from_user=row.from_user,
+                snippet=_highlighted_snippet(snippets.get(row.id, row.snippet)),
+                rank=row.rank,
+                create_date=row.create_date,
+            )
+            for row in rows
+        ],
+        next_cursor=next_cursor,
+    )
+
+
+def _highlighted_snippet(headline: str) -> str:
+    """
+    HTML escapes the snippet built by ts_headline, with its matches in <mark> tags
+    """
+    return (
+        html.escape(headline)
+        .replace(_MATCH_START, "<mark>")
+        .replace(_MATCH_STOP, "</mark>")
+    )
+
+
+def _compressed_message_snippets(
+    rows: list[Row], ts_query: ColumnElement, db: Session
+) -> dict[UUID, str]:
+    """
+    Builds the snippets of the compressed messages among the results, from their decompressed text. All in one query,
+        as one column per message
+    """
+    compressed = [row for row in rows if row.compressed_content is not None]
+    if not compressed:
+        return {}
+
+    snippets = db.execute(
+        select(
+            *(
+                func.ts_headline(
+                    _CONFIGURATION,
+                    literal(read_content(None, row.compressed_content), Text),
+                    ts_query,
+                    _SNIPPET_OPTIONS,
+                )
+                for row in compressed
+            )
+        )
+    ).one()
+    return {row.id: snippet for row, snippet in zip(compressed, snippets)}
@@ -0,0 +1,491 @@
+import asyncio
+import contextlib
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from enum import StrEnum
+from typing import AsyncIterator
+from uuid import UUID
+
+import anyio
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from src.ai_models import get_inference_client
+from src.config import CONFIG
+from src.data_models.base import generate_current_date
+from src.data_models.chat import ChatMessage, ChatMessageStatus
+from src.database import get_database_engine
+from src.inference.generation import GenerationStream
+from src.logs import get_logger
+from src.metrics import (
+    GENERATION_ACTIVE,
+    GENERATION_CANCELLED,
+    GENERATION_CANCELLED_UNUSED_TOKENS,
+    GENERATION_DURATION,
+    GENERATION_FINISHED,
+    GENERATION_TIME_TO_FIRST_TOKEN,
+    GENERATION_TOKENS,
+    GENERATION_TOKENS_PER_SECOND,
+)
+from src.services.chat_retrieval import embed_chat_message
+from src.services.message_writer import (
+    MessageWrite,
+    save_messages_async,
+    submit_messages,
+    write_messages_now,
+)
+from src.services.summarization import summarize_chat_message
+from src.util.stream_framing import StreamEvent
+
+logger = get_logger(__name__)
+
+# How long a new reply may go without any client streaming it before it counts as abandoned, e.g. because the client
+#   disconnected before the response started. Never shorter than `generation_disconnect_grace_seconds`
+FIRST_SUBSCRIBER_TIMEOUT_SECONDS = 10.0
+# A streaming reply that has not been saved for this many checkpoint intervals was left behind by a process that
+#   stopped (crashed, was killed or redeployed), and is marked as aborted. Every process saves the checkpoint date of
+#   the replies it is generating a few times within that time, also while they wait for their first token
+ABANDONED_AFTER_CHECKPOINT_INTERVALS = 10
+ABANDONED_SWEEPS_PER_PERIOD = 4
+
+
+class CancelReason(StrEnum):
+    # No client streamed the reply for `generation_disconnect_grace_seconds`
+    CLIENT_DISCONNECTED = "client_disconnected"
+    # The user asked to stop the reply
+    USER_REQUEST = "user_request"
+
+
+class LiveGeneration:
+    """
+    An assistant reply that is currently being generated.
+
+    The reply is read from the generation stream by a background task, independently of any client. That task keeps
+        the whole reply in memory for clients to (re)attach to, and checkpoints it into the reply's `ChatMessage` every
+        `message_checkpoint_interval_seconds` or `message_checkpoint_characters`, whichever comes first. A dropped
+        connection therefore neither stops the generation nor loses what has been generated so far.
+
+    Once no client has been streaming the reply for `generation_disconnect_grace_seconds`, nobody is waiting for it
+        anymore and the generation is cancelled, as it is when the user stops it. What was generated until then is
+        saved as an aborted reply.
+    """
+
+    def __init__(
+        self, chat_id: UUID, message_id: UUID, results_stream: GenerationStream
+    ):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.cancel_reason: CancelReason | None = None
+        # Final status of the reply, once it is finished
+        self.status: ChatMessageStatus | None = None
+
+        self._results_stream = results_stream
+        self._parts: list[str] = []
+        self._length = 0
+        self._finished = False
+        self._error: Exception | None = None
+        self._changed = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+        # Last checkpoint handed to the message writer, done once it is committed
+        self._checkpoint: Future | None = None
+
+        self._subscribers = 0
+        self._abandoned_check: asyncio.TimerHandle | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._schedule_abandoned_check(
+            max(
+                FIRST_SUBSCRIBER_TIMEOUT_SECONDS,
+                CONFIG.generation_disconnect_grace_seconds,
+            )
+        )
+
+    def cancel(self, reason: CancelReason) -> bool:
+        """
+        Stops generating the reply, the stream of every client ends with what was generated so far
+
+        :return: False if the reply was already finished or cancelled
+        """
+        if self._finished or self.cancel_reason is not None:
+            return False
+
+        self._results_stream.cancel()
+        self._record_cancel(reason)
+        return True
+
+    def _record_cancel(self, reason: CancelReason):
+        self.cancel_reason = reason
+        GENERATION_CANCELLED.labels(reason).inc()
+        logger.info(f"Cancelled generation of message {self.message_id} ({reason})")
+
+    def _schedule_abandoned_check(self, delay_seconds: float):
+        if self._abandoned_check is not None:
+            self._abandoned_check.cancel()
+        self._abandoned_check = asyncio.get_running_loop().call_later(
+            delay_seconds, self._cancel_if_abandoned
+        )
+
+    def _cancel_if_abandoned(self):
+        self._abandoned_check = None
+        if self._subscribers == 0:
+            self.cancel(CancelReason.CLIENT_DISCONNECTED)
+
+    async def wait(self):
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def subscribe(self, offset: int = 0) -> AsyncIterator[str]:
+        """
+        Streams the reply, starting with everything generated so far and following along until it is finished
+
+        :param offset: Number of characters of the reply the client already has, these are skipped
+        """
+        index = 0
+        position = 0
+        sent_text = False
+
+        self._subscribers += 1
+        if self._abandoned_check is not None:
+            self._abandoned_check.cancel()
+            self._abandoned_check = None
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: index < len(self._parts) or self._finished
+                    )
+                    # The first text goes out right away, after that text is collected into larger chunks, so a
+                    #   stream doesn't cost one write per token
+                    if sent_text:
+                        await self._wait_for_more_text(position)
+                    parts = self._parts[index:]
+                    finished = self._finished
+
+                if parts:
+                    index += len(parts)
+                    chunk = "".join(parts)
+                    chunk_start = position
+                    position += len(chunk)
+                    if position > offset:
+                        sent_text = True
+                        yield chunk[max(offset - chunk_start, 0) :]
+                    continue
+
+                if finished:
+                    if self._error is not None:
+                        raise self._error
+                    return
+        finally:
+            # Runs as well when the response is cancelled because its client disconnected
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self._finished:
+                self._schedule_abandoned_check(
+                    CONFIG.generation_disconnect_grace_seconds
+                )
+
+    async def _wait_for_more_text(self, position: int):
+        # Must be called with the condition held
+        if CONFIG.stream_coalesce_seconds <= 0:
+            return
+
+        with contextlib.suppress(TimeoutError):
+            async with asyncio.timeout(CONFIG.stream_coalesce_seconds):
+                await self._changed.wait_for(
+                    lambda: (
+                        self._length - position >= CONFIG.stream_coalesce_characters
+                        or self._finished
+                    )
+                )
+
+    async def events(self, offset: int = 0) -> AsyncIterator[StreamEvent]:
+        """
+        Streams the reply like `subscribe`, as the events of the framed stream formats
+        """
+        yield StreamEvent(
+            "message", {"message_id": str(self.message_id), "offset": offset}
+        )
+        try:
+            async for text in self.subscribe(offset):
+                yield StreamEvent("delta", {"text": text})
+        except Exception:
+            yield StreamEvent("error", {"detail": "Generating the reply failed"})
+            return
+
+        yield StreamEvent(
+            "end",
+            {
+                "message_id": str(self.message_id),
+                "status": self.status,
+                "usage": {
+                    "prompt_tokens": self._results_stream.prompt_tokens,
+                    "completion_tokens": self._results_stream.generated_tokens,
+                },
+            },
+        )
+
+    async def _append(self, text: str):
+        async with self._changed:
+            self._parts.append(text)
+            self._length += len(text)
+            self._changed.notify_all()
+
+    async def _close(self, error: Exception | None = None):
+        if self._abandoned_check is not None:
+            self._abandoned_check.cancel()
+            self._abandoned_check = None
+
+        async with self._changed:
+            self._error = error
+            self._finished = True
+            self._changed.notify_all()
+
+    async def _run(self):
+        saved_length = 0
+        last_checkpoint = time.monotonic()
+        first_text_at = None
+
+        GENERATION_ACTIVE.inc()
+        try:
+            async for text in self._results_stream:
+                if first_text_at is None:
+                    first_text_at = time.perf_counter()
+                    GENERATION_TIME_TO_FIRST_TOKEN.observe(
+                        first_text_at - self._results_stream.created_at
+                    )
+                await self._append(text)
+
+                if (
+                    self._length - saved_length >= CONFIG.message_checkpoint_characters
+                    or time.monotonic() - last_checkpoint
+                    >= CONFIG.message_checkpoint_interval_seconds
+                ):
+                    # A skipped checkpoint is due again with the next text
+                    if await self._save_checkpoint():
+                        saved_length = self._length
+                        last_checkpoint = time.monotonic()
+        except asyncio.CancelledError:
+            # The event loop is going away, so there is no worker thread left to save from. The message writer is
+            #   only shut down after the live generations, it still saves what is queued
+            write = _message_write(
+                self.message_id, "".join(self._parts), ChatMessageStatus.ABORTED
+            )
+            if submit_messages(write) is None:
+                self._wait_for_checkpoint()
+                write_messages_now(write)
+            LIVE_GENERATIONS.pop(self.message_id, None)
+            GENERATION_FINISHED.labels(ChatMessageStatus.ABORTED).inc()
+            raise
+        except Exception as e:
+            logger.exception(f"Generation of message {self.message_id} failed")
+            await self._finish(ChatMessageStatus.ABORTED, e)
+            return
+        finally:
+            GENERATION_ACTIVE.dec()
+            self._record_metrics(first_text_at)
+
+        if self.cancel_reason is None and self._results_stream.cancelled:
+            # The user stopped the reply through another web worker, see `cancel_remote_generations`
+            self._record_cancel(CancelReason.USER_REQUEST)
+
+        if self.cancel_reason is not None:
+            GENERATION_CANCELLED_UNUSED_TOKENS.inc(
+                max(
+                    CONFIG.generation_max_new_tokens
+                    - self._results_stream.generated_tokens,
+                    0,
+                )
+            )
+            await self._finish(ChatMessageStatus.ABORTED)
+        else:
+            await self._finish(ChatMessageStatus.COMPLETE)
+
+    def _record_metrics(self, first_text_at: float | None):
+        finished_at = time.perf_counter()
+        generated_tokens = self._results_stream.generated_tokens
+
+        GENERATION_DURATION.observe(finished_at - self._results_stream.created_at)
+        GENERATION_TOKENS.inc(generated_tokens)
+        if first_text_at is not None and finished_at > first_text_at:
+            GENERATION_TOKENS_PER_SECOND.observe(
+                (generated_tokens - 1) / (finished_at - first_text_at)
+            )
+
+    async def _save_checkpoint(self) -> bool:
+        """
+        :return: False if the checkpoint was skipped
+        """
+        # Only one checkpoint is queued at a time, while the previous one is not committed yet the reply is saved with
+        #   the next one. The writer never falls behind by more than one write per reply that way
+        if self._checkpoint is not None and not self._checkpoint.done():
+            return False
+
+        write = _message_write(
+            self.message_id, "".join(self._parts), ChatMessageStatus.STREAMING
+        )
+        self._checkpoint = submit_messages(write)
+        if self._checkpoint is None:
+            await save_messages_async(write)
+        return True
+
+    def _wait_for_checkpoint(self):
+        # A write that is saved right away must not be overwritten by an older checkpoint the writer commits after it
+        if self._checkpoint is not None:
+            with contextlib.suppress(Exception):
+                self._checkpoint.result()
+
+    async def _finish(self, status: ChatMessageStatus, error: Exception | None = None):
+        content = "".join(self._parts)
+        self.status = status
+        try:
+            if self._checkpoint is not None:
+                with contextlib.suppress(Exception):
+                    await asyncio.wrap_future(self._checkpoint)
+            await save_messages_async(_message_write(self.message_id, content, status))
+        finally:
+            # Only unregister once the final content is saved, so a client that no longer finds the live generation
+            #   always reads the finished message from the database
+            LIVE_GENERATIONS.pop(self.message_id, None)
+            await self._close(error)
+
+        GENERATION_FINISHED.labels(status).inc()
+        if status == ChatMessageStatus.COMPLETE:
+            summarize_chat_message(self.message_id, content)
+        if content:
+            embed_chat_message(self.chat_id, self.message_id, False, content)
+
+
+def _message_write(
+    message_id: UUID, content: str, status: ChatMessageStatus
+) -> MessageWrite:
+    return MessageWrite(message_updates={message_id: (content, status)})
+
+
+LIVE_GENERATIONS: dict[UUID, LiveGeneration] = {}
+
+
+def start_live_generation(
+    chat_id: UUID, message_id: UUID, results_stream: GenerationStream
+) -> LiveGeneration:
+    """
+    Starts reading the generation stream into the given (already saved) assistant message. Must be called from the
+        event loop.
+    """
+    live_generation = LiveGeneration(chat_id, message_id, results_stream)
+    LIVE_GENERATIONS[message_id] = live_generation
+    live_generation.start()
+
+    return live_generation
+
+
+def get_live_generation(message_id: UUID) -> LiveGeneration | None:
+    return LIVE_GENERATIONS.get(message_id)
+
+
+def get_live_generations_of_chat(chat_id: UUID) -> list[LiveGeneration]:
+    return [
+        live_generation
+        for live_generation in list(LIVE_GENERATIONS.values())
+        if live_generation.chat_id == chat_id
+    ]
+
+
+def cancel_remote_generations(chat_id: UUID) -> int | None:
+    """
+    Cancels the replies of the chat that other web workers generate, through the inference server. Blocks until the
+        server has cancelled them, the web workers that generate them save them as aborted shortly after
+
+    :return: Number of cancelled replies, None without an inference server, there is no way to reach the processes
+        that generate them then
+    """
+    inference_client = get_inference_client()
+    if inference_client is None:
+        return None
+    return inference_client.cancel_session(chat_id)
+
+
+async def wait_for_live_generations():
+    """
+    Waits until all live generations have saved their final state. Once the schedulers are stopped, this is right
+        after they have been marked as aborted.
+    """
+    for live_generation in list(LIVE_GENERATIONS.values()):
+        await live_generation.wait()
+
+
+def abort_abandoned_replies(live_message_ids: list[UUID]) -> int:
+    """
+    Marks streaming replies that have not been saved for `ABANDONED_AFTER_CHECKPOINT_INTERVALS` checkpoint intervals
+        as aborted. The checkpoint date of the replies this process is generating is saved first, so they never count
+        as abandoned
+
+    :param live_message_ids: Ids of the replies this process is generating
+    :return: Number of replies that were aborted
+    """
+    now = generate_current_date()
+    abandoned_before = now - timedelta(
+        seconds=CONFIG.message_checkpoint_interval_seconds
+        * ABANDONED_AFTER_CHECKPOINT_INTERVALS
+    )
+    with Session(get_database_engine()) as db:
+        if live_message_ids:
+            db.execute(
+                update(ChatMessage)
+                .where(
+                    ChatMessage.id.in_(live_message_ids),
+                    ChatMessage.status == ChatMessageStatus.STREAMING,
+                )
+                .values(checkpoint_date=now)
+            )
+        aborted = db.execute(
+            update(ChatMessage)
+            .where(
+                ChatMessage.status == ChatMessageStatus.STREAMING,
+                ChatMessage.checkpoint_date < abandoned_before,
+            )
+            .values(status=ChatMessageStatus.ABORTED)
+        ).rowcount
+        db.commit()
+
+    if aborted:
+        logger.info(f"Marked {aborted} abandoned replies as aborted")
+    return aborted
+
+
+async def _sweep_abandoned_replies():
+    period_seconds = (
+        CONFIG.message_checkpoint_interval_seconds
+        * ABANDONED_AFTER_CHECKPOINT_INTERVALS
+        / ABANDONED_SWEEPS_PER_PERIOD
+    )
+    while True:
+        try:
+            await anyio.to_thread.run_sync(
+                abort_abandoned_replies, list(LIVE_GENERATIONS)
+            )
+        except Exception:
+            logger.exception("Failed to abort abandoned replies")
+        await asyncio.sleep(period_seconds)
+
+
+_ABANDONED_REPLY_SWEEP: asyncio.Task | None = None
+
+
+def start_abandoned_reply_sweep():
+    """
+    Starts aborting abandoned replies periodically, see `abort_abandoned_replies`. Must be called from the event loop
+    """
+    global _ABANDONED_REPLY_SWEEP
+
+    _ABANDONED_REPLY_SWEEP = asyncio.create_task(_sweep_abandoned_replies())
+
+
+async def stop_abandoned_reply_sweep():
+    global _ABANDONED_REPLY_SWEEP
+
+    if _ABANDONED_REPLY_SWEEP is not None:
+        _ABANDONED_REPLY_SWEEP.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _ABANDONED_REPLY_SWEEP
+        _ABANDONED_REPLY_SWEEP = None
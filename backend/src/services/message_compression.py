@@ -0,0 +1,226 @@
+import argparse
+import threading
+import time
+from typing import Any, NamedTuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from src.config import CONFIG
+from src.data_models.chat import (
+    ChatMessage,
+    ChatMessageStatus,
+    MessageCompressionDictionary,
+)
+from src.database import get_database_engine, initialize_database_engine
+from src.logs import configure_logging, get_logger
+from src.util import dictionary_compression
+from src.util.dictionary_compression import NO_DICTIONARY
+
+logger = get_logger(__name__)
+
+
+class CompressionStatistics(NamedTuple):
+    dictionary_version: int
+    compressed_messages: int
+    original_bytes: int
+    compressed_bytes: int
+    average_compress_seconds: float
+    decompressed_messages: int
+    average_decompress_seconds: float
+
+
+class MessageCompressor:
+    """
+    Compresses and decompresses the content of messages with the dictionaries saved in the database. New content is
+        compressed with the newest dictionary. The dictionaries are loaded on startup, and again when content was
+        compressed with one that was trained later (e.g. content saved by another worker).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dictionaries: dict[int, bytes] = {NO_DICTIONARY: b""}
+        self._version = NO_DICTIONARY
+
+        self._compressed_messages = 0
+        self._original_bytes = 0
+        self._compressed_bytes = 0
+        self._total_compress_seconds = 0.0
+        self._decompressed_messages = 0
+        self._total_decompress_seconds = 0.0
+
+    def load_dictionaries(self):
+        with Session(get_database_engine()) as db:
+            rows = db.execute(
+                select(
+                    MessageCompressionDictionary.version,
+                    MessageCompressionDictionary.data,
+                )
+            ).all()
+
+        with self._lock:
+            self._dictionaries.update((row.version, row.data) for row in rows)
+            self._version = max(self._dictionaries)
+
+    def compress(self, content: str) -> bytes:
+        start = time.perf_counter()
+        with self._lock:
+            version = self._version
+            dictionary = self._dictionaries[version]
+
+        compressed = dictionary_compression.compress(content, version, dictionary)
+
+        with self._lock:
+            self._compressed_messages += 1
+            self._original_bytes += len(content.encode())
+            self._compressed_bytes += len(compressed)
+            self._total_compress_seconds += time.perf_counter() - start
+        return compressed
+
+    def decompress(self, data: bytes) -> str:
+        start = time.perf_counter()
+        version = dictionary_compression.dictionary_version(data)
+        with self._lock:
+            dictionary = self._dictionaries.get(version)
+        if dictionary is None:
+            self.load_dictionaries()
+            with self._lock:
+                dictionary = self._dictionaries.get(version)
+            if dictionary is None:
+                raise RuntimeError(f"Unknown compression dictionary {version}")
+
+        content = dictionary_compression.decompress(data, dictionary)
+
+        with self._lock:
+            self._decompressed_messages += 1
+            self._total_decompress_seconds += time.perf_counter() - start
+        return content
+
+    def statistics(self) -> CompressionStatistics:
+        with self._lock:
+            return CompressionStatistics(
+                dictionary_version=self._version,
+                compressed_messages=self._compressed_messages,
+                original_bytes=self._original_bytes,
+                compressed_bytes=self._compressed_bytes,
+                average_compress_seconds=self._total_compress_seconds
+                / self._compressed_messages
+                if self._compressed_messages
+                else 0.0,
+                decompressed_messages=self._decompressed_messages,
+                average_decompress_seconds=self._total_decompress_seconds
+                / self._decompressed_messages
+                if self._decompressed_messages
+                else 0.0,
+            )
+
+
+MESSAGE_COMPRESSOR = MessageCompressor()
+
+
+def load_compression_dictionaries():
+    MESSAGE_COMPRESSOR.load_dictionaries()
+    logger.info(
+        f"Compressing messages with dictionary {MESSAGE_COMPRESSOR.statistics().dictionary_version}"
+    )
+
+
+def message_content_values(content: str, compress: bool = True) -> dict[str, Any]:
+    """
+    Values of the content columns of a message with the given text. It is compressed if it has at least
+        `CC_MESSAGE_COMPRESSION_MIN_CHARACTERS` characters and gets smaller that way. The search vector has to be saved
+        along with them, see `message_search_vector`.
+
+    :param compress: False for content that is replaced soon, like the checkpoints of a reply that is being generated
+    """
+    if (
+        compress
+        and CONFIG.message_compression_min_characters
+        and len(content) >= CONFIG.message_compression_min_characters
+    ):
+        compressed = MESSAGE_COMPRESSOR.compress(content)
+        if len(compressed) < len(content.encode()):
+            return {
+                "plain_content": None,
+                "compressed_content": compressed,
+                "content_length": len(content),
+            }
+
+    return {
+        "plain_content": content,
+        "compressed_content": None,
+        "content_length": len(content),
+    }
+
+
+def decompress_content(data: bytes) -> str:
+    return MESSAGE_COMPRESSOR.decompress(data)
+
+
+def read_content(plain_content: str | None, compressed_content: bytes | None) -> str:
+    """
+    Text of a message from its `plain_content` and `compressed_content` columns, for queries that select those rather
+        than the whole `ChatMessage`
+    """
+    if plain_content is not None:
+        return plain_content
+    return MESSAGE_COMPRESSOR.decompress(compressed_content)
+
+
+def train_message_dictionary(sample_size: int) -> int | None:
+    """
+    Trains a new dictionary on the newest finished messages that are long enough to be compressed, and saves it. It is
+        used for new content once the app is restarted.
+
+    :return: Version of the new dictionary, None if the messages have nothing in common to train on
+    """
+    query = (
+        select(ChatMessage.plain_content, ChatMessage.compressed_content)
+        .where(
+            ChatMessage.status != ChatMessageStatus.STREAMING,
+            ChatMessage.content_length >= CONFIG.message_compression_min_characters,
+        )
+        .order_by(ChatMessage.create_date.desc())
+        .limit(sample_size)
+    )
+    with Session(get_database_engine()) as db:
+        samples = [read_content(*row) for row in db.execute(query)]
+        dictionary = dictionary_compression.train_dictionary(samples)
+        if not dictionary:
+            return None
+
+        version = (
+            db.scalar(select(func.max(MessageCompressionDictionary.version)))
+            or NO_DICTIONARY
+        ) + 1
+        db.add(
+            MessageCompressionDictionary(
+                version=version, data=dictionary, sample_messages=len(samples)
+            )
+        )
+        db.commit()
+
+    logger.info(
+        f"Trained compression dictionary {version} ({len(dictionary)} bytes) on {len(samples)} messages"
+    )
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Trains a new dictionary to compress messages with, on the newest messages"
+    )
+    parser.add_argument(
+        "--sample-size", type=int, default=2000, help="Messages to train on"
+    )
+    arguments = parser.parse_args()
+
+    configure_logging()
+    initialize_database_engine()
+    load_compression_dictionaries()
+    if train_message_dictionary(arguments.sample_size) is None:
+        logger.warning("The messages have nothing in common to train a dictionary on")
+
+
+if __name__ == "__main__":
+    main()
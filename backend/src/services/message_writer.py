@@ -0,0 +1,358 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, NamedTuple
+from uuid import UUID
+
+import anyio
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import Session
+
+from src.config import CONFIG
+from src.data_models.base import generate_current_date
+from src.data_models.chat import (
+    Chat,
+    ChatMessage,
+    ChatMessageStatus,
+    message_search_vector,
+)
+from src.database import get_database_engine
+from src.logs import get_logger
+from src.services.message_compression import message_content_values
+
+logger = get_logger(__name__)
+
+# The search vector is computed from the text of each row, also when the row only holds the compressed content
+_INSERT_MESSAGE = insert(ChatMessage).values(
+    search_vector=message_search_vector(bindparam("search_text"))
+)
+
+
+class MessageWrite(NamedTuple):
+    """
+    Chats and messages to save together, in one transaction. New messages hold their text in `content` (it is
+        compressed when written), updates replace the content and status of an existing message.
+    """
+
+    new_chats: tuple[dict[str, Any], ...] = ()
+    new_messages: tuple[dict[str, Any], ...] = ()
+    # Message id -> (content, status)
+    message_updates: dict[UUID, tuple[str, ChatMessageStatus]] = {}
+
+
+class MessageWriterStatistics(NamedTuple):
+    queue_depth: int
+    queued_writes: int
+    synchronous_writes: int
+    failed_writes: int
+    coalesced_updates: int
+    commits: int
+    average_batch_size: float
+    average_commit_seconds: float
+    max_wait_seconds: float
+
+
+def _message_row(message: dict[str, Any]) -> dict[str, Any]:
+    content = message["content"]
+    return {
+        "id": message["id"],
+        "chat_id": message["chat_id"],
+        "from_user": message["from_user"],
+        "status": message["status"],
+        "create_date": message["create_date"],
+        "checkpoint_date": generate_current_date()
+        if message["status"] == ChatMessageStatus.STREAMING
+        else None,
+        "embedding": message.get("embedding"),
+        # Replies are saved while they are generated, there is nothing worth compressing yet
+        **message_content_values(
+            content, compress=message["status"] != ChatMessageStatus.STREAMING
+        ),
+        "search_text": content,
+    }
+
+
+def _write(writes: list[MessageWrite]) -> int:
+    """
+    Saves the writes in a single transaction. Chats first, as the messages may belong to them, then new messages, then
+        the updates. Of several updates of the same message only the last one is saved.
+
+    :return: Number of updates that were replaced by a later update of the same message
+    """
+    chats = [chat for write in writes for chat in write.new_chats]
+    messages = [
+        _message_row(message) for write in writes for message in write.new_messages
+    ]
+    updates = {}
+    coalesced_updates = 0
+    for write in writes:
+        for message_id, content_and_status in write.message_updates.items():
+            coalesced_updates += message_id in updates
+            updates[message_id] = content_and_status
+
+    with Session(get_database_engine()) as db:
+        # Lists of rows are inserted with executemany, which sends them in as few statements as possible
+        if chats:
+            db.execute(insert(Chat), chats)
+        if messages:
+            db.execute(_INSERT_MESSAGE, messages)
+        for message_id, (content, status) in updates.items():
+            db.execute(
+                update(ChatMessage)
+                .where(ChatMessage.id == message_id)
+                .values(
+                    **message_content_values(
+                        content, compress=status != ChatMessageStatus.STREAMING
+                    ),
+                    search_vector=message_search_vector(content),
+                    status=status,
+                    checkpoint_date=generate_current_date(),
+                )
+            )
+        db.commit()
+
+    return coalesced_updates
+
+
+class MessageWriter:
+    """
+    Background writer that group commits the chats and messages saved by all requests. Writes are queued, and the
+        writer thread saves everything that was queued within `flush_interval_seconds` of the first write in a single
+        transaction, with one connection. A reply that is being generated is checkpointed many times, queued
+        checkpoints of the same reply are coalesced into one update.
+
+    Every write comes with a future that is done once the write is committed. Writes that don't fit into the queue
+        are not queued, the caller saves them on its own (see `save_messages`). On `stop` the writer saves everything
+        still in the queue before it returns.
+    """
+
+    def __init__(
+        self, flush_interval_seconds: float, batch_size: int, max_queued_writes: int
+    ):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.batch_size = batch_size
+
+        self._queue: queue.Queue[tuple[MessageWrite, Future, float]] = queue.Queue(
+            maxsize=max_queued_writes
+        )
+        self._running = False
+        self._thread: threading.Thread | None = None
+        # Held while checking whether the writer runs and queueing, so nothing is queued once it is stopped
+        self._submit_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._queued_writes = 0
+        self._synchronous_writes = 0
+        self._failed_writes = 0
+        self._coalesced_updates = 0
+        self._commits = 0
+        self._total_commit_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="message-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Saves the writes that are still queued and stops the writer. Writes submitted from now on are rejected
+        """
+        with self._submit_lock:
+            self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        # Whatever the writer thread left behind is saved here, no future is left waiting
+        leftover = []
+        while True:
+            try:
+                leftover.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftover:
+            self._write_batch(leftover)
+
+    def submit(self, write: MessageWrite) -> Future | None:
+        """
+        Queues the write, can be called from any thread (and the event loop)
+
+        :return: Done once the write is committed, None if the writer is stopped or its queue is full
+        """
+        future = Future()
+        with self._submit_lock:
+            if not self._running:
+                return None
+            try:
+                self._queue.put_nowait((write, future, time.perf_counter()))
+            except queue.Full:
+                return None
+
+        with self._stats_lock:
+            self._queued_writes += 1
+        return future
+
+    def record_synchronous_write(self):
+        with self._stats_lock:
+            self._synchronous_writes += 1
+
+    def statistics(self) -> MessageWriterStatistics:
+        with self._stats_lock:
+            return MessageWriterStatistics(
+                queue_depth=self._queue.qsize(),
+                queued_writes=self._queued_writes,
+                synchronous_writes=self._synchronous_writes,
+                failed_writes=self._failed_writes,
+                coalesced_updates=self._coalesced_updates,
+                commits=self._commits,
+                average_batch_size=self._queued_writes / self._commits
+                if self._commits
+                else 0.0,
+                average_commit_seconds=self._total_commit_seconds / self._commits
+                if self._commits
+                else 0.0,
+                max_wait_seconds=self._max_wait_seconds,
+            )
+
+    def _next_batch(self) -> list[tuple[MessageWrite, Future, float]]:
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+
+        # Once stopping, the rest of the queue is saved without waiting for more writes
+        deadline = time.monotonic() + (
+            self.flush_interval_seconds if self._running else 0
+        )
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(
+                    self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+            elif not self._running:
+                break
+
+    def _write_batch(self, batch: list[tuple[MessageWrite, Future, float]]):
+        start = time.perf_counter()
+        try:
+            coalesced_updates = _write([write for write, _, _ in batch])
+        except Exception:
+            logger.exception(
+                f"Failed to save {len(batch)} writes together, saving them one by one"
+            )
+            self._write_one_by_one(batch)
+            return
+
+        finished = time.perf_counter()
+        for _, future, _ in batch:
+            future.set_result(None)
+
+        with self._stats_lock:
+            self._commits += 1
+            self._coalesced_updates += coalesced_updates
+            self._total_commit_seconds += finished - start
+            self._max_wait_seconds = max(
+                self._max_wait_seconds,
+                *(finished - queued_at for _, _, queued_at in batch),
+            )
+
+    def _write_one_by_one(self, batch: list[tuple[MessageWrite, Future, float]]):
+        # A write that can't be saved must not take the others of its batch down with it
+        for write, future, _ in batch:
+            try:
+                _write([write])
+            except Exception as e:
+                logger.exception("Failed to save messages")
+                with self._stats_lock:
+                    self._failed_writes += 1
+                future.set_exception(e)
+            else:
+                with self._stats_lock:
+                    self._commits += 1
+                future.set_result(None)
+
+
+MESSAGE_WRITER: MessageWriter | None = None
+
+
+def initialize_message_writer():
+    global MESSAGE_WRITER
+
+    if CONFIG.message_write_interval_seconds <= 0:
+        return
+
+    MESSAGE_WRITER = MessageWriter(
+        flush_interval_seconds=CONFIG.message_write_interval_seconds,
+        batch_size=CONFIG.message_write_batch_size,
+        max_queued_writes=CONFIG.message_write_max_queued,
+    )
+    MESSAGE_WRITER.start()
+
+
+def shutdown_message_writer():
+    global MESSAGE_WRITER
+
+    if MESSAGE_WRITER is not None:
+        MESSAGE_WRITER.stop()
+        MESSAGE_WRITER = None
+
+
+def submit_messages(write: MessageWrite) -> Future | None:
+    """
+    Queues the write with the message writer without waiting for it, see `MessageWriter.submit`
+
+    :return: None if it could not be queued, the caller has to save it itself
+    """
+    if MESSAGE_WRITER is None:
+        return None
+    return MESSAGE_WRITER.submit(write)
+
+
+def write_messages_now(write: MessageWrite):
+    """
+    Saves the write right away, on the calling thread
+    """
+    if MESSAGE_WRITER is not None:
+        MESSAGE_WRITER.record_synchronous_write()
+    _write([write])
+
+
+def save_messages(write: MessageWrite):
+    """
+    Saves the write and waits until it is committed. Blocks, must not be called from the event loop
+
+    :raises Exception: If the write could not be saved
+    """
+    future = submit_messages(write)
+    if future is None:
+        write_messages_now(write)
+    else:
+        future.result()
+
+
+async def save_messages_async(write: MessageWrite, wait: bool = True):
+    """
+    Saves the write from the event loop
+
+    :param wait: Wait until the write is committed. Otherwise only until it is queued, failures are logged by the
+        writer (or raised, if it is saved right away because it could not be queued)
+    """
+    future = submit_messages(write)
+    if future is None:
+        await anyio.to_thread.run_sync(write_messages_now, write)
+    elif wait:
+        await asyncio.wrap_future(future)
@@ -0,0 +1,316 @@
+import queue
+import threading
+import time
+from typing import NamedTuple
+from uuid import UUID
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from src.ai_models import get_inference_client, get_model_registry
+from src.config import CONFIG
+from src.data_models.chat import ChatMessage, ChatMessageStatus
+from src.database import get_database_engine
+from src.exceptions import GenerationQueueFullError
+from src.inference.generation import GenerationPriority, SamplingParameters
+from src.logs import get_logger
+from src.services.message_compression import read_content
+
+logger = get_logger(__name__)
+
+SUMMARY_PROMPT = "SUMMARIZE THE FOLLOWING MESSAGE:\n"
+
+# How long to wait before trying again when the scheduler has live messages queued
+BUSY_BACKOFF_SECONDS = 0.5
+
+
+class SummarizationStatistics(NamedTuple):
+    queue_depth: int
+    summarized_messages: int
+    failed_messages: int
+    batches: int
+    average_latency_seconds: float
+    max_latency_seconds: float
+    last_batch_seconds: float
+
+
+class SummarizationWorker:
+    """
+    Background worker that fills in `ChatMessage.summary` using the model that is already loaded for chatting.
+
+    Message ids are pulled from a queue in batches of up to `batch_size`. All messages of a batch are submitted to the
+        generation scheduler together at background priority, so they are decoded as one padded batch and only take
+        up capacity that live chat messages are not waiting for. Summaries of a batch are written back in a single
+        bulk update.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        max_queued_messages: int,
+        max_new_tokens: int,
+        max_input_tokens: int,
+    ):
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.max_input_tokens = max_input_tokens
+
+        self._queue: queue.Queue[tuple[UUID, float]] = queue.Queue(
+            maxsize=max_queued_messages
+        )
+        self._running = False
+        self._thread: threading.Thread | None = None
+
+        self._stats_lock = threading.Lock()
+        self._summarized_messages = 0
+        self._failed_messages = 0
+        self._batches = 0
+        self._total_latency_seconds = 0.0
+        self._max_latency_seconds = 0.0
+        self._last_batch_seconds = 0.0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="summarization-worker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def enqueue(self, message_id: UUID) -> bool:
+        """
+        Queues the message to be summarized
+
+        :return: False if the queue is full, the message will be picked up again by the next backfill
+        """
+        try:
+            self._queue.put_nowait((message_id, time.perf_counter()))
+            return True
+        except queue.Full:
+            return False
+
+    def enqueue_unsummarized_messages(self, min_characters: int):
+        """
+        Queues existing messages that are missing a summary, until the queue is full
+        """
+        query = (
+            select(ChatMessage.id)
+            .where(
+                ChatMessage.summary.is_(None),
+                ChatMessage.status != ChatMessageStatus.STREAMING,
+                ChatMessage.content_length >= min_characters,
+            )
+            .order_by(ChatMessage.create_date.desc())
+            .execution_options(yield_per=1000)
+        )
+
+        queued = 0
+        with Session(get_database_engine()) as db:
+            for message_id in db.scalars(query):
+                if not self.enqueue(message_id):
+                    break
+                queued += 1
+
+        logger.info(f"Queued {queued} existing messages for summarization")
+
+    def statistics(self) -> SummarizationStatistics:
+        with self._stats_lock:
+            return SummarizationStatistics(
+                queue_depth=self._queue.qsize(),
+                summarized_messages=self._summarized_messages,
+                failed_messages=self._failed_messages,
+                batches=self._batches,
+                average_latency_seconds=self._total_latency_seconds
+                / self._summarized_messages
+                if self._summarized_messages
+                else 0.0,
+                max_latency_seconds=self._max_latency_seconds,
+                last_batch_seconds=self._last_batch_seconds,
+            )
+
+    def _next_batch(self) -> list[tuple[UUID, float]]:
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        retry_batch = None
+        while self._running:
+            batch = retry_batch if retry_batch is not None else self._next_batch()
+            retry_batch = None
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                self._summarize_batch(batch)
+            except GenerationQueueFullError:
+                # live messages take priority, try the batch again later. It is kept here rather than put back into
+                #   the queue, which producers may have filled up again in the meantime
+                retry_batch = batch
+                time.sleep(BUSY_BACKOFF_SECONDS)
+                continue
+            except Exception:
+                logger.exception(f"Failed to summarize {len(batch)} messages")
+                with self._stats_lock:
+                    self._failed_messages += len(batch)
+                continue
+
+            finished = time.perf_counter()
+            with self._stats_lock:
+                self._batches += 1
+                self._last_batch_seconds = finished - start
+                for _, enqueued_at in batch:
+                    self._total_latency_seconds += finished - enqueued_at
+                    self._max_latency_seconds = max(
+                        self._max_latency_seconds, finished - enqueued_at
+                    )
+                self._summarized_messages += len(batch)
+
+    def _summarize_batch(self, batch: list[tuple[UUID, float]]):
+        # Summaries are always generated by the default model, which stays loaded while they are
+        with get_model_registry().use() as ml_model:
+            self._summarize_batch_with_model(batch, ml_model)
+
+    def _summarize_batch_with_model(self, batch: list[tuple[UUID, float]], ml_model):
+        scheduler = ml_model.scheduler
+
+        # Don't add to the queue while live messages are waiting for a free slot in the batch
+        while self._running and scheduler.statistics().queued_requests > 0:
+            time.sleep(BUSY_BACKOFF_SECONDS)
+
+        message_ids = [message_id for message_id, _ in batch]
+        with Session(get_database_engine()) as db:
+            messages = db.execute(
+                select(
+                    ChatMessage.id,
+                    ChatMessage.plain_content,
+                    ChatMessage.compressed_content,
+                ).where(ChatMessage.id.in_(message_ids), ChatMessage.summary.is_(None))
+            ).all()
+
+        # The connection is released while generating, all summaries are submitted up front so they share a batch.
+        #   If the scheduler's queue fills up halfway, the summaries submitted so far are cancelled, as the whole
+        #   batch is tried again
+        streams = []
+        try:
+            for message in messages:
+                prompt_ids = self._build_prompt_ids(
+                    ml_model.tokenizer,
+                    read_content(message.plain_content, message.compressed_content),
+                )
+                streams.append(
+                    (
+                        message.id,
+                        scheduler.submit(
+                            prompt_ids,
+                            max_new_tokens=self.max_new_tokens,
+                            priority=GenerationPriority.BACKGROUND,
+                            sampling=SamplingParameters(do_sample=False),
+                        ),
+                    )
+                )
+        except Exception:
+            for _, stream in streams:
+                stream.cancel()
+            raise
+
+        summaries = [
+            {"id": message_id, "summary": "".join(stream).strip()}
+            for message_id, stream in streams
+        ]
+
+        if summaries:
+            with Session(get_database_engine()) as db:
+                db.execute(update(ChatMessage), summaries)
+                db.commit()
+
+    def _build_prompt_ids(self, tokenizer, content: str) -> list[int]:
+        content_ids = tokenizer(content, add_special_tokens=False).input_ids
+        if len(content_ids) > self.max_input_tokens:
+            content = tokenizer.decode(content_ids[: self.max_input_tokens])
+
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": SUMMARY_PROMPT + content}],
+            tokenize=False,
+            add_generation_prompt=True,
+            enable_thinking=False,
+        )
+        return tokenizer([text]).input_ids[0]
+
+
+SUMMARIZATION_WORKER: SummarizationWorker | None = None
+
+
+def initialize_summarization_worker():
+    global SUMMARIZATION_WORKER
+
+    # With an inference server, the server summarizes the messages of all web workers, see `summarize_chat_message`
+    if not CONFIG.summarization_enabled or get_inference_client() is not None:
+        return
+
+    SUMMARIZATION_WORKER = SummarizationWorker(
+        batch_size=CONFIG.summarization_batch_size,
+        max_queued_messages=CONFIG.summarization_max_queued_messages,
+        max_new_tokens=CONFIG.summarization_max_new_tokens,
+        max_input_tokens=CONFIG.context_max_tokens,
+    )
+    SUMMARIZATION_WORKER.start()
+    SUMMARIZATION_WORKER.enqueue_unsummarized_messages(
+        CONFIG.summarization_min_characters
+    )
+
+
+def shutdown_summarization_worker():
+    global SUMMARIZATION_WORKER
+
+    if SUMMARIZATION_WORKER is not None:
+        SUMMARIZATION_WORKER.stop()
+        SUMMARIZATION_WORKER = None
+
+
+def summarize_chat_message(message_id: UUID, content: str):
+    """
+    Queues the message to have its summary generated in the background, if it is long enough to need one
+    """
+    if (
+        not CONFIG.summarization_enabled
+        or len(content) < CONFIG.summarization_min_characters
+    ):
+        return
+
+    if SUMMARIZATION_WORKER is not None:
+        SUMMARIZATION_WORKER.enqueue(message_id)
+        return
+
+    inference_client = get_inference_client()
+    if inference_client is not None:
+        inference_client.notify("summarize", message_id)
+
+
+def summarization_statistics() -> SummarizationStatistics | None:
+    """
+    Statistics of the summarization worker of this process, or of the inference server's. None if summarization is
+        disabled
+    """
+    if SUMMARIZATION_WORKER is not None:
+        return SUMMARIZATION_WORKER.statistics()
+
+    inference_client = get_inference_client()
+    if inference_client is not None:
+        return inference_client.call("summarization_statistics")
+    return None
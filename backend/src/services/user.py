@@ -1,3 +1,4 @@
+import functools
 import secrets
 import uuid
 import datetime
@@ -23,6 +24,8 @@ from src.models.user import (
     UserLoginResponse,
     UserTokenLoginModel,
 )
+from src.util.password_hashing import HashingExecutor
+from src.util.token_cache import VerifiedTokenCache
 
 
 def _throw_if_already_exists(user: CreateNewUserModel, db: Session):
@@ -44,8 +47,24 @@ def _throw_if_already_exists(user: CreateNewUserModel, db: Session):
         raise ValidationError("User with given username or email already exists")
 
 
-_PASSWORD_HASHER = PasswordHasher()
-FAKE_HASH = _PASSWORD_HASHER.hash("fake_password")
+_PASSWORD_HASHER = PasswordHasher(
+    time_cost=CONFIG.password_hash_time_cost,
+    memory_cost=CONFIG.password_hash_memory_cost_kib,
+    parallelism=CONFIG.password_hash_parallelism,
+)
+
+
+@functools.cache
+def _fake_password_hash() -> str:
+    # Hashing takes a noticeable time with the default cost, so it is only done once the first login needs it
+    return _PASSWORD_HASHER.hash("fake_password")
+
+
+# All hashing runs on its own bounded pool, so a burst of logins can't starve the request threads and the CPU
+HASHING_EXECUTOR = HashingExecutor(
+    workers=CONFIG.password_hashing_workers,
+    max_queued=CONFIG.password_hashing_max_queued,
+)
 
 
 def _hash_password(password: str) -> str:
@@ -55,7 +74,7 @@ def _hash_password(password: str) -> str:
     :param password:
     :return:
     """
-    return _PASSWORD_HASHER.hash(password)
+    return HASHING_EXECUTOR.run(_PASSWORD_HASHER.hash, password)
 
 
 def _verify_password(hashed_password: str, password: str) -> bool:
@@ -66,6 +85,10 @@ def _verify_password(hashed_password: str, password: str) -> bool:
     :param password: The raw password provided as input by the user
     :return: True if matches, false otherwise
     """
+    return HASHING_EXECUTOR.run(_verify_password_hash, hashed_password, password)
+
+
+def _verify_password_hash(hashed_password: str, password: str) -> bool:
     try:
         return _PASSWORD_HASHER.verify(hashed_password, password)
     except argon2.exceptions.VerificationError:
@@ -100,7 +123,7 @@ def _validate_login_user(username: str, db: Session) -> User:
 
     if user is None:
         # Validate the password, so this function takes the same amount of time if the user does not exist as if it does
-        _verify_password(FAKE_HASH, username)
+        _verify_password(_fake_password_hash(), username)
         raise InvalidCredentialsError()
 
     if user.locked:
@@ -122,6 +145,10 @@ def login(login_model: UserLoginModel, db: Session) -> UserLoginResponse:
     if not _verify_password(user.password, login_model.password):
         raise InvalidCredentialsError()
 
+    # Upgrade the hash if the cost parameters have changed, it is committed together with the refresh token
+    if _PASSWORD_HASHER.check_needs_rehash(user.password):
+        user.password = _hash_password(login_model.password)
+
     return _create_login_response_for_user(user, db)
 
 
@@ -190,7 +217,17 @@ def _create_user_access_token(user: User) -> str:
     return jwt.encode(payload, CONFIG.jwt_sign_secret, algorithm=JWT_SIGN_ALGO)
 
 
+# Verified access tokens, so clients sending the same token on every request only have it verified once
+VERIFIED_TOKEN_CACHE: VerifiedTokenCache[JwtUser] = VerifiedTokenCache(
+    CONFIG.auth_token_cache_size
+)
+
+
 def validate_user_access_token(token: str) -> JwtUser:
+    cached_user = VERIFIED_TOKEN_CACHE.get(token)
+    if cached_user is not None:
+        return cached_user
+
     try:
         decoded_payload = jwt.decode(
             token,
@@ -200,7 +237,7 @@ def validate_user_access_token(token: str) -> JwtUser:
                 "require": ["iat", "nbf", "exp", "sub", "username", "name", "email"]
             },
         )
-        return JwtUser(
+        user = JwtUser(
             id=uuid.UUID(decoded_payload["sub"]),
             username=decoded_payload["username"],
             name=decoded_payload["name"],
@@ -209,6 +246,9 @@ def validate_user_access_token(token: str) -> JwtUser:
     except jwt.PyJWTError:
         raise InvalidTokenError()
 
+    VERIFIED_TOKEN_CACHE.put(token, user, expires_at=decoded_payload["exp"])
+    return user
+
 
 def _generate_refresh_token() -> tuple[str, str]:
     return secrets.token_urlsafe(16)[:16], secrets.token_urlsafe(128)
@@ -0,0 +1,43 @@
+import time
+
+from src.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS, HTTP_REQUESTS_IN_PROGRESS
+
+
+class HttpMetricsMiddleware:
+    """
+    Records the count and duration of every HTTP request, labelled with the route template (e.g. `/chat/{chat_id}/`)
+        rather than the raw path, so the number of label values stays bounded.
+
+    Implemented as plain ASGI middleware, so streamed responses pass through untouched and are timed until their last
+        chunk has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            HTTP_REQUESTS.labels(scope["method"], route_path, status_code).inc()
+            HTTP_REQUEST_DURATION.labels(scope["method"], route_path).observe(
+                time.perf_counter() - start
+            )
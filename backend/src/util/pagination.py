@@ -0,0 +1,46 @@
+import base64
+import binascii
+import datetime
+import uuid
+
+from src.exceptions import ValidationError
+
+
+def encode_cursor(create_date: datetime.datetime, entity_id: uuid.UUID) -> str:
+    """
+    Encodes the position of an entity in a list ordered by (create_date, id) into an opaque cursor
+    """
+    raw = f"{create_date.isoformat()}|{entity_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, uuid.UUID]:
+    """
+    Decodes a cursor created by `encode_cursor`, raises a ValidationError if it is not a valid cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        create_date, entity_id = raw.split("|")
+        return datetime.datetime.fromisoformat(create_date), uuid.UUID(entity_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError("Invalid cursor")
+
+
+def encode_rank_cursor(rank: float, entity_id: uuid.UUID) -> str:
+    """
+    Encodes the position of an entity in a list ordered by (rank, id), e.g. of search results, into an opaque cursor
+    """
+    raw = f"{rank!r}|{entity_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_rank_cursor(cursor: str) -> tuple[float, uuid.UUID]:
+    """
+    Decodes a cursor created by `encode_rank_cursor`, raises a ValidationError if it is not a valid cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        rank, entity_id = raw.split("|")
+        return float(rank), uuid.UUID(entity_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError("Invalid cursor")
@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple, TypeVar
+
+from src.exceptions import PasswordHashingBusyError
+
+T = TypeVar("T")
+
+
+class HashingStatistics(NamedTuple):
+    workers: int
+    max_queued: int
+    in_flight: int
+    completed: int
+    rejected: int
+    average_wait_seconds: float
+    max_wait_seconds: float
+    average_hash_seconds: float
+    max_hash_seconds: float
+
+
+class HashingExecutor:
+    """
+    Runs password and token hashing on a small dedicated pool of threads.
+
+    Argon2 is deliberately expensive, so a burst of logins would otherwise take up every CPU core and request thread.
+        At most `workers` hashes run at once and at most `max_queued` more wait for a free worker. Anything beyond that
+        is rejected immediately with a `PasswordHashingBusyError`, rather than piling up.
+    """
+
+    def __init__(self, workers: int, max_queued: int):
+        self.workers = workers
+        self.max_queued = max_queued
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hashing"
+        )
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._total_hash_seconds = 0.0
+        self._max_hash_seconds = 0.0
+
+    def run(self, function: Callable[..., T], *args) -> T:
+        """
+        Runs the function on the hashing pool and waits for its result
+
+        :raises PasswordHashingBusyError: If all workers are busy and the queue is full
+        """
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queued:
+                self._rejected += 1
+                raise PasswordHashingBusyError()
+            self._in_flight += 1
+
+        try:
+            submitted_at = time.perf_counter()
+            return self._executor.submit(
+                self._timed, submitted_at, function, *args
+            ).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _timed(self, submitted_at: float, function: Callable[..., T], *args) -> T:
+        started_at = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            finished_at = time.perf_counter()
+            with self._lock:
+                self._completed += 1
+                self._total_wait_seconds += started_at - submitted_at
+                self._max_wait_seconds = max(
+                    self._max_wait_seconds, started_at - submitted_at
+                )
+                self._total_hash_seconds += finished_at - started_at
+                self._max_hash_seconds = max(
+                    self._max_hash_seconds, finished_at - started_at
+                )
+
+    def statistics(self) -> HashingStatistics:
+        with self._lock:
+            return HashingStatistics(
+                workers=self.workers,
+                max_queued=self.max_queued,
+                in_flight=self._in_flight,
+                completed=self._completed,
+                rejected=self._rejected,
+                average_wait_seconds=self._total_wait_seconds / self._completed
+                if self._completed
+                else 0.0,
+                max_wait_seconds=self._max_wait_seconds,
+                average_hash_seconds=self._total_hash_seconds / self._completed
+                if self._completed
+                else 0.0,
+                max_hash_seconds=self._max_hash_seconds,
+            )
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Callable
+
+import anyio
+from fastapi import HTTPException
+from starlette import status
+
+from src.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds clients are asked to wait before retrying while the process is starting up
+STARTUP_RETRY_AFTER_SECONDS = 5
+
+
+class StartupStatus:
+    """
+    Progress of the startup of this process: which steps took how long, and whether it can serve requests yet
+    """
+
+    def __init__(self):
+        # Created while the app is imported, so the time until startup begins is roughly the time spent importing it
+        self.created_at = time.perf_counter()
+        self.started_at: float | None = None
+        self.timings: dict[str, float] = {}
+        self.error: BaseException | None = None
+
+        self.ready = False
+        # Set once the startup finished, whether it succeeded or not
+        self._finished = asyncio.Event()
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def begin(self):
+        self.started_at = time.perf_counter()
+        self.timings["imports"] = self.started_at - self.created_at
+
+    async def run_step(self, name: str, function: Callable, *args):
+        """
+        Runs a blocking startup step on a worker thread, so other steps and health checks run in the meantime
+        """
+        start = time.perf_counter()
+        result = await anyio.to_thread.run_sync(function, *args)
+        self.timings[name] = time.perf_counter() - start
+        return result
+
+    def mark_ready(self):
+        self.timings["total"] = time.perf_counter() - self.started_at
+        self.ready = True
+        self._finished.set()
+
+        breakdown = ", ".join(
+            f"{name} {seconds:.2f}s"
+            for name, seconds in self.timings.items()
+            if name != "total"
+        )
+        logger.info(
+            f"Ready to serve requests after {self.timings['total']:.2f}s ({breakdown})"
+        )
+
+    def mark_failed(self, error: BaseException):
+        self.error = error
+        self._finished.set()
+        logger.error("Startup failed", exc_info=error)
+
+    async def wait_until_ready(self):
+        """
+        :raises RuntimeError: If the startup failed
+        """
+        await self._finished.wait()
+        if self.error is not None:
+            raise RuntimeError("Startup failed") from self.error
+
+
+STARTUP = StartupStatus()
+
+
+def verify_ready():
+    """
+    Rejects requests until startup has finished, e.g. while the models are still loading
+    """
+    if not STARTUP.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The service is starting up, try again later",
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER_SECONDS)},
+        )
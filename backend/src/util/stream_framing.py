@@ -0,0 +1,73 @@
+import json
+from enum import StrEnum
+from typing import Any, AsyncIterator, NamedTuple
+
+
+class StreamEvent(NamedTuple):
+    """
+    An event of a streamed reply: `chat` (the created chat), `message` (the reply being streamed), `delta` (text of
+        the reply), `end` (the reply is finished, with its status and token usage) or `error`
+    """
+
+    name: str
+    data: dict[str, Any]
+
+
+class StreamFormat(StrEnum):
+    # Only the text of the reply, the format of the original API
+    TEXT = "text"
+    # One JSON object per line, with the event name in `type`
+    NDJSON = "ndjson"
+    # Server-sent events, with the event data as JSON
+    SSE = "sse"
+
+    @property
+    def media_type(self) -> str | None:
+        return _MEDIA_TYPES[self]
+
+
+_MEDIA_TYPES = {
+    StreamFormat.TEXT: None,
+    StreamFormat.NDJSON: "application/x-ndjson",
+    StreamFormat.SSE: "text/event-stream",
+}
+
+
+def negotiate_stream_format(accept: str | None) -> StreamFormat:
+    """
+    Picks the format of a streamed reply from the Accept header, clients that don't ask for a framed format get the
+        plain text
+    """
+    if accept:
+        media_types = {part.split(";")[0].strip().lower() for part in accept.split(",")}
+        if "text/event-stream" in media_types:
+            return StreamFormat.SSE
+        if "application/x-ndjson" in media_types:
+            return StreamFormat.NDJSON
+
+    return StreamFormat.TEXT
+
+
+def _dump_json(data: dict[str, Any]) -> str:
+    # Same output as pydantic's `model_dump_json`, so the chat line of the text format stays unchanged
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+async def frame_events(
+    events: AsyncIterator[StreamEvent], stream_format: StreamFormat
+) -> AsyncIterator[str]:
+    """
+    Encodes the events of a streamed reply in the given format, one chunk per event
+    """
+    async for event in events:
+        if stream_format == StreamFormat.SSE:
+            yield f"event: {event.name}\ndata: {_dump_json(event.data)}\n\n"
+        elif stream_format == StreamFormat.NDJSON:
+            yield _dump_json({"type": event.name, **event.data}) + "\n"
+        elif event.name == "chat":
+            yield _dump_json(event.data) + "\n"
+        elif event.name == "delta":
+            yield event.data["text"]
+        elif event.name == "error":
+            # The text format has no way to tell the client, the connection is dropped instead like it always was
+            raise RuntimeError(event.data["detail"])
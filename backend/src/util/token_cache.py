@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, NamedTuple, TypeVar
+
+T = TypeVar("T")
+
+
+class TokenCacheStatistics(NamedTuple):
+    max_entries: int
+    entries: int
+    hits: int
+    misses: int
+    expirations: int
+    evictions: int
+    hit_rate: float
+
+
+class _CachedToken(NamedTuple, Generic[T]):
+    value: T
+    expires_at: float
+
+
+class VerifiedTokenCache(Generic[T]):
+    """
+    Remembers the result of verifying a token until the token expires, so repeated requests with the same token skip
+        the signature check.
+
+    Tokens are keyed by their SHA-256 digest, so the raw tokens are never kept in memory. Least recently used tokens are
+        evicted once more than `max_entries` are cached.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._tokens: OrderedDict[bytes, _CachedToken[T]] = OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._expirations = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> T | None:
+        key = self._key(token)
+
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is None:
+                self._misses += 1
+                return None
+
+            if cached.expires_at <= time.time():
+                del self._tokens[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+
+            self._tokens.move_to_end(key)
+            self._hits += 1
+            return cached.value
+
+    def put(self, token: str, value: T, expires_at: float):
+        """
+        Caches the verified value of the token
+
+        :param token: The raw token
+        :param value: The value the token was verified to, returned by `get` until the token expires
+        :param expires_at: Unix timestamp at which the token expires
+        """
+        if self.max_entries <= 0:
+            return
+
+        key = self._key(token)
+
+        with self._lock:
+            self._tokens[key] = _CachedToken(value, expires_at)
+            self._tokens.move_to_end(key)
+
+            while len(self._tokens) > self.max_entries:
+                self._tokens.popitem(last=False)
+                self._evictions += 1
+
+    def statistics(self) -> TokenCacheStatistics:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return TokenCacheStatistics(
+                max_entries=self.max_entries,
+                entries=len(self._tokens),
+                hits=self._hits,
+                misses=self._misses,
+                expirations=self._expirations,
+                evictions=self._evictions,
+                hit_rate=self._hits / lookups if lookups else 0.0,
+            )